@@ -1,12 +1,16 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Security
+from fastapi import FastAPI, Depends, HTTPException, Request, status, Security
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic_settings import BaseSettings
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, make_url, text
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+import asyncio
 import redis
 import os
-from typing import Annotated
+from typing import Annotated, Dict, Optional
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 
@@ -16,14 +20,75 @@ load_dotenv()
 # --- 3.10.1 Settings and Configuration ---
 class Settings(BaseSettings):
     database_url: str
+    async_database_url: str = "" # Empty derives it from database_url (pymysql -> aiomysql, sqlite -> aiosqlite)
+    db_pool_size: int = 10 # Connections kept open per engine (sync and async each have their own pool)
+    db_max_overflow: int = 20 # Extra connections allowed during spikes, closed when returned
+    db_pool_timeout_s: float = 10.0 # Wait for a free connection before failing the request
+    db_pool_recycle_s: int = 1800 # Replace connections older than this; keep below MySQL's wait_timeout
+    db_pool_pre_ping: bool = True # Test each connection on checkout and reconnect if the server dropped it
+    database_replica_urls: str = "" # Comma-separated read replica URLs for get_read_db; empty reads from the primary
+    db_replica_pin_s: float = 5.0 # After a client writes, its reads stay on the primary this long (read-your-writes)
+    db_replica_eject_after_failures: int = 3 # Consecutive connection errors before a replica is taken out of rotation
+    db_replica_eject_s: float = 30.0 # How long an ejected replica stays out before it is tried again
+    db_replica_check_interval_s: float = 10.0 # Period of the SELECT 1 health check on every replica
     redis_url: str
     jwt_secret_key: str
     algorithm: str = "HS256"
+    jwt_cache_max_entries: int = 10000 # Verified tokens whose claims are kept in memory per worker; 0 decodes every request
+    jwt_cache_max_ttl_s: float = 300.0 # Upper bound on caching one token, below its own exp; bounds a key rotation's lag
     line_channel_access_token: str = "your_line_channel_access_token"
     line_channel_secret: str = "your_line_channel_secret"
     line_user_id: str = "Udeadbeefdeadbeefdeadbeefdeadbeef" # Default mock ID
     stripe_api_key: str = "sk_test_mock_stripe_key_12345"
     newebpay_api_key: str = "mock_newebpay_key_ABCDE"
+    iot_series_capacity: int = 8640 # Readings kept in memory per device (1 day at 10s intervals)
+    iot_bulk_max_rows: int = 100000 # Upper bound on rows accepted by one bulk upload
+    iot_persist_enabled: bool = True # Write IoT readings behind to the iot_readings table
+    iot_persist_max_pending_rows: int = 100000 # Ingest answers 429 once this many rows await flushing
+    iot_persist_batch_size: int = 500 # Rows per multi-row INSERT
+    iot_persist_flush_interval_ms: int = 1000 # Flush at least this often while rows are pending
+    iot_persist_to_db: bool = True # Also insert flushed readings into the iot_readings table
+    iot_persist_max_retries: int = 3 # Retries of a failed flush before it is requeued (transient errors) or split to dead-letter bad rows
+    iot_persist_retry_backoff_ms: int = 200 # First retry delay, doubled on each further retry
+    iot_segment_dir: str = "" # Directory for on-disk IoT segment files; empty disables cold storage
+    iot_segment_max_records: int = 1000000 # Records per segment file before rolling over (40 bytes each)
+    iot_segment_retention_days: int = 180 # Compaction deletes readings older than this
+    iot_segment_compaction_interval_s: int = 3600
+    iot_live_max_queue: int = 32 # Frames buffered per live subscriber before the oldest is dropped
+    iot_stats_utc_offset_minutes: int = 0 # Where device stats start each hour/day (480 for Taiwan midnight)
+    esg_cache_ttl_s: int = 300 # Freshness of a cached ESG report; writes invalidate it sooner
+    esg_cache_ttl_jitter: float = 0.1 # +/- fraction applied to each TTL so entries expire spread out
+    esg_cache_lock_timeout_ms: int = 10000 # Upper bound on one worker's recompute before others may try
+    esg_cache_wait_timeout_ms: int = 2000 # How long other workers wait for that recompute
+    analytics_pool_enabled: bool = True # Run CPU-heavy analytics in worker processes instead of threads
+    analytics_pool_workers: int = 2
+    analytics_pool_max_pending: int = 8 # Queued + running analytics tasks before answering 503
+    analytics_task_timeout_s: float = 60.0
+    orders_bulk_max_items: int = 1000 # Upper bound on orders accepted by one POST /orders/bulk
+    idempotency_ttl_s: int = 86400 # How long a response stays replayable for its Idempotency-Key
+    idempotency_lock_timeout_ms: int = 30000 # Upper bound on one request holding its key in flight
+    idempotency_wait_timeout_ms: int = 10000 # How long a concurrent duplicate waits before answering 409
+    stock_hold_ttl_s: int = 900 # How long a reservation holds stock before it returns to sale unpaid
+    stock_reconcile_interval_ms: int = 1000 # How often reservations confirmed in Redis are written to products.stock
+    stock_reconcile_batch_size: int = 500 # Products per reconciliation transaction
+    product_search_max_age_s: int = 300 # Rebuild a tenant's search index from MySQL after this (picks up other workers' products)
+    product_search_delta_rebuild_fraction: float = 0.1 # Also rebuild once products added in place exceed this share
+    rate_limit_enabled: bool = True
+    # Token buckets per plan (JSON in RATE_LIMIT_PLANS): requests/s and burst per tenant, and per tenant and route
+    rate_limit_plans: Dict[str, Dict[str, float]] = {
+        "free": {"rate": 5, "burst": 20, "route_rate": 2, "route_burst": 10},
+        "standard": {"rate": 20, "burst": 60, "route_rate": 10, "route_burst": 30},
+        "enterprise": {"rate": 100, "burst": 300, "route_rate": 50, "route_burst": 150},
+    }
+    rate_limit_tenant_plans: Dict[int, str] = {} # Tenant id -> plan (JSON); other tenants get the default plan
+    rate_limit_default_plan: str = "standard"
+    rate_limit_anonymous_plan: str = "free" # Requests without a valid token, limited per client address
+    rate_limit_exempt_paths: str = "/health,/docs,/redoc,/openapi.json" # Comma-separated path prefixes never limited
+    # Comma-separated routes ("METHOD path") never limited: IoT ingest runs at device rates and has its own backpressure (429 when its queue is full)
+    rate_limit_exempt_routes: str = "POST /api/v1/iot/data,POST /api/v1/iot/data/bulk"
+    rate_limit_max_in_flight: int = 0 # Shed load with 503 once this many requests run in one worker; 0 disables
+    rate_limit_redis_timeout_ms: int = 50 # Limiter's Redis socket timeout; on failure it uses in-process buckets
+    rate_limit_fallback_s: float = 5.0 # How long in-process buckets are used after a Redis failure
 
     class Config:
         env_file = ".env"
@@ -52,6 +117,45 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# --- 3.10.1.1 Rate Limiting and Load Shedding ---
+# Registered before CORS so that CORS wraps it and 429/503 responses reach the browser with CORS headers
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+from api.services.rate_limit import RateLimitMiddleware, TokenBucketLimiter
+
+def request_tenant(token: str) -> Optional[int]:
+    """Tenant of a bearer token for rate limiting, or None if it does not verify; fills the JWT cache (3.10.5) for get_current_user."""
+    try:
+        return get_current_user(token)["tenant_id"]
+    except HTTPException:
+        return None
+
+# A client of its own with short timeouts and no retries: every request waits for its check, so it must never wait long on Redis
+rate_limiter = TokenBucketLimiter(
+    redis.Redis.from_url(
+        settings.redis_url,
+        socket_timeout=settings.rate_limit_redis_timeout_ms / 1000,
+        socket_connect_timeout=settings.rate_limit_redis_timeout_ms / 1000,
+        retry=Retry(NoBackoff(), 0),
+    ),
+    settings.rate_limit_plans,
+    settings.rate_limit_tenant_plans,
+    default_plan=settings.rate_limit_default_plan,
+    anonymous_plan=settings.rate_limit_anonymous_plan,
+    fallback_s=settings.rate_limit_fallback_s,
+)
+rate_limit_exempt_paths = tuple(path.strip() for path in settings.rate_limit_exempt_paths.split(",") if path.strip())
+rate_limit_exempt_routes = tuple(route.strip() for route in settings.rate_limit_exempt_routes.split(",") if route.strip())
+if settings.rate_limit_enabled:
+    app.add_middleware(
+        RateLimitMiddleware,
+        limiter=rate_limiter,
+        resolve_tenant=request_tenant,
+        exempt_paths=rate_limit_exempt_paths,
+        exempt_routes=rate_limit_exempt_routes,
+        max_in_flight=settings.rate_limit_max_in_flight,
+    )
+
 # --- 3.10.2 CORS Middleware ---
 app.add_middleware(
     CORSMiddleware,
@@ -59,13 +163,21 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed", "Retry-After"], # Keyset pagination token; marks replayed idempotent responses; 429/503 backoff
 )
 
 # --- 3.10.3 Database Configuration ---
 SQLALCHEMY_DATABASE_URL = settings.database_url
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+from api.services.db_pool import PoolMonitor, pool_options
+POOL_SETTINGS = dict(pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow, timeout_s=settings.db_pool_timeout_s,
+                     recycle_s=settings.db_pool_recycle_s, pre_ping=settings.db_pool_pre_ping)
+db_pool_monitor = PoolMonitor()
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **pool_options(SQLALCHEMY_DATABASE_URL, db_pool_monitor, QueuePool, **POOL_SETTINGS))
+db_pool_monitor.attach(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 from api.models import Base, Tenant, Farmer, Product, Order # Import all models for initial data
+from api.services.esg_stats import rebuild_esg_stats
+from api.migrations import run_migrations
 
 # Dependency to get a DB session
 def get_db():
@@ -75,9 +187,116 @@ def get_db():
     finally:
         db.close()
 
+# Async engine for 'async def' routes: a request waiting on the database no longer holds a threadpool thread
+ASYNC_DRIVERS = {"mysql": "mysql+aiomysql", "mysql+pymysql": "mysql+aiomysql", "sqlite": "sqlite+aiosqlite", "sqlite+pysqlite": "sqlite+aiosqlite"}
+
+def async_database_url(url: str) -> str:
+    """The async-driver form of a sync database URL (unchanged if it already names an async driver)."""
+    parsed = make_url(url)
+    return parsed.set(drivername=ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = settings.async_database_url or async_database_url(SQLALCHEMY_DATABASE_URL)
+async_db_pool_monitor = PoolMonitor()
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL, async_db_pool_monitor, AsyncAdaptedQueuePool, **POOL_SETTINGS))
+async_db_pool_monitor.attach(async_engine.sync_engine)
+# expire_on_commit=False: attributes stay loaded after commit, since async sessions cannot lazy-load them
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Dependency to get an async DB session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # --- 3.10.4 Caching with Redis ---
 redis_client = redis.Redis.from_url(settings.redis_url)
 
+# ESG reports are cached per tenant and farmer; order writes invalidate them
+from api.services.esg_cache import ESGReportCache
+esg_report_cache = ESGReportCache(
+    redis_client,
+    ttl_s=settings.esg_cache_ttl_s,
+    ttl_jitter=settings.esg_cache_ttl_jitter,
+    lock_timeout_ms=settings.esg_cache_lock_timeout_ms,
+    wait_timeout_ms=settings.esg_cache_wait_timeout_ms,
+)
+
+# Responses of POSTs sent with an Idempotency-Key, replayed to retries instead of re-running them
+from api.services.idempotency import IdempotencyStore
+idempotency_store = IdempotencyStore(
+    redis_client,
+    ttl_s=settings.idempotency_ttl_s,
+    lock_timeout_ms=settings.idempotency_lock_timeout_ms,
+    wait_timeout_ms=settings.idempotency_wait_timeout_ms,
+)
+
+# Stock reservations counted in Redis and written behind to products.stock (reconciler started in 3.12.1)
+from api.services.stock import StockReservations
+stock_reservations = StockReservations(
+    redis_client,
+    engine,
+    hold_ttl_s=settings.stock_hold_ttl_s,
+    reconcile_batch_size=settings.stock_reconcile_batch_size,
+)
+
+# In-memory product name search per tenant (built on its first GET /products/search)
+from api.services.product_search import ProductSearchIndex
+product_search_index = ProductSearchIndex(
+    max_age_s=settings.product_search_max_age_s,
+    delta_rebuild_fraction=settings.product_search_delta_rebuild_fraction,
+)
+
+# Process pool for CPU-heavy analytics (started and stopped in 3.12.1)
+from api.services.process_pool import AnalyticsProcessPool
+analytics_pool = AnalyticsProcessPool(
+    max_workers=settings.analytics_pool_workers,
+    max_pending=settings.analytics_pool_max_pending,
+    task_timeout_s=settings.analytics_task_timeout_s,
+)
+
+# --- 3.10.4.1 Read Replicas ---
+from api.services.read_replicas import ReplicaRouter, client_key
+REPLICA_URLS = [url.strip() for url in settings.database_replica_urls.split(",") if url.strip()]
+replica_pool_monitors = {f"replica{i + 1}": PoolMonitor() for i in range(len(REPLICA_URLS))}
+replica_engines = []
+for (name, monitor), url in zip(replica_pool_monitors.items(), REPLICA_URLS):
+    replica_url = async_database_url(url)
+    replica_engines.append((name, create_async_engine(replica_url, **pool_options(replica_url, monitor, AsyncAdaptedQueuePool, **POOL_SETTINGS))))
+    monitor.attach(replica_engines[-1][1].sync_engine)
+read_router = ReplicaRouter(
+    AsyncSessionLocal,
+    replica_engines,
+    redis_client,
+    pin_s=settings.db_replica_pin_s,
+    eject_after_failures=settings.db_replica_eject_after_failures,
+    eject_s=settings.db_replica_eject_s,
+)
+
+def read_client_key(request: Request) -> str:
+    return client_key(request.headers.get("authorization"), request.client.host if request.client else None)
+
+# Dependency to get an async DB session for read-only handlers: a replica when configured, else the primary
+async def get_read_db(request: Request):
+    replica, session_factory = await read_router.route(read_client_key(request))
+    async with session_factory() as db:
+        try:
+            yield db
+        except (OperationalError, InterfaceError):
+            # Lost or refused connections count against the replica; enough of them eject it
+            if replica is not None:
+                read_router.record_failure(replica)
+            raise
+    if replica is not None:
+        read_router.record_success(replica)
+
+if read_router.enabled:
+    @app.middleware("http")
+    async def pin_writers_to_primary(request: Request, call_next):
+        """After a successful write, the client's reads go to the primary for DB_REPLICA_PIN_S (read-your-writes)."""
+        response = await call_next(request)
+        if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+            await read_router.pin(read_client_key(request))
+        return response
+
 # --- 3.10.5 JWT Token Dependency for Multi-tenancy ---
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
@@ -95,37 +314,54 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, settings.jwt_secret_key, algorithm=settings.algorithm)
     return encoded_jwt
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
-    credentials_exception = HTTPException(
+# Claims of verified tokens, so a reused token skips the HMAC check and JSON decoding
+from api.services.token_cache import TokenCache
+token_cache = TokenCache(max_entries=settings.jwt_cache_max_entries, max_ttl_s=settings.jwt_cache_max_ttl_s)
+
+def credentials_exception(detail: str = "Could not validate credentials") -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
+        detail=detail,
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def revoke_token(token: str) -> bool:
+    """Revocation hook (e.g. for logout): evicts the token from this worker's cache and refuses it until it expires."""
+    try:
+        exp = jwt.get_unverified_claims(token).get("exp")
+    except JWTError:
+        exp = None
+    return token_cache.revoke(token, exp)
+
+def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+    if token_cache.is_revoked(token):
+        raise credentials_exception("Token has been revoked")
     try:
         payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.algorithm])
-        username: str = payload.get("sub")
-        tenant_id: int = payload.get("tenant_id") # Get tenant_id from token
-        if username is None or tenant_id is None:
-            raise credentials_exception
-        # In a real app, you would verify against the DB:
-        # user = db.query(User).filter(User.username == username, User.tenant_id == tenant_id).first()
-        # if user is None:
-        #    raise credentials_exception
-        return {"username": username, "tenant_id": tenant_id}
     except JWTError as e:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"Invalid token: {e}",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+        raise credentials_exception(f"Invalid token: {e}")
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Authentication error: {e}",
         )
+    username: str = payload.get("sub")
+    tenant_id: int = payload.get("tenant_id") # Get tenant_id from token
+    if username is None or tenant_id is None:
+        raise credentials_exception()
+    # In a real app, you would verify against the DB:
+    # user = db.query(User).filter(User.username == username, User.tenant_id == tenant_id).first()
+    # if user is None:
+    #    raise credentials_exception()
+    user = {"username": username, "tenant_id": tenant_id}
+    token_cache.put(token, user, payload.get("exp"))
+    return user
 
 # --- 3.10.6 Import and include API Routers ---
-from api.routes import farmers, auth, products, orders, financial, iot, blockchain
+from api.routes import farmers, auth, products, orders, financial, iot, blockchain, analytics
 from notification.line_bot_service import router as line_router
 # This mock router is for frontend to trigger LINE notifications easily for demo
 from api.routes.notifications_mock_for_frontend import router as notifications_mock_router 
@@ -138,6 +374,7 @@ app.include_router(orders.router, prefix="/api/v1", tags=["Orders"])
 app.include_router(financial.router, prefix="/api/v1", tags=["Financial Ledger"])
 app.include_router(iot.router, prefix="/api/v1", tags=["IoT"])
 app.include_router(blockchain.router, prefix="/api/v1", tags=["Blockchain"])
+app.include_router(analytics.router, prefix="/api/v1", tags=["Analytics"])
 app.include_router(line_router, prefix="/api/v1", tags=["Notifications"])
 app.include_router(notifications_mock_router, prefix="/api/v1", tags=["Notifications (Mock)"]) # Mock for frontend
 
@@ -147,22 +384,56 @@ app.include_router(notifications_mock_router, prefix="/api/v1", tags=["Notificat
 def health_check():
     """Health check endpoint to verify service status."""
     try:
-        # Check database connection
-        db = next(get_db())
-        db.execute(text("SELECT 1"))
+        # Check database connection (the session is closed, returning its connection to the pool)
+        with SessionLocal() as db:
+            db.execute(text("SELECT 1"))
         # Check Redis connection
         redis_client.ping()
         return {"status": "ok", "message": "All services are running"}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Service unavailable: {e}")
 
+@app.get("/health/db-pool")
+def db_pool_stats():
+    """
+    Connection pool usage of this worker's sync, async and replica engines (checkouts, waits, overflow and
+    invalidations), and read routing: reads per replica, ejections, pinned and fallback reads.
+    """
+    return {
+        "settings": POOL_SETTINGS,
+        "sync": db_pool_monitor.stats(),
+        "async": async_db_pool_monitor.stats(),
+        "replicas": {name: monitor.stats() for name, monitor in replica_pool_monitors.items()},
+        "read_routing": read_router.stats(),
+    }
+
+@app.get("/health/cache")
+def cache_stats():
+    """Hit/miss counters of the ESG report cache, idempotency store, stock reservations and JWT cache in this worker."""
+    return {
+        "esg_reports": esg_report_cache.stats(),
+        "idempotency": idempotency_store.stats(),
+        "stock": stock_reservations.stats(),
+        "jwt": token_cache.stats(),
+    }
+
+@app.get("/health/rate-limit")
+def rate_limit_stats():
+    """Allowed and rejected requests per tenant, load shed and Redis fallbacks of the rate limiter in this worker."""
+    return rate_limiter.stats()
+
+@app.get("/health/search")
+def search_index_stats():
+    """Size, age and memory of each tenant's product search index in this worker."""
+    return {"tenants": product_search_index.stats()}
+
 # --- 3.12 Initial Data Setup on Startup ---
 @app.on_event("startup")
 def create_initial_data():
     db = SessionLocal()
     try:
-        # Create all tables if they don't exist
-        Base.metadata.create_all(bind=engine)
+        # Create missing tables and apply pending schema migrations (see api/migrations.py)
+        run_migrations(engine)
 
         # Check if default tenant exists
         default_tenant = db.query(Tenant).filter(Tenant.id == 1).first()
@@ -197,6 +468,9 @@ def create_initial_data():
             db.add_all([order1, order2])
             db.commit()
             print("Default orders created.")
+
+            # Derive the demo farmer's ESG stats, score and total sales from the orders above
+            rebuild_esg_stats(db, tenant_id=1)
         else:
             print("Default tenant, farmer, products, and orders already exist. Skipping initial data creation.")
     except Exception as e:
@@ -205,6 +479,30 @@ def create_initial_data():
         db.close()
 
 
+# --- 3.12.1 Background Workers ---
+@app.on_event("startup")
+async def start_background_workers():
+    if settings.iot_persist_enabled:
+        await iot.iot_writer.start()
+    if iot.iot_segments is not None:
+        await iot.iot_segments.start_compaction(settings.iot_segment_compaction_interval_s)
+    if settings.analytics_pool_enabled:
+        analytics_pool.start()
+    await stock_reservations.start(settings.stock_reconcile_interval_ms)
+    await read_router.start(settings.db_replica_check_interval_s)
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    # Drain queued IoT readings to the database before the process exits
+    await iot.iot_writer.stop()
+    if iot.iot_segments is not None:
+        await iot.iot_segments.stop_compaction()
+    await asyncio.to_thread(analytics_pool.stop)
+    await stock_reservations.stop() # Writes confirmed reservations still pending to MySQL
+    await read_router.stop()
+    await async_engine.dispose()
+
+
 # --- 3.13 Main execution ---
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,132 @@
+"""
+Versioned schema migrations.
+
+Each migration runs once and is recorded in the schema_migrations table. Migration 1 creates any
+missing tables from the models (what startup used to do with Base.metadata.create_all); later
+migrations bring databases created before a model change up to date. They inspect the live schema
+first, so on a database that migration 1 has just created from the current models they do nothing.
+
+Run from the repository root:
+    python -m api.migrations upgrade
+    python -m api.migrations status
+"""
+import sys
+from contextlib import contextmanager
+from typing import Callable, List, Tuple
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, insert, select, text, update
+from sqlalchemy.engine import Connection, Engine
+from api.models import Base, Order, Product, utcnow
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Serializes migrations when several workers start at once (MySQL only)
+MIGRATION_LOCK_NAME = "agribridge_schema_migrations"
+MIGRATION_LOCK_TIMEOUT_S = 60
+
+
+def _create_tables(conn: Connection):
+    Base.metadata.create_all(bind=conn)
+
+
+def _add_order_created_at_and_composite_indexes(conn: Connection):
+    if "created_at" not in {column["name"] for column in inspect(conn).get_columns("orders")}:
+        conn.execute(text("ALTER TABLE orders ADD COLUMN created_at DATETIME NULL"))
+        # Existing orders have no recorded creation time; stamp them with the migration time
+        conn.execute(update(Order).where(Order.created_at.is_(None)).values(created_at=utcnow()))
+    inspector = inspect(conn)
+    for table, index_name in ((Order.__table__, "ix_orders_tenant_status_created"), (Product.__table__, "ix_products_tenant_farmer")):
+        if index_name not in {index["name"] for index in inspector.get_indexes(table.name)}:
+            next(index for index in table.indexes if index.name == index_name).create(bind=conn)
+
+
+def _add_stock_columns(conn: Connection):
+    inspector = inspect(conn)
+    if "stock" not in {column["name"] for column in inspector.get_columns("products")}:
+        conn.execute(text("ALTER TABLE products ADD COLUMN stock INTEGER NULL"))
+    if "reservation_id" not in {column["name"] for column in inspector.get_columns("orders")}:
+        conn.execute(text("ALTER TABLE orders ADD COLUMN reservation_id VARCHAR(32) NULL"))
+
+
+def _add_order_batch_id(conn: Connection):
+    if "batch_id" not in {column["name"] for column in inspect(conn).get_columns("orders")}:
+        conn.execute(text("ALTER TABLE orders ADD COLUMN batch_id VARCHAR(32) NULL"))
+    if "ix_orders_batch_id" not in {index["name"] for index in inspect(conn).get_indexes("orders")}:
+        next(index for index in Order.__table__.indexes if index.name == "ix_orders_batch_id").create(bind=conn)
+
+
+# (version, name, migrate) in the order they are applied; never renumber or edit an applied migration
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "create tables", _create_tables),
+    (2, "orders.created_at and composite indexes for order and product listings", _add_order_created_at_and_composite_indexes),
+    (3, "products.stock and orders.reservation_id", _add_stock_columns),
+    (4, "orders.batch_id", _add_order_batch_id),
+]
+
+
+@contextmanager
+def _migration_lock(conn: Connection):
+    if conn.dialect.name != "mysql":
+        yield
+        return
+    if not conn.execute(text("SELECT GET_LOCK(:name, :timeout)"), {"name": MIGRATION_LOCK_NAME, "timeout": MIGRATION_LOCK_TIMEOUT_S}).scalar():
+        raise RuntimeError("Timed out waiting for another process to finish migrating the schema")
+    conn.commit()
+    try:
+        yield
+    finally:
+        conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": MIGRATION_LOCK_NAME})
+        conn.commit()
+
+
+def _applied_versions(conn: Connection) -> set:
+    schema_migrations.create(bind=conn, checkfirst=True)
+    versions = set(conn.execute(select(schema_migrations.c.version)).scalars())
+    conn.commit()
+    return versions
+
+
+def pending_migrations(engine: Engine) -> List[Tuple[int, str]]:
+    """Migrations not yet applied to the database, as (version, name)."""
+    with engine.connect() as conn:
+        applied = _applied_versions(conn)
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in applied]
+
+
+def run_migrations(engine: Engine) -> List[int]:
+    """Applies pending migrations in order, each in its own transaction. Returns the versions applied."""
+    applied_now = []
+    with engine.connect() as conn, _migration_lock(conn):
+        applied = _applied_versions(conn) # Read under the lock: another worker may have just migrated
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            with conn.begin():
+                migrate(conn)
+                conn.execute(insert(schema_migrations).values(version=version, name=name, applied_at=utcnow()))
+            print(f"Applied migration {version}: {name}")
+            applied_now.append(version)
+    return applied_now
+
+
+def main(argv: List[str]):
+    if not argv or argv[0] not in ("upgrade", "status"):
+        print("Usage: python -m api.migrations upgrade|status")
+        return 2
+    from api.main import engine
+    if argv[0] == "upgrade":
+        print(f"{len(run_migrations(engine))} migrations applied.")
+        return 0
+    pending = pending_migrations(engine)
+    for version, name in pending:
+        print(f"Pending migration {version}: {name}")
+    print(f"{len(pending)} pending migrations.")
+    return 1 if pending else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
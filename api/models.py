@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Index
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
 
+def utcnow() -> datetime:
+    """Naive UTC timestamp, the form DateTime columns are stored in."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Tenant(Base):
     __tablename__ = "tenants"
     id = Column(Integer, primary_key=True, index=True)
@@ -29,8 +34,12 @@ class Product(Base):
     name = Column(String(255))
     price = Column(Float)
     farmer_id = Column(Integer, ForeignKey("farmers.id"))
+    stock = Column(Integer, nullable=True) # On-hand units, written behind from Redis (api/services/stock.py); NULL = not tracked
     tenant = relationship("Tenant", back_populates="products") # Many-to-one with Tenant
     farmer = relationship("Farmer", back_populates="products") # Many-to-one with Farmer
+    __table_args__ = (
+        Index("ix_products_tenant_farmer", "tenant_id", "farmer_id"), # "Products of farmer X in tenant Y"
+    )
 
 class Order(Base):
     __tablename__ = "orders"
@@ -41,5 +50,40 @@ class Order(Base):
     total_price = Column(Float)
     buyer_id = Column(Integer) # Mock buyer ID
     status = Column(String(50))
+    created_at = Column(DateTime, default=utcnow) # UTC
+    reservation_id = Column(String(32), nullable=True) # Stock held for the order until payment confirms it
+    batch_id = Column(String(32), nullable=True, index=True) # Bulk insert that created the order, where ids cannot be returned
     tenant = relationship("Tenant", back_populates="orders") # Many-to-one with Tenant
     product = relationship("Product") # Many-to-one with Product
+    __table_args__ = (
+        Index("ix_orders_tenant_status_created", "tenant_id", "status", "created_at"), # "Pending orders of a tenant, newest first"
+    )
+
+class FarmerEsgStats(Base):
+    __tablename__ = "farmer_esg_stats"
+    farmer_id = Column(Integer, ForeignKey("farmers.id"), primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), index=True)  # Multi-tenant support
+    total_quantity = Column(BigInteger, nullable=False, default=0) # Sum of order quantities for the farmer's products
+    unique_products = Column(Integer, nullable=False, default=0) # Distinct products with at least one order
+
+class FarmerProductSales(Base):
+    __tablename__ = "farmer_product_sales"
+    farmer_id = Column(Integer, ForeignKey("farmers.id"), primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), index=True)  # Multi-tenant support
+    quantity = Column(BigInteger, nullable=False, default=0)
+    order_count = Column(Integer, nullable=False, default=0)
+
+class IoTReading(Base):
+    __tablename__ = "iot_readings"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    tenant_id = Column(Integer, nullable=False)  # Multi-tenant support (from the JWT, not a FK)
+    device_id = Column(String(64), nullable=False)
+    timestamp_ms = Column(BigInteger, nullable=False) # UTC epoch milliseconds
+    temperature = Column(Float, nullable=True)
+    humidity = Column(Float, nullable=True)
+    soil_moisture = Column(Float, nullable=True)
+    light_intensity = Column(Float, nullable=True)
+    __table_args__ = (
+        Index("ix_iot_readings_tenant_device_ts", "tenant_id", "device_id", "timestamp_ms"),
+    )
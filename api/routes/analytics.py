@@ -0,0 +1,59 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from typing import Any, Dict
+from api.main import get_db, get_current_user, analytics_pool, esg_report_cache
+from api.models import Farmer
+from api.schemas import ESGReportResponse
+from api.services.esg_calculator import build_esg_report, calculate_esg_scores_offloaded, load_orders_frame, write_esg_scores
+from api.services.process_pool import ProcessPoolBusy, ProcessPoolTimeout
+import asyncio
+import time
+
+router = APIRouter()
+
+def _load_tenant_orders(db: Session, tenant_id: int):
+    farmer_ids = [farmer_id for (farmer_id,) in db.query(Farmer.id).filter(Farmer.tenant_id == tenant_id).all()]
+    return farmer_ids, load_orders_frame(db, tenant_id)
+
+@router.post("/analytics/esg/recalculate", response_model=Dict[str, Any])
+async def recalculate_tenant_esg_scores(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    """
+    Recomputes every farmer's ESG score for the current tenant.
+    Database I/O runs in the thread pool and the scoring itself in the analytics process pool,
+    so neither the event loop nor other sync endpoints wait on it.
+    """
+    tenant_id = current_user.get("tenant_id")
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
+
+    started = time.perf_counter()
+    farmer_ids, orders = await asyncio.to_thread(_load_tenant_orders, db, tenant_id)
+    try:
+        scores = await calculate_esg_scores_offloaded(analytics_pool, orders, farmer_ids)
+    except ProcessPoolBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "5"})
+    except ProcessPoolTimeout as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
+    updated = await asyncio.to_thread(write_esg_scores, db, scores[scores["farmer_id"].isin(farmer_ids)])
+    return {"tenant_id": tenant_id, "farmers_updated": updated, "elapsed_ms": (time.perf_counter() - started) * 1000}
+
+@router.get("/analytics/esg/farmers/{farmer_id}/report", response_model=ESGReportResponse)
+async def get_farmer_esg_report(farmer_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    """
+    Returns the ESG report of one of the current tenant's farmers through the Redis report cache.
+    Reads the primary, so a report recomputed right after an order's invalidation includes that order.
+    """
+    tenant_id = current_user.get("tenant_id")
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
+
+    # The cache blocks (database work, or polling while another worker recomputes), so it runs in the thread pool
+    report = await asyncio.to_thread(esg_report_cache.get_or_compute, tenant_id, farmer_id, lambda: build_esg_report(db, tenant_id, farmer_id))
+    if report is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Farmer not found or not accessible by this tenant.")
+    return report
+
+@router.get("/analytics/pool/stats", response_model=Dict[str, Any])
+def get_analytics_pool_stats(current_user: dict = Depends(get_current_user)):
+    """Returns queue depth, task counts and task durations of the analytics process pool."""
+    return analytics_pool.stats()
@@ -1,48 +1,116 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
 from sqlalchemy.orm import Session
-from typing import List
-from api.main import get_db, get_current_user
+from typing import List, Optional
+from api.main import get_db, get_current_user, idempotency_store, stock_reservations
+from api.models import Order
+from api.services.idempotency import IDEMPOTENCY_KEY_HEADER, REPLAYED_HEADER, IdempotencyError
+from api.services.stock import StockError
 from api.schemas import PaymentRequest, PaymentResponse
 import uuid
 import os
 
 router = APIRouter()
 
-@router.post("/payments", response_model=PaymentResponse, status_code=status.HTTP_200_OK)
-def process_payment(payment_request: PaymentRequest, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """
-    Mocks a payment processing endpoint.
-    In a real application, this would integrate with Stripe/NewebPay.
-    """
-    tenant_id = current_user.get("tenant_id", 1)
-    
+PAYMENT_METHODS = ("stripe", "newebpay")
+
+def _call_gateway(payment_request: PaymentRequest) -> str:
+    """Charges the payment through its gateway; returns the transaction status."""
     # Simulate payment gateway integration
     if payment_request.payment_method == "stripe":
         api_key = os.getenv("STRIPE_API_KEY")
         if not api_key or "mock" in api_key:
             print("Stripe API key not set or is mock key. Simulating success.")
         # Call Stripe API here
-        transaction_status = "completed"
-    elif payment_request.payment_method == "newebpay":
+    else:
         api_key = os.getenv("NEWEPAY_API_KEY")
         if not api_key or "mock" in api_key:
             print("NewebPay API key not set or is mock key. Simulating success.")
         # Call NewebPay API here
-        transaction_status = "completed"
-    else:
+    return "completed"
+
+@router.post("/payments", response_model=PaymentResponse, status_code=status.HTTP_200_OK)
+def process_payment(payment_request: PaymentRequest, response: Response, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user),
+                    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER)):
+    """
+    Mocks a payment processing endpoint.
+    In a real application, this would integrate with Stripe/NewebPay.
+    With an Idempotency-Key header, a retry of the same request returns the first response
+    (marked Idempotent-Replayed) instead of calling the gateway again.
+    Only a 'pending' order can be paid: it is claimed ('paying') before the gateway is called, so a
+    second payment of the same order is refused with 409. After the charge the order becomes
+    'confirmed', selling the units held by its stock reservation. If the hold has already expired the
+    payment is refused with 409 before the gateway is called; if the gateway fails the held units are
+    released and the order is 'pending' again. A charge whose units can no longer be confirmed is
+    answered (and recorded on the order) as 'refund_pending'.
+    """
+    tenant_id = current_user.get("tenant_id", 1)
+    if payment_request.payment_method not in PAYMENT_METHODS:
         raise HTTPException(status_code=400, detail="Unsupported payment method")
 
-    # In a real app, record transaction in DB
-    transaction_id = str(uuid.uuid4())
-    print(f"Tenant {tenant_id}: Processed payment for order {payment_request.order_id} - {payment_request.amount} {payment_request.currency}")
-    
-    return PaymentResponse(
-        transaction_id=transaction_id,
-        status=transaction_status,
-        amount=payment_request.amount,
-        currency=payment_request.currency,
-        order_id=payment_request.order_id
-    )
+    def charge():
+        # Claim the order first: of concurrent or repeated payments (whatever their Idempotency-Key) only one gets past here
+        claimed = (db.query(Order)
+                   .filter(Order.id == payment_request.order_id, Order.tenant_id == tenant_id, Order.status == "pending")
+                   .update({"status": "paying"}, synchronize_session=False))
+        db.commit()
+        if not claimed:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Order not found or not awaiting payment")
+        order = db.query(Order).filter(Order.id == payment_request.order_id).one()
+
+        def unclaim():
+            order.status = "pending"
+            db.commit()
+
+        # Check the units are still held before charging for them, and keep them held for the gateway call
+        if order.reservation_id:
+            try:
+                stock_reservations.renew(tenant_id, order.product_id, order.reservation_id)
+            except StockError as e:
+                unclaim()
+                raise HTTPException(status_code=e.status_code, detail=str(e))
+
+        try:
+            transaction_status = _call_gateway(payment_request)
+        except Exception:
+            if order.reservation_id:
+                stock_reservations.release(tenant_id, order.product_id, order.reservation_id)
+            unclaim()
+            raise
+
+        # The customer has been charged: from here on the outcome is recorded, never raised
+        order.status = "confirmed"
+        if order.reservation_id:
+            try:
+                stock_reservations.confirm(tenant_id, order.product_id, order.reservation_id)
+            except StockError as e:
+                print(f"Tenant {tenant_id}: Order {order.id} was charged but its stock could not be confirmed, refund needed: {e}")
+                order.status = transaction_status = "refund_pending"
+        try:
+            db.commit()
+        except Exception as e:
+            # The order stays 'paying', so it cannot be charged again before someone looks at it
+            db.rollback()
+            print(f"Tenant {tenant_id}: Order {order.id} was charged but its status '{order.status}' could not be saved: {e}")
+
+        # In a real app, record transaction in DB
+        transaction_id = str(uuid.uuid4())
+        print(f"Tenant {tenant_id}: Processed payment for order {payment_request.order_id} - {payment_request.amount} {payment_request.currency}")
+
+        return PaymentResponse(
+            transaction_id=transaction_id,
+            status=transaction_status,
+            amount=payment_request.amount,
+            currency=payment_request.currency,
+            order_id=payment_request.order_id
+        ).model_dump()
+
+    try:
+        body, replayed = idempotency_store.run(tenant_id, "POST /payments", idempotency_key, payment_request.model_dump(), charge)
+    except IdempotencyError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    if replayed:
+        response.headers[REPLAYED_HEADER] = "true"
+    return body
 
 @router.get("/ledger/transactions", response_model=List[PaymentResponse])
 def get_transactions(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user), limit: int = 10, offset: int = 0):
@@ -1,20 +1,78 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from api.schemas import IoTData, IoTDataResponse
-from typing import List, Dict
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from api.main import get_current_user, settings, engine
+from api.schemas import IoTData, IoTDataResponse, IoTBulkIngestResponse, IoTAlertRule, IoTAlertRuleCreate, IoTDeviceStats
+from api.services.iot_store import IOT_CHANNELS, IoTTimeSeriesStore, from_epoch_ms, reading_columns, to_epoch_ms, to_iot_data
+from api.services.iot_persistence import IoTQueueFull, IoTWriteBehindQueue
+from api.services.iot_segments import IoTSegmentStore, read_history, read_latest
+from api.services.iot_live import IoTLiveHub
+from api.services.iot_rules import IoTRuleEngine
+from api.services.iot_stats import IoTDeviceStatsStore
+from notification.line_bot_service import send_line_notification
+from api.services import iot_ingest, iot_aggregation
+from typing import Any, Dict, List, Optional
+import asyncio
 import datetime
+import numpy as np
 from datetime import timedelta
 
 router = APIRouter()
 
-# In-memory store for mock IoT data (keyed by tenant_id, then device_id)
-# This will store a history of IoT data for charting
-mock_iot_data_store: Dict[int, Dict[str, List[IoTData]]] = {}
+# In-memory columnar store for IoT data (keyed by tenant_id, then device_id)
+# Each device keeps a bounded ring buffer of readings for charting
+mock_iot_data_store = IoTTimeSeriesStore(capacity=settings.iot_series_capacity)
+
+# On-disk segment files holding long-term (cold) history, if configured
+iot_segments = IoTSegmentStore(
+    settings.iot_segment_dir,
+    segment_max_records=settings.iot_segment_max_records,
+    retention_days=settings.iot_segment_retention_days,
+) if settings.iot_segment_dir else None
+
+# Write-behind pipeline persisting readings to the iot_readings table and segments (started in api/main.py)
+iot_writer = IoTWriteBehindQueue(
+    engine if settings.iot_persist_to_db else None,
+    max_pending_rows=settings.iot_persist_max_pending_rows,
+    batch_size=settings.iot_persist_batch_size,
+    flush_interval_ms=settings.iot_persist_flush_interval_ms,
+    segments=iot_segments,
+    max_retries=settings.iot_persist_max_retries,
+    retry_backoff_ms=settings.iot_persist_retry_backoff_ms,
+)
+
+# Fan-out of newly ingested readings to WebSocket/SSE subscribers
+iot_live_hub = IoTLiveHub(max_queue=settings.iot_live_max_queue)
+
+# Incremental alert rules evaluated on every ingested reading
+iot_rule_engine = IoTRuleEngine()
+
+# Running hourly/daily min, max, mean and stddev per device and channel
+iot_device_stats = IoTDeviceStatsStore(utc_offset_minutes=settings.iot_stats_utc_offset_minutes)
+
+def _dispatch_alerts(alerts: List[Dict[str, Any]]):
+    """Sends fired alerts to LINE from the default thread pool so ingest never waits on the LINE API."""
+    loop = asyncio.get_running_loop()
+    for alert in alerts:
+        message = (f"[AgriBridge] {alert['rule_name']}: {alert['device_id']} {alert['channel']}={alert['value']:.2f} "
+                   f"({from_epoch_ms(alert['timestamp_ms']).isoformat()})")
+        print(f"IoT alert fired: {message}")
+        loop.run_in_executor(None, send_line_notification, alert["line_user_id"] or settings.line_user_id, message)
+
+def _after_ingest(tenant_id: int, device_id: str, timestamps: np.ndarray, values: np.ndarray):
+    """Fans stored readings out to the running stats, live subscribers and the alert rule engine."""
+    iot_device_stats.update(tenant_id, device_id, timestamps, values)
+    iot_live_hub.publish(tenant_id, device_id, timestamps, values)
+    alerts = iot_rule_engine.evaluate(tenant_id, device_id, timestamps, values)
+    if alerts:
+        _dispatch_alerts(alerts)
+
+def _queue_full(e: IoTQueueFull) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers={"Retry-After": "1"})
 
 # Generate some historical mock data for charting
 def _generate_mock_iot_data(tenant_id: int, device_id: str, num_points: int = 20):
-    if tenant_id not in mock_iot_data_store:
-        mock_iot_data_store[tenant_id] = {}
-    if device_id not in mock_iot_data_store[tenant_id] or not mock_iot_data_store[tenant_id][device_id]:
+    series = mock_iot_data_store.get_series(tenant_id, device_id)
+    if series is not None and len(series) == 0:
         current_time = datetime.datetime.now(datetime.timezone.utc)
         for i in range(num_points):
             timestamp = current_time - timedelta(minutes=(num_points - 1 - i) * 5) # 5-minute intervals
@@ -25,39 +83,208 @@ def _generate_mock_iot_data(tenant_id: int, device_id: str, num_points: int = 20
                 humidity=round(50 + (i * 0.3) + (i % 2), 2),    # Simulate fluctuating humidity
                 soil_moisture=round(30 + (i * 0.2) + (i % 4), 2) # Simulate fluctuating soil moisture
             )
-            mock_iot_data_store[tenant_id][device_id].append(data_point)
+            mock_iot_data_store.append(tenant_id, data_point)
 
 @router.post("/iot/data", response_model=IoTDataResponse, status_code=status.HTTP_201_CREATED)
-def receive_iot_data(data: IoTData, current_user: dict = Depends(get_current_user)):
+async def receive_iot_data(data: IoTData, current_user: dict = Depends(get_current_user)):
     """
     Receives mock IoT sensor data for the current tenant.
-    In a real application, this would store data in a time-series DB.
+    Readings are kept in a bounded per-device columnar buffer and queued for write-behind persistence.
     """
     tenant_id = current_user.get("tenant_id", 1)
 
-    if tenant_id not in mock_iot_data_store:
-        mock_iot_data_store[tenant_id] = {}
-    if data.device_id not in mock_iot_data_store[tenant_id]:
-        mock_iot_data_store[tenant_id][data.device_id] = []
-    
     # Ensure timestamp is set if not provided by device
     if not data.timestamp:
         data.timestamp = datetime.datetime.now(datetime.timezone.utc)
-        
-    mock_iot_data_store[tenant_id][data.device_id].append(data)
+
+    columns = reading_columns(data)
+    try:
+        iot_writer.offer(tenant_id, {data.device_id: columns})
+    except IoTQueueFull as e:
+        raise _queue_full(e)
+    mock_iot_data_store.append(tenant_id, data)
+    _after_ingest(tenant_id, data.device_id, *columns)
     print(f"Tenant {tenant_id}: Received IoT data for device {data.device_id}: {data.dict()}")
     return IoTDataResponse(message="IoT data received successfully", data=data)
 
+@router.post("/iot/data/bulk", response_model=IoTBulkIngestResponse, status_code=status.HTTP_200_OK)
+async def receive_iot_data_bulk(request: Request, current_user: dict = Depends(get_current_user)):
+    """
+    Receives a batch of IoT readings streamed as NDJSON (default) or msgpack.
+    The batch is authenticated once, validated as a whole and appended to the store in one pass;
+    rows that fail validation are reported individually instead of failing the upload.
+    """
+    tenant_id = current_user.get("tenant_id", 1)
+    content_type = request.headers.get("content-type", iot_ingest.NDJSON_CONTENT_TYPES[0]).split(";")[0].strip().lower()
+
+    try:
+        if content_type in iot_ingest.MSGPACK_CONTENT_TYPES:
+            if iot_ingest.msgpack is None:
+                raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="msgpack codec is not available on this server")
+            rows = await iot_ingest.decode_msgpack(request.stream(), settings.iot_bulk_max_rows)
+        elif content_type in iot_ingest.NDJSON_CONTENT_TYPES:
+            rows = await iot_ingest.decode_ndjson(request.stream(), settings.iot_bulk_max_rows)
+        else:
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=f"Unsupported content type: {content_type}")
+    except iot_ingest.IoTBatchTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except ValueError as e: # Corrupt msgpack framing cannot be attributed to a single row
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Malformed payload: {e}")
+
+    try:
+        result = iot_ingest.ingest_rows(mock_iot_data_store, tenant_id, rows, writer=iot_writer, on_ingest=_after_ingest)
+    except IoTQueueFull as e:
+        raise _queue_full(e)
+    print(f"Tenant {tenant_id}: Bulk IoT upload accepted {result['accepted']} rows, rejected {result['rejected']}")
+    return result
+
+@router.get("/iot/persistence/stats", response_model=Dict[str, Any])
+def get_iot_persistence_stats(current_user: dict = Depends(get_current_user)):
+    """Reports write-behind queue depth and flush latency for the IoT persistence pipeline."""
+    return iot_writer.stats()
+
+@router.get("/iot/persistence/dead-letters", response_model=List[Dict[str, Any]])
+def get_iot_dead_letters(current_user: dict = Depends(get_current_user)):
+    """Readings of the current tenant that the write-behind pipeline could not persist, with the error."""
+    tenant_id = current_user.get("tenant_id", 1)
+    return [row for row in iot_writer.dead_letters() if row["tenant_id"] == tenant_id]
+
+@router.get("/iot/devices", response_model=List[IoTDeviceStats])
+def get_iot_devices(current_user: dict = Depends(get_current_user)):
+    """Returns the running stats of every device of the current tenant."""
+    return iot_device_stats.summaries(current_user.get("tenant_id", 1))
+
+@router.get("/iot/devices/{device_id}/stats", response_model=IoTDeviceStats)
+def get_iot_device_stats(device_id: str, current_user: dict = Depends(get_current_user)):
+    """Returns a device's min, max, mean and stddev per channel for the current hour and day, and its last-seen time."""
+    summary = iot_device_stats.summary(current_user.get("tenant_id", 1), device_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return summary
+
+@router.post("/iot/rules", response_model=IoTAlertRule, status_code=status.HTTP_201_CREATED)
+def create_iot_alert_rule(rule: IoTAlertRuleCreate, current_user: dict = Depends(get_current_user)):
+    """Creates an alert rule for the current tenant; firing rules notify via LINE."""
+    tenant_id = current_user.get("tenant_id", 1)
+    try:
+        return iot_rule_engine.add_rule(tenant_id, rule.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+@router.get("/iot/rules", response_model=List[IoTAlertRule])
+def get_iot_alert_rules(current_user: dict = Depends(get_current_user)):
+    """Lists the current tenant's alert rules."""
+    return iot_rule_engine.list_rules(current_user.get("tenant_id", 1))
+
+@router.delete("/iot/rules/{rule_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_iot_alert_rule(rule_id: int, current_user: dict = Depends(get_current_user)):
+    """Deletes one of the current tenant's alert rules."""
+    if not iot_rule_engine.remove_rule(current_user.get("tenant_id", 1), rule_id):
+        raise HTTPException(status_code=404, detail="Alert rule not found")
+
+@router.websocket("/iot/live/{device_id}")
+async def iot_live_websocket(websocket: WebSocket, device_id: str, token: str = Query(...)):
+    """
+    Pushes readings for a device to the client as they are ingested.
+    Browsers cannot set headers on WebSocket upgrades, so the JWT is passed as the 'token' query parameter.
+    """
+    try:
+        current_user = get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=1008) # Policy violation: invalid credentials
+        return
+    tenant_id = current_user.get("tenant_id", 1)
+    await websocket.accept()
+    subscriber = iot_live_hub.subscribe(tenant_id, device_id)
+
+    async def send_frames():
+        while True:
+            frame, published_at = await subscriber.next_frame()
+            await websocket.send_text(frame)
+            iot_live_hub.record_delivery(published_at)
+
+    sender = asyncio.create_task(send_frames())
+    try:
+        # Clients only listen; reading here notices disconnects even while no frames are flowing
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        iot_live_hub.unsubscribe(tenant_id, device_id, subscriber)
+
+@router.get("/iot/live/{device_id}/events")
+async def iot_live_events(device_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    """Server-Sent Events variant of the live feed for clients that cannot use WebSockets."""
+    tenant_id = current_user.get("tenant_id", 1)
+    subscriber = iot_live_hub.subscribe(tenant_id, device_id)
+
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                frame, published_at = await subscriber.next_frame()
+                yield f"data: {frame}\n\n"
+                iot_live_hub.record_delivery(published_at)
+        finally:
+            iot_live_hub.unsubscribe(tenant_id, device_id, subscriber)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@router.get("/iot/live/stats", response_model=Dict[str, Any])
+def get_iot_live_stats(current_user: dict = Depends(get_current_user)):
+    """Reports live connection counts and broadcast latency for the current tenant's devices."""
+    return iot_live_hub.stats(current_user.get("tenant_id", 1))
+
 @router.get("/iot/data/{device_id}", response_model=List[IoTData], status_code=status.HTTP_200_OK)
-def get_iot_data(device_id: str, current_user: dict = Depends(get_current_user), limit: int = 20):
-    """Retrieves mock IoT sensor data for a specific device and current tenant."""
+def get_iot_data(
+    device_id: str,
+    current_user: dict = Depends(get_current_user),
+    limit: int = 20,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    bucket: Optional[str] = Query(None, description="Bucket width for aggregation, e.g. 1m, 15m, 1h"),
+    agg: str = Query("mean", description="Bucket aggregation: min, max, mean or last"),
+    points: Optional[int] = Query(None, ge=3, description="Downsample to this many points with LTTB"),
+    channel: str = Query("temperature", description="Channel that drives LTTB point selection"),
+):
+    """
+    Retrieves mock IoT sensor data for a specific device and current tenant.
+    Without range or downsampling parameters the latest 'limit' readings are returned.
+    Recent readings come from memory and older ones from on-disk segments when configured.
+    With 'bucket' the readings in [since, until] are aggregated per bucket; with 'points'
+    they are reduced by LTTB to a fixed number of visually faithful readings.
+    """
     tenant_id = current_user.get("tenant_id", 1)
-    
+
     # Generate mock data if not already present for demonstration
     _generate_mock_iot_data(tenant_id, device_id)
 
-    if tenant_id not in mock_iot_data_store or device_id not in mock_iot_data_store[tenant_id]:
+    if since is None and until is None and bucket is None and points is None:
+        # Return the latest 'limit' data points
+        history = read_latest(mock_iot_data_store, iot_segments, tenant_id, device_id, limit)
+    else:
+        history = read_history(
+            mock_iot_data_store,
+            iot_segments,
+            tenant_id,
+            device_id,
+            to_epoch_ms(since) if since else None,
+            to_epoch_ms(until) if until else None,
+        )
+    if history is None:
         raise HTTPException(status_code=404, detail="No IoT data found for this device or tenant")
-    
-    # Return the latest 'limit' data points
-    return mock_iot_data_store[tenant_id][device_id][-limit:]
+
+    timestamps, values = history
+    try:
+        if bucket is not None:
+            timestamps, values = iot_aggregation.bucket_aggregate(timestamps, values, iot_aggregation.parse_bucket(bucket), agg)
+        elif points is not None:
+            if channel not in IOT_CHANNELS:
+                raise ValueError(f"Invalid channel '{channel}'. Use one of: {', '.join(IOT_CHANNELS)}.")
+            timestamps, values = iot_aggregation.lttb_downsample(timestamps, values, IOT_CHANNELS.index(channel), points)
+        else:
+            timestamps, values = timestamps[-limit:], values[:, -limit:]
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return to_iot_data(device_id, timestamps, values)
@@ -1,42 +1,214 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+import uuid
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from api.main import get_db, get_current_user
-from api.models import Order, Product
-from api.schemas import OrderCreate, OrderResponse
+from sqlalchemy import insert, select
+from typing import Any, Dict, List, Optional
+from datetime import datetime, timezone
+from api.main import get_async_db, get_current_user, get_read_db, esg_report_cache, idempotency_store, settings, stock_reservations
+from api.models import Order, Product, utcnow
+from api.services.pagination import NEXT_CURSOR_HEADER, paginate_async
+from api.schemas import OrderBulkCreate, OrderBulkCreateResponse, OrderBulkItemResult, OrderCreate, OrderResponse
+from api.services.esg_stats import record_order, record_orders
+from api.services.idempotency import IDEMPOTENCY_KEY_HEADER, REPLAYED_HEADER, IdempotencyError
+from api.services.stock import StockError
+import numpy as np
 
 router = APIRouter()
 
 @router.post("/orders", response_model=OrderResponse, status_code=status.HTTP_201_CREATED)
-def create_order(order: OrderCreate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Create a new order for the current tenant."""
+async def create_order(order: OrderCreate, response: Response, db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user),
+                       idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER)):
+    """
+    Create a new order for the current tenant.
+    For products with stock, the ordered units are reserved in Redis (409 when sold out) and held
+    until the order is paid; unpaid holds return to sale after STOCK_HOLD_TTL_S.
+    With an Idempotency-Key header, a retry of the same request returns the first response
+    (marked Idempotent-Replayed) instead of creating another order.
+    """
     tenant_id = current_user.get("tenant_id")
     if tenant_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
 
-    product = db.query(Product).filter(Product.id == order.product_id, Product.tenant_id == tenant_id).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found or not owned by your tenant")
-    
-    total_price = product.price * order.quantity
-    db_order = Order(
-        product_id=order.product_id,
-        quantity=order.quantity,
-        total_price=total_price,
-        buyer_id=order.buyer_id,
-        status="pending",
-        tenant_id=tenant_id
-    )
-    db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
-    return db_order
+    async def create():
+        product = (await db.execute(select(Product).where(Product.id == order.product_id, Product.tenant_id == tenant_id))).scalars().first()
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found or not owned by your tenant")
+
+        reservation_id = None
+        if product.stock is not None:
+            try:
+                reservation_id = await asyncio.to_thread(stock_reservations.reserve, tenant_id, product.id, order.quantity, product.stock)
+            except StockError as e:
+                raise HTTPException(status_code=e.status_code, detail=str(e))
+
+        total_price = product.price * order.quantity
+        try:
+            # Refresh the farmer's ESG score in O(1) within the same transaction as the order
+            # (the ESG stats code is synchronous ORM code; run_sync runs it on this session's connection)
+            await db.run_sync(record_order, product, order.quantity)
+            db_order = Order(
+                product_id=order.product_id,
+                quantity=order.quantity,
+                total_price=total_price,
+                buyer_id=order.buyer_id,
+                status="pending",
+                tenant_id=tenant_id,
+                reservation_id=reservation_id
+            )
+            db.add(db_order)
+            await db.commit()
+        except BaseException:
+            if reservation_id is not None:
+                await asyncio.to_thread(stock_reservations.release, tenant_id, product.id, reservation_id)
+            raise
+        await db.refresh(db_order)
+        await asyncio.to_thread(esg_report_cache.invalidate, tenant_id, product.farmer_id)
+        return OrderResponse.model_validate(db_order).model_dump(mode="json")
+
+    try:
+        body, replayed = await idempotency_store.run_async(tenant_id, "POST /orders", idempotency_key, order.model_dump(), create)
+    except IdempotencyError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    if replayed:
+        response.headers[REPLAYED_HEADER] = "true"
+    return body
+
+def _insert_orders(db: Session, rows: List[Dict[str, Any]]) -> List[int]:
+    """Inserts order rows in one round trip and returns their ids in row order."""
+    dialect = db.get_bind().dialect
+    if dialect.insert_returning and dialect.use_insertmanyvalues:
+        # Backends with RETURNING (SQLite, MariaDB, PostgreSQL) batch the rows and return ids in parameter order
+        result = db.execute(insert(Order).returning(Order.id, sort_by_parameter_order=True), rows)
+        return list(result.scalars())
+    # MySQL: one INSERT ... VALUES (...), (...) tagged with a batch id, then the ids are read back by it.
+    # They are not assumed consecutive from LAST_INSERT_ID(): auto_increment_increment, interleaved lock
+    # mode and Galera clusters all leave gaps. One statement assigns its rows increasing ids in row order.
+    batch_id = uuid.uuid4().hex
+    db.execute(insert(Order).values([{**row, "batch_id": batch_id} for row in rows]))
+    return list(db.execute(select(Order.id).where(Order.batch_id == batch_id).order_by(Order.id)).scalars())
+
+@router.post("/orders/bulk", response_model=OrderBulkCreateResponse, status_code=status.HTTP_200_OK)
+async def create_orders_bulk(payload: OrderBulkCreate, db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
+    """
+    Create many orders for the current tenant in one transaction: a single product lookup,
+    a single multi-row INSERT and a single commit. Items whose product is not found, or whose
+    stock cannot be reserved, are reported as failed; the others are created.
+    """
+    tenant_id = current_user.get("tenant_id")
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
+    items = payload.orders
+    if len(items) > settings.orders_bulk_max_items:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {settings.orders_bulk_max_items} orders per request")
+
+    product_ids = {item.product_id for item in items}
+    products = {
+        product.id: product
+        for product in (await db.execute(select(Product).where(Product.tenant_id == tenant_id, Product.id.in_(product_ids)))).scalars()
+    } if product_ids else {}
+
+    results: List[Optional[OrderBulkItemResult]] = [None] * len(items)
+    found = []
+    for index, item in enumerate(items):
+        if item.product_id in products:
+            found.append(index)
+        else:
+            results[index] = OrderBulkItemResult(index=index, status="failed", detail="Product not found or not owned by your tenant")
+
+    def reserve_stock() -> Dict[int, str]:
+        held = {}
+        for index in found:
+            product = products[items[index].product_id]
+            if product.stock is None:
+                continue
+            try:
+                held[index] = stock_reservations.reserve(tenant_id, product.id, items[index].quantity, product.stock)
+            except StockError as e:
+                results[index] = OrderBulkItemResult(index=index, status="failed", detail=str(e))
+        return held
+
+    def release_stock():
+        for index, reservation_id in reservations.items():
+            stock_reservations.release(tenant_id, items[index].product_id, reservation_id)
+
+    reservations: Dict[int, str] = {}
+    if any(products[items[index].product_id].stock is not None for index in found):
+        reservations = await asyncio.to_thread(reserve_stock)
+    accepted = [index for index in found if results[index] is None]
+
+    if accepted:
+        quantities = np.array([items[index].quantity for index in accepted], dtype=np.int64)
+        prices = np.array([products[items[index].product_id].price for index in accepted], dtype=np.float64)
+        total_prices = (prices * quantities).tolist()
+        created_at = utcnow()
+        rows = [
+            {
+                "product_id": items[index].product_id,
+                "quantity": items[index].quantity,
+                "total_price": total_price,
+                "buyer_id": items[index].buyer_id,
+                "status": "pending",
+                "tenant_id": tenant_id,
+                "created_at": created_at,
+                "reservation_id": reservations.get(index),
+            }
+            for index, total_price in zip(accepted, total_prices)
+        ]
+        try:
+            # Refresh the affected farmers' ESG scores within the same transaction as the orders
+            await db.run_sync(record_orders, [(products[items[index].product_id], items[index].quantity) for index in accepted])
+            order_ids = await db.run_sync(_insert_orders, rows)
+            await db.commit()
+        except BaseException:
+            await asyncio.to_thread(release_stock)
+            raise
+        for farmer_id in {products[items[index].product_id].farmer_id for index in accepted}:
+            await asyncio.to_thread(esg_report_cache.invalidate, tenant_id, farmer_id)
+        for index, order_id, row in zip(accepted, order_ids, rows):
+            results[index] = OrderBulkItemResult(index=index, status="created", order=OrderResponse(id=order_id, **row))
+
+    return OrderBulkCreateResponse(created=len(accepted), failed=len(items) - len(accepted), results=results)
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Query datetimes may carry an offset; created_at is stored as naive UTC."""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
 
 @router.get("/orders", response_model=List[OrderResponse])
-def get_orders(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user), limit: int = 10, offset: int = 0):
-    """Retrieve a list of orders with pagination, respecting tenant isolation."""
+async def get_orders(response: Response, db: AsyncSession = Depends(get_read_db), current_user: dict = Depends(get_current_user), limit: int = 10,
+                     offset: int = 0, cursor: Optional[str] = None, order_status: Optional[str] = Query(None, alias="status"),
+                     farmer_id: Optional[int] = None, created_from: Optional[datetime] = None, created_to: Optional[datetime] = None,
+                     newest_first: bool = False):
+    """
+    Retrieve a list of orders with offset or cursor pagination (next cursor in X-Next-Cursor), respecting tenant isolation.
+    Optional filters: status, farmer_id and a created_at range [created_from, created_to).
+    newest_first lists by created_at descending, served by the (tenant_id, status, created_at) index.
+    """
     tenant_id = current_user.get("tenant_id")
     if tenant_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
-        
-    return db.query(Order).filter(Order.tenant_id == tenant_id).offset(offset).limit(limit).all()
+
+    statement = select(Order).where(Order.tenant_id == tenant_id)
+    if order_status is not None:
+        statement = statement.where(Order.status == order_status)
+    if created_from is not None:
+        statement = statement.where(Order.created_at >= _as_utc(created_from))
+    if created_to is not None:
+        statement = statement.where(Order.created_at < _as_utc(created_to))
+    if farmer_id is not None:
+        statement = statement.join(Product, Order.product_id == Product.id).where(Product.tenant_id == tenant_id, Product.farmer_id == farmer_id)
+    try:
+        if newest_first:
+            rows, next_cursor = await paginate_async(db, statement, Order.id, tenant_id, limit, offset, cursor,
+                                                     sort_column=Order.created_at, descending=True)
+        else:
+            rows, next_cursor = await paginate_async(db, statement, Order.id, tenant_id, limit, offset, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return rows
@@ -1,42 +1,121 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+import asyncio
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
-from api.main import get_db, get_current_user
+from api.main import AsyncSessionLocal, get_async_db, get_current_user, get_read_db, product_search_index, stock_reservations
 from api.models import Product
-from api.schemas import ProductCreate, ProductResponse
+from api.services.pagination import NEXT_CURSOR_HEADER, paginate_async
+from api.schemas import ProductCreate, ProductResponse, ProductSearchHit, ProductStockLevels, ProductStockUpdate
+from api.services.stock import StockError
 
 router = APIRouter()
 
 @router.post("/products", response_model=ProductResponse, status_code=status.HTTP_201_CREATED)
-def create_product(product: ProductCreate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+async def create_product(product: ProductCreate, db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
     """Create a new product for the current tenant."""
     tenant_id = current_user.get("tenant_id")
     if tenant_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
-    
+
     db_product = Product(**product.dict(), tenant_id=tenant_id)
     db.add(db_product)
-    db.commit()
-    db.refresh(db_product)
+    await db.commit()
+    await db.refresh(db_product)
+    product_search_index.add(tenant_id, db_product.id, db_product.name)
     return db_product
 
 @router.get("/products", response_model=List[ProductResponse])
-def get_products(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user), limit: int = 10, offset: int = 0):
-    """Retrieve a list of products with pagination, respecting tenant isolation."""
+async def get_products(response: Response, db: AsyncSession = Depends(get_read_db), current_user: dict = Depends(get_current_user), limit: int = 10,
+                       offset: int = 0, cursor: Optional[str] = None, farmer_id: Optional[int] = None):
+    """
+    Retrieve a list of products with offset or cursor pagination (next cursor in X-Next-Cursor), respecting tenant isolation.
+    Optional farmer_id filter, served by the (tenant_id, farmer_id) index.
+    """
     tenant_id = current_user.get("tenant_id")
     if tenant_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
-    
-    return db.query(Product).filter(Product.tenant_id == tenant_id).offset(offset).limit(limit).all()
 
-@router.get("/products/{product_id}", response_model=ProductResponse)
-def get_product(product_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Retrieve a specific product by ID, respecting tenant isolation."""
+    statement = select(Product).where(Product.tenant_id == tenant_id)
+    if farmer_id is not None:
+        statement = statement.where(Product.farmer_id == farmer_id)
+    try:
+        rows, next_cursor = await paginate_async(db, statement, Product.id, tenant_id, limit, offset, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return rows
+
+async def _product_names(db: AsyncSession, tenant_id: int):
+    return (await db.execute(select(Product.id, Product.name).where(Product.tenant_id == tenant_id))).all()
+
+async def _refresh_search_index(tenant_id: int):
+    # Runs after the response, so it opens its own session
+    async with AsyncSessionLocal() as db:
+        await product_search_index.refresh(tenant_id, lambda: _product_names(db, tenant_id))
+
+@router.get("/products/search", response_model=List[ProductSearchHit])
+async def search_products(background_tasks: BackgroundTasks, q: str = Query(..., min_length=1, max_length=100),
+                          limit: int = Query(10, ge=1, le=50), prefix_only: bool = False,
+                          db: AsyncSession = Depends(get_read_db), current_user: dict = Depends(get_current_user)):
+    """
+    Search the tenant's product names (CJK-aware, full-width/case-insensitive). Names starting with q rank first,
+    then names containing it, shorter names first; prefix_only=true keeps only the former (typeahead).
+    """
     tenant_id = current_user.get("tenant_id")
     if tenant_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
-    
-    product = db.query(Product).filter(Product.id == product_id, Product.tenant_id == tenant_id).first()
+
+    if not product_search_index.is_built(tenant_id):
+        await product_search_index.ensure_built(tenant_id, lambda: _product_names(db, tenant_id))
+    elif product_search_index.needs_refresh(tenant_id):
+        background_tasks.add_task(_refresh_search_index, tenant_id)
+    return product_search_index.search(tenant_id, q, limit, prefix_only)
+
+async def _tenant_product(db: AsyncSession, product_id: int, tenant_id: int) -> Product:
+    product = (await db.execute(select(Product).where(Product.id == product_id, Product.tenant_id == tenant_id))).scalars().first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     return product
+
+@router.get("/products/{product_id}", response_model=ProductResponse)
+async def get_product(product_id: int, db: AsyncSession = Depends(get_read_db), current_user: dict = Depends(get_current_user)):
+    """Retrieve a specific product by ID, respecting tenant isolation."""
+    tenant_id = current_user.get("tenant_id")
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
+
+    return await _tenant_product(db, product_id, tenant_id)
+
+@router.get("/products/{product_id}/stock", response_model=ProductStockLevels)
+async def get_product_stock(product_id: int, db: AsyncSession = Depends(get_read_db), current_user: dict = Depends(get_current_user)):
+    """Live stock of a product: units available for sale and units held by unpaid orders."""
+    tenant_id = current_user.get("tenant_id")
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
+
+    product = await _tenant_product(db, product_id, tenant_id)
+    if product.stock is None:
+        raise HTTPException(status_code=404, detail="Product has no stock tracking")
+    try:
+        levels = await asyncio.to_thread(stock_reservations.levels, tenant_id, product_id)
+    except StockError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return ProductStockLevels(product_id=product_id, **(levels or {"available": product.stock, "held": 0}))
+
+@router.put("/products/{product_id}/stock", response_model=ProductStockLevels)
+async def set_product_stock(product_id: int, update: ProductStockUpdate, db: AsyncSession = Depends(get_async_db),
+                            current_user: dict = Depends(get_current_user)):
+    """Set the units available for sale (restock); units held by unpaid orders are kept. Enables stock tracking."""
+    tenant_id = current_user.get("tenant_id")
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tenant ID not found in token.")
+
+    product = await _tenant_product(db, product_id, tenant_id)
+    try:
+        product.stock = await asyncio.to_thread(stock_reservations.set_available, tenant_id, product_id, update.available)
+    except StockError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    await db.commit()
+    return ProductStockLevels(product_id=product_id, available=update.available, held=product.stock - update.available)
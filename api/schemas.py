@@ -35,6 +35,7 @@ class ProductCreate(BaseModel):
     name: str = Field(..., example="有機蘋果")
     price: float = Field(..., example=50.0)
     farmer_id: int = Field(..., example=1)
+    stock: Optional[int] = Field(None, ge=0, example=100) # Omit for products sold without stock tracking
 
 class ProductResponse(BaseModel):
     id: int
@@ -42,13 +43,27 @@ class ProductResponse(BaseModel):
     price: float
     farmer_id: int
     tenant_id: int # Include tenant_id in response
+    stock: Optional[int] = None # On-hand units as last reconciled from Redis
 
     class Config:
         from_attributes = True
 
+class ProductStockUpdate(BaseModel):
+    available: int = Field(..., ge=0, example=500) # Units for sale, not counting units held by open reservations
+
+class ProductStockLevels(BaseModel):
+    product_id: int
+    available: int
+    held: int
+
+class ProductSearchHit(BaseModel):
+    product_id: int
+    name: str
+    match: str # "prefix" (name starts with the query) or "contains"
+
 class OrderCreate(BaseModel):
     product_id: int = Field(..., example=101)
-    quantity: int = Field(..., example=10)
+    quantity: int = Field(..., gt=0, example=10)
     buyer_id: int = Field(..., example=101)
 
 class OrderResponse(BaseModel):
@@ -59,10 +74,25 @@ class OrderResponse(BaseModel):
     buyer_id: int
     status: str
     tenant_id: int # Include tenant_id in response
+    created_at: Optional[datetime] = None # UTC
 
     class Config:
         from_attributes = True
 
+class OrderBulkCreate(BaseModel):
+    orders: List[OrderCreate]
+
+class OrderBulkItemResult(BaseModel):
+    index: int # Position of the item in the request
+    status: str # "created" or "failed"
+    order: Optional[OrderResponse] = None
+    detail: Optional[str] = None
+
+class OrderBulkCreateResponse(BaseModel):
+    created: int
+    failed: int
+    results: List[OrderBulkItemResult]
+
 # --- New Schemas for Financial Ledger ---
 class PaymentRequest(BaseModel):
     order_id: int
@@ -79,7 +109,7 @@ class PaymentResponse(BaseModel):
 
 # --- New Schemas for IoT Data ---
 class IoTData(BaseModel):
-    device_id: str
+    device_id: str = Field(..., min_length=1, max_length=64) # iot_readings.device_id is String(64)
     timestamp: datetime # Use datetime object for better handling
     temperature: Optional[float] = None
     humidity: Optional[float] = None
@@ -90,6 +120,47 @@ class IoTDataResponse(BaseModel):
     message: str
     data: IoTData
 
+class IoTBulkRowError(BaseModel):
+    row: int # Zero-based position of the rejected row in the upload
+    detail: str
+
+class IoTBulkIngestResponse(BaseModel):
+    accepted: int
+    rejected: int
+    errors: List[IoTBulkRowError]
+
+class IoTAlertRuleCreate(BaseModel):
+    name: str = Field(..., example="土壤過乾")
+    kind: str = Field(..., example="duration") # threshold, duration or rate
+    channel: str = Field(..., example="soil_moisture")
+    direction: str = Field(..., example="below") # above/below, or rise/fall for rate rules
+    value: float = Field(..., example=25.0) # Threshold, or minimum change for rate rules
+    window_s: int = Field(0, example=600) # Required for duration and rate rules
+    cooldown_s: int = Field(3600, example=3600) # Minimum time between notifications per device
+    device_id: Optional[str] = None # None applies the rule to every device of the tenant
+    line_user_id: Optional[str] = None # Defaults to the configured LINE_USER_ID
+
+class IoTAlertRule(IoTAlertRuleCreate):
+    id: int
+
+class IoTChannelStats(BaseModel):
+    count: int
+    min: Optional[float] = None
+    max: Optional[float] = None
+    mean: Optional[float] = None
+    stddev: Optional[float] = None
+
+class IoTPeriodStats(BaseModel):
+    since: datetime # Start of the current hour or day
+    channels: Dict[str, IoTChannelStats]
+
+class IoTDeviceStats(BaseModel):
+    device_id: str
+    last_seen: datetime
+    total_readings: int
+    hourly: IoTPeriodStats
+    daily: IoTPeriodStats
+
 # --- New Schemas for Blockchain (Mock) ---
 class BlockchainTransaction(BaseModel):
     sender: str
@@ -0,0 +1,98 @@
+import threading
+import time
+from typing import Any, Dict, Type
+from sqlalchemy import event, exc, make_url
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+
+class PoolMonitor:
+    """
+    Connection pool counters for one engine, fed by pool event listeners (checkouts, new connections,
+    invalidated connections, peak checked-out and overflow) and by timing each checkout.
+    Pool events fire only once a connection has been handed out, so the checkout wait is measured
+    by the pool class from pool_class(), which times the pool's own get.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engine = None
+        self._stats = {"checkouts": 0, "connects": 0, "invalidations": 0, "timeouts": 0,
+                       "peak_checked_out": 0, "peak_overflow": 0, "wait_ms_last": 0.0, "wait_ms_max": 0.0, "wait_ms_total": 0.0}
+
+    def pool_class(self, base: Type[Pool]) -> Type[Pool]:
+        """A subclass of 'base' reporting checkout waits and pool timeouts to this monitor (kept across engine.dispose())."""
+        monitor = self
+
+        def _do_get(pool):
+            started = time.perf_counter()
+            try:
+                return base._do_get(pool)
+            except exc.TimeoutError:
+                monitor._record_timeout()
+                raise
+            finally:
+                monitor._record_wait((time.perf_counter() - started) * 1000)
+
+        return type(f"Monitored{base.__name__}", (base,), {"_do_get": _do_get})
+
+    def attach(self, engine: Engine):
+        """Registers the listeners on the engine's pool (pass async_engine.sync_engine for an async engine)."""
+        self._engine = engine
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        event.listen(engine, "soft_invalidate", self._on_invalidate)
+
+    def _record_wait(self, wait_ms: float):
+        with self._lock:
+            self._stats["wait_ms_last"] = wait_ms
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+            self._stats["wait_ms_total"] += wait_ms
+
+    def _record_timeout(self):
+        with self._lock:
+            self._stats["timeouts"] += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pool = self._engine.pool # engine.dispose() swaps in a new pool; always read the current one
+        with self._lock:
+            self._stats["checkouts"] += 1
+            if hasattr(pool, "checkedout"):
+                self._stats["peak_checked_out"] = max(self._stats["peak_checked_out"], pool.checkedout())
+                self._stats["peak_overflow"] = max(self._stats["peak_overflow"], pool.overflow())
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._stats["connects"] += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        # Stale connections (e.g. closed by MySQL after wait_timeout) are invalidated and replaced
+        with self._lock:
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        pool = self._engine.pool if self._engine is not None else None
+        wait_ms_total, checkouts = stats.pop("wait_ms_total"), stats["checkouts"]
+        stats["wait_ms_avg"] = wait_ms_total / checkouts if checkouts else 0.0
+        if pool is not None and hasattr(pool, "checkedout"):
+            stats.update(pool_size=pool.size(), checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0), checked_in=pool.checkedin())
+        return stats
+
+
+def pool_options(url: str, monitor: PoolMonitor, base: Type[Pool], pool_size: int, max_overflow: int, timeout_s: float,
+                 recycle_s: int, pre_ping: bool) -> Dict[str, Any]:
+    """create_engine/create_async_engine keyword arguments for a monitored, sized pool."""
+    if make_url(url).get_backend_name() == "sqlite":
+        # SQLite picks its own pool per database kind (in-memory or file); only pre-ping applies
+        return {"pool_pre_ping": pre_ping}
+    return {
+        "poolclass": monitor.pool_class(base),
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": timeout_s,
+        "pool_recycle": recycle_s,
+        "pool_pre_ping": pre_ping,
+    }
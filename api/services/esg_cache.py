@@ -0,0 +1,152 @@
+import json
+import random
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+from redis.exceptions import RedisError
+
+# Reports stay in Redis this many times their freshness TTL so they can be served while one worker refreshes them
+STALE_GRACE_FACTOR = 2
+
+# Deletes the lock only if it still holds our token, so a slow worker never releases someone else's lock
+_RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class ESGReportCache:
+    """
+    Read-through Redis cache for ESG reports, keyed per (tenant_id, farmer_id) and version.
+    Order writes call invalidate(), which bumps the farmer's version counter so reports
+    computed from older data are never read again (they simply expire).
+    On a miss only the worker holding a short Redis lock recomputes; the others wait for its result.
+    A report past its (jittered) TTL but still on the current version is served while one worker refreshes it.
+    Redis failures fall back to computing the report directly.
+    """
+
+    def __init__(self, redis_client, ttl_s: int = 300, ttl_jitter: float = 0.1, lock_timeout_ms: int = 10000,
+                 wait_timeout_ms: int = 2000, poll_interval_ms: int = 50):
+        self.redis = redis_client
+        self.ttl_s = ttl_s
+        self.ttl_jitter = ttl_jitter
+        self.lock_timeout_ms = lock_timeout_ms
+        self.wait_timeout_ms = wait_timeout_ms
+        self.poll_interval_ms = poll_interval_ms
+        self._release_lock = redis_client.register_script(_RELEASE_LOCK)
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale_hits": 0, "wait_hits": 0, "wait_timeouts": 0, "invalidations": 0, "errors": 0}
+
+    @staticmethod
+    def _key(tenant_id: int, farmer_id: int, suffix: str) -> str:
+        return f"esg:{tenant_id}:{farmer_id}:{suffix}"
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def get_or_compute(self, tenant_id: int, farmer_id: int, compute: Callable[[], Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """
+        Returns the cached report, or computes and caches it. compute() returning None (unknown farmer) is not cached.
+        Blocking: besides compute() it may poll Redis for up to wait_timeout_ms, so async routes call it through asyncio.to_thread.
+        """
+        try:
+            version = int(self.redis.get(self._key(tenant_id, farmer_id, "version")) or 0)
+            report_key = self._key(tenant_id, farmer_id, f"report:{version}")
+            lock_key = self._key(tenant_id, farmer_id, f"lock:{version}")
+            raw = self.redis.get(report_key)
+        except RedisError as e:
+            print(f"ESG report cache unavailable, computing directly: {e}")
+            self._count("errors")
+            return compute()
+
+        if raw is not None:
+            entry = json.loads(raw)
+            if entry["fresh_until"] > time.time():
+                self._count("hits")
+                return entry["report"]
+            token = self._acquire(lock_key)
+            if token is None:
+                # Another worker is refreshing this version; its previous report is still correct data
+                self._count("stale_hits")
+                return entry["report"]
+            self._count("misses")
+            return self._compute_and_store(report_key, lock_key, token, compute)
+
+        token = self._acquire(lock_key)
+        if token is not None:
+            self._count("misses")
+            return self._compute_and_store(report_key, lock_key, token, compute)
+        # Another worker is computing this version; wait for its report instead of hitting the database too
+        report = self._wait_for(report_key)
+        if report is not None:
+            self._count("wait_hits")
+            return report
+        self._count("wait_timeouts")
+        return compute()
+
+    def invalidate(self, tenant_id: int, farmer_id: Optional[int]):
+        """Bumps the farmer's report version; call after the write that changes the report has committed."""
+        if farmer_id is None:
+            return
+        try:
+            self.redis.incr(self._key(tenant_id, farmer_id, "version"))
+            self._count("invalidations")
+        except RedisError as e:
+            print(f"Failed to invalidate ESG report for tenant {tenant_id}, farmer {farmer_id}: {e}")
+            self._count("errors")
+
+    def _acquire(self, lock_key: str) -> Optional[str]:
+        token = uuid.uuid4().hex
+        try:
+            return token if self.redis.set(lock_key, token, nx=True, px=self.lock_timeout_ms) else None
+        except RedisError:
+            self._count("errors")
+            return token # Without Redis every worker computes for itself
+
+    def _compute_and_store(self, report_key: str, lock_key: str, token: str, compute: Callable[[], Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        try:
+            report = compute()
+            if report is not None:
+                self._store(report_key, report)
+            return report
+        finally:
+            try:
+                self._release_lock(keys=[lock_key], args=[token])
+            except RedisError:
+                pass
+
+    def _store(self, report_key: str, report: Dict[str, Any]):
+        # Jitter the TTL so reports cached together do not all expire together
+        ttl = self.ttl_s * random.uniform(1 - self.ttl_jitter, 1 + self.ttl_jitter)
+        entry = json.dumps({"report": report, "fresh_until": time.time() + ttl})
+        try:
+            self.redis.set(report_key, entry, ex=max(1, int(ttl * STALE_GRACE_FACTOR)))
+        except RedisError as e:
+            print(f"Failed to cache ESG report: {e}")
+            self._count("errors")
+
+    def _wait_for(self, report_key: str) -> Optional[Dict[str, Any]]:
+        """Polls for the report another worker is computing; sleeps the calling thread between polls."""
+        deadline = time.monotonic() + self.wait_timeout_ms / 1000
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval_ms / 1000)
+            try:
+                raw = self.redis.get(report_key)
+            except RedisError:
+                self._count("errors")
+                return None
+            if raw is not None:
+                return json.loads(raw)["report"]
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        cached = stats["hits"] + stats["stale_hits"] + stats["wait_hits"]
+        served = cached + stats["misses"] + stats["wait_timeouts"]
+        stats["hit_ratio"] = cached / served if served else 0.0
+        return stats
@@ -1,6 +1,9 @@
 import pandas as pd
 import numpy as np
-from typing import Tuple
+from typing import Any, Dict, Iterator, Optional, Tuple
+from sqlalchemy import func, select, update
+from api.models import Farmer, Order, Product
+from api.services.process_pool import AnalyticsProcessPool, ColumnSpec, attach_columns
 
 def calculate_esg_score(sales_data: pd.DataFrame, environmental_data: dict = None) -> Tuple[float, dict, dict]:
     """
@@ -13,7 +16,13 @@ def calculate_esg_score(sales_data: pd.DataFrame, environmental_data: dict = Non
     # Sales-based metrics
     total_sales = sales_data['quantity'].sum()
     unique_products = sales_data['product_id'].nunique()
-    
+    return calculate_esg_score_from_totals(total_sales, unique_products, environmental_data)
+
+def calculate_esg_score_from_totals(total_sales, unique_products: int, environmental_data: dict = None) -> Tuple[float, dict, dict]:
+    """
+    ESG score from a farmer's sufficient statistics (total quantity sold, distinct products sold),
+    for callers that maintain them incrementally instead of loading every order.
+    """
     # Social impact: weighted by sales volume and product diversity
     fair_trade_index = min(total_sales * 0.005, 0.95)
     community_engagement = "High" if unique_products > 3 else "Moderate" if unique_products > 1 else "Low"
@@ -34,3 +43,178 @@ def calculate_esg_score(sales_data: pd.DataFrame, environmental_data: dict = Non
     esg_score = np.clip((fair_trade_index * 50) + (unique_products * 10) + (carbon_reduction * 20), 0, 100)
     
     return float(esg_score), social_impact, environmental_impact
+
+ESG_BATCH_COLUMNS = ["farmer_id", "total_sales", "unique_products", "fair_trade_index", "carbon_reduction", "esg_score"]
+
+def calculate_esg_scores(orders: pd.DataFrame, farmer_ids=None, environmental_data: dict = None) -> pd.DataFrame:
+    """
+    Batch version of calculate_esg_score for a whole tenant (or all tenants) in one pass.
+    orders needs 'farmer_id', 'product_id' and 'quantity' columns, one row per order.
+    Returns one row per farmer with ESG_BATCH_COLUMNS; esg_score matches calculate_esg_score
+    on that farmer's orders. Farmers listed in farmer_ids without orders score 0.0.
+    """
+    orders = orders[orders['farmer_id'].notna()]
+    farmer_codes, farmers = pd.factorize(orders['farmer_id'], sort=True)
+    num_farmers = len(farmers)
+    quantities = orders['quantity'].to_numpy()
+    total_sales = np.bincount(farmer_codes, weights=quantities, minlength=num_farmers)
+    if np.issubdtype(quantities.dtype, np.integer):
+        total_sales = total_sales.astype(np.int64)
+
+    # Distinct (farmer, product) pairs via one int64 key per order; missing products are ignored like nunique()
+    product_ids = orders['product_id'].to_numpy()
+    integer_ids = np.issubdtype(product_ids.dtype, np.integer) and len(product_ids) > 0
+    if integer_ids:
+        lowest = int(product_ids.min())
+        span = int(product_ids.max()) - lowest + 1
+    if integer_ids and num_farmers * span < 2 ** 62:
+        # Integer ids are offset directly, skipping a second hash pass over every order
+        product_codes = product_ids - lowest
+        known = slice(None)
+    else:
+        product_codes, products = pd.factorize(orders['product_id'])
+        span = max(len(products), 1)
+        known = product_codes >= 0
+    pairs = pd.unique(farmer_codes[known].astype(np.int64) * span + product_codes[known])
+    unique_products = np.bincount(pairs // span, minlength=num_farmers)
+
+    # Same expressions, in the same order, as calculate_esg_score so the floats are identical
+    fair_trade_index = np.minimum(total_sales * 0.005, 0.95)
+    if environmental_data is None:
+        carbon_reduction = total_sales * 0.002
+    else:
+        carbon_reduction = np.full(num_farmers, environmental_data.get('carbon_reduction', 1.2), dtype=np.float64)
+    esg_score = np.clip((fair_trade_index * 50) + (unique_products * 10) + (carbon_reduction * 20), 0, 100)
+
+    scores = pd.DataFrame({
+        "farmer_id": np.asarray(farmers).astype(np.int64),
+        "total_sales": total_sales,
+        "unique_products": unique_products,
+        "fair_trade_index": fair_trade_index,
+        "carbon_reduction": carbon_reduction,
+        "esg_score": esg_score.astype(np.float64),
+    }, columns=ESG_BATCH_COLUMNS)
+    if farmer_ids is not None:
+        missing = np.setdiff1d(np.asarray(list(farmer_ids)), scores['farmer_id'].to_numpy())
+        if len(missing):
+            empty = pd.DataFrame({"farmer_id": missing}).reindex(columns=ESG_BATCH_COLUMNS, fill_value=0)
+            empty[["fair_trade_index", "carbon_reduction", "esg_score"]] = 0.0
+            scores = pd.concat([scores, empty], ignore_index=True)
+    return scores
+
+def _esg_scores_worker(spec: ColumnSpec, farmer_ids, environmental_data: dict = None) -> Dict[str, np.ndarray]:
+    """Runs calculate_esg_scores in an analytics worker on order columns mapped from shared memory."""
+    shm, columns = attach_columns(spec)
+    try:
+        orders = pd.DataFrame(columns, copy=True)
+        del columns # Release the shared buffer views before closing the block
+        scores = calculate_esg_scores(orders, farmer_ids, environmental_data)
+        return {name: scores[name].to_numpy() for name in ESG_BATCH_COLUMNS}
+    finally:
+        shm.close()
+
+async def calculate_esg_scores_offloaded(pool: AnalyticsProcessPool, orders: pd.DataFrame, farmer_ids=None,
+                                         environmental_data: dict = None) -> pd.DataFrame:
+    """calculate_esg_scores on the analytics process pool; the orders columns travel through shared memory."""
+    # to_numeric turns the object columns of empty or NULL-holding frames into plain numeric arrays
+    columns = {name: pd.to_numeric(orders[name]).to_numpy() for name in ("farmer_id", "product_id", "quantity")}
+    result = await pool.submit_columns(
+        _esg_scores_worker, columns, list(farmer_ids) if farmer_ids is not None else None, environmental_data
+    )
+    return pd.DataFrame(result, columns=ESG_BATCH_COLUMNS)
+
+def load_orders_frame(db, tenant_id: int = None) -> pd.DataFrame:
+    """Loads (farmer_id, product_id, quantity) for every order of a tenant, or of all tenants."""
+    query = select(Product.farmer_id, Order.product_id, Order.quantity).join(Product, Order.product_id == Product.id)
+    if tenant_id is not None:
+        query = query.where(Order.tenant_id == tenant_id)
+    rows = db.execute(query).all()
+    return pd.DataFrame(rows, columns=["farmer_id", "product_id", "quantity"])
+
+def write_esg_scores(db, scores: pd.DataFrame) -> int:
+    """Writes esg_score back to the farmers table with one bulk UPDATE by primary key; returns the row count."""
+    if scores.empty:
+        return 0
+    params = [
+        {"id": int(farmer_id), "esg_score": float(score)}
+        for farmer_id, score in zip(scores['farmer_id'].tolist(), scores['esg_score'].tolist())
+    ]
+    db.execute(update(Farmer), params)
+    db.commit()
+    return len(params)
+
+ESG_STREAM_CHUNK_SIZE = 10000
+
+class ESGPartialAggregate:
+    """
+    Running inputs of calculate_esg_score folded chunk by chunk: the quantity total and the set of
+    distinct product ids. Memory is bounded by one chunk plus the farmer's product count, never by order history.
+    """
+
+    def __init__(self):
+        self.total_sales = 0
+        self.product_ids = set()
+        self.rows = 0
+
+    def add(self, chunk: pd.DataFrame):
+        if chunk.empty:
+            return
+        self.total_sales += chunk['quantity'].sum()
+        self.product_ids.update(chunk['product_id'].dropna().unique().tolist())
+        self.rows += len(chunk)
+
+    def result(self, environmental_data: dict = None) -> Tuple[float, dict, dict]:
+        """Same result as calculate_esg_score over all the rows added."""
+        if self.rows == 0:
+            return calculate_esg_score(pd.DataFrame(columns=['product_id', 'quantity']))
+        return calculate_esg_score_from_totals(self.total_sales, len(self.product_ids), environmental_data)
+
+def _farmer_orders_query(farmer_id: int):
+    return select(Order.product_id, Order.quantity).join(Product, Order.product_id == Product.id).where(Product.farmer_id == farmer_id)
+
+def iter_farmer_order_chunks(db, farmer_id: int, chunk_size: int = ESG_STREAM_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Streams a farmer's (product_id, quantity) order rows through a server-side cursor, chunk_size rows at a time."""
+    result = db.execute(_farmer_orders_query(farmer_id).execution_options(stream_results=True, yield_per=chunk_size))
+    for partition in result.partitions():
+        yield pd.DataFrame(partition, columns=['product_id', 'quantity'])
+
+def calculate_farmer_esg_score_streaming(db, farmer_id: int, chunk_size: int = ESG_STREAM_CHUNK_SIZE,
+                                         environmental_data: dict = None) -> Tuple[float, dict, dict]:
+    """calculate_esg_score over a farmer's full order history with bounded memory, folding streamed chunks."""
+    aggregate = ESGPartialAggregate()
+    for chunk in iter_farmer_order_chunks(db, farmer_id, chunk_size):
+        aggregate.add(chunk)
+    return aggregate.result(environmental_data)
+
+def calculate_farmer_esg_score_sql(db, farmer_id: int, environmental_data: dict = None) -> Tuple[float, dict, dict]:
+    """calculate_esg_score over a farmer's full order history, with SUM and COUNT(DISTINCT) done by the database."""
+    orders = _farmer_orders_query(farmer_id).subquery()
+    row_count, total_sales, unique_products = db.execute(
+        select(func.count(), func.sum(orders.c.quantity), func.count(func.distinct(orders.c.product_id)))
+    ).one()
+    if row_count == 0:
+        return calculate_esg_score(pd.DataFrame(columns=['product_id', 'quantity']))
+    # MySQL returns SUM() as Decimal; the in-memory path works on integer totals
+    return calculate_esg_score_from_totals(int(total_sales or 0), unique_products, environmental_data)
+
+def build_esg_report(db, tenant_id: int, farmer_id: int) -> Optional[Dict[str, Any]]:
+    """Builds the ESGReportResponse payload for one of the tenant's farmers, or None if the farmer does not exist."""
+    farmer = db.query(Farmer).filter(Farmer.id == farmer_id, Farmer.tenant_id == tenant_id).first()
+    if farmer is None:
+        return None
+    esg_score, social_impact, environmental_impact = calculate_farmer_esg_score_sql(db, farmer_id)
+    return {
+        "farmer_name": farmer.name,
+        "esg_score": esg_score,
+        "social_impact": social_impact,
+        "environmental_impact": environmental_impact,
+    }
+
+def recalculate_esg_scores(db, tenant_id: int = None) -> int:
+    """Recomputes and stores the ESG score of every farmer of a tenant (or of all tenants)."""
+    farmer_query = db.query(Farmer.id)
+    if tenant_id is not None:
+        farmer_query = farmer_query.filter(Farmer.tenant_id == tenant_id)
+    farmer_ids = [farmer_id for (farmer_id,) in farmer_query.all()]
+    scores = calculate_esg_scores(load_orders_frame(db, tenant_id), farmer_ids=farmer_ids)
+    return write_esg_scores(db, scores[scores['farmer_id'].isin(farmer_ids)])
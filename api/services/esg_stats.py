@@ -0,0 +1,197 @@
+"""
+Incrementally maintained ESG inputs per farmer.
+
+An ESG score depends only on a farmer's total quantity sold and number of distinct products sold,
+so create_order updates those sufficient statistics (farmer_esg_stats, farmer_product_sales) in the
+order's transaction and refreshes Farmer.esg_score / Farmer.total_sales in O(1).
+rebuild_esg_stats repairs them from the orders table; check_esg_consistency compares stored scores
+with calculate_esg_score over the full order history.
+
+Run from the repository root:
+    python -m api.services.esg_stats rebuild [tenant_id]
+    python -m api.services.esg_stats check [tenant_id]
+"""
+import sys
+import pandas as pd
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
+from api.models import Farmer, FarmerEsgStats, FarmerProductSales, Order, Product
+from api.services.esg_calculator import calculate_esg_score, calculate_esg_score_from_totals
+
+# Stored scores are written from the same expressions, so only float noise is tolerated
+ESG_TOLERANCE = 1e-9
+
+
+def _backfill_stats(db: Session, farmer: Farmer) -> FarmerEsgStats:
+    """Creates the stats row of a farmer that has none, from the farmer's existing orders."""
+    rows = db.execute(
+        select(Order.product_id, func.sum(Order.quantity), func.count(Order.id))
+        .join(Product, Order.product_id == Product.id)
+        .where(Product.farmer_id == farmer.id)
+        .group_by(Order.product_id)
+    ).all()
+    for product_id, quantity, order_count in rows:
+        db.add(FarmerProductSales(farmer_id=farmer.id, product_id=product_id, tenant_id=farmer.tenant_id,
+                                  quantity=int(quantity or 0), order_count=order_count))
+    stats = FarmerEsgStats(farmer_id=farmer.id, tenant_id=farmer.tenant_id,
+                           total_quantity=sum(int(quantity or 0) for _, quantity, _ in rows), unique_products=len(rows))
+    db.add(stats)
+    db.flush() # Make the backfilled rows visible to the lookups that follow
+    return stats
+
+
+def record_order(db: Session, product: Product, quantity: int) -> Optional[Farmer]:
+    """
+    Folds a new order into its farmer's ESG stats and refreshes esg_score and total_sales.
+    Call before adding the order itself and commit together with it; the farmer row is locked
+    (SELECT ... FOR UPDATE) so concurrent orders for the same farmer serialize.
+    Returns the updated farmer, or None if the product has no farmer.
+    """
+    return record_orders(db, [(product, quantity)]).get(product.farmer_id)
+
+
+def record_orders(db: Session, items: List[Tuple[Product, int]]) -> Dict[int, Farmer]:
+    """
+    Batch form of record_order for (product, quantity) pairs: locks all affected farmers with one
+    SELECT ... FOR UPDATE (in id order, so concurrent batches cannot deadlock) and loads their stats
+    with one query per table. Returns the updated farmers by id.
+    The stats are read with FOR UPDATE as well: a locking read returns the latest committed rows,
+    where a plain SELECT under REPEATABLE READ would return the snapshot taken before the farmer lock
+    was granted, losing the increments (or repeating the first insert) of an order committed meanwhile.
+    """
+    farmer_ids = sorted({product.farmer_id for product, _ in items if product.farmer_id is not None})
+    if not farmer_ids:
+        return {}
+    farmers = {farmer.id: farmer for farmer in
+               db.query(Farmer).filter(Farmer.id.in_(farmer_ids)).order_by(Farmer.id).with_for_update().populate_existing().all()}
+    stats = {row.farmer_id: row for row in
+             db.query(FarmerEsgStats).filter(FarmerEsgStats.farmer_id.in_(list(farmers))).with_for_update().populate_existing().all()}
+    for farmer_id, farmer in farmers.items():
+        if farmer_id not in stats:
+            stats[farmer_id] = _backfill_stats(db, farmer)
+    sales = {(row.farmer_id, row.product_id): row for row in
+             db.query(FarmerProductSales).filter(FarmerProductSales.farmer_id.in_(list(farmers))).with_for_update().populate_existing().all()}
+
+    for product, quantity in items:
+        farmer = farmers.get(product.farmer_id)
+        if farmer is None:
+            continue
+        farmer_stats = stats[farmer.id]
+        product_sales = sales.get((farmer.id, product.id))
+        if product_sales is None:
+            product_sales = sales[(farmer.id, product.id)] = FarmerProductSales(
+                farmer_id=farmer.id, product_id=product.id, tenant_id=farmer.tenant_id, quantity=0, order_count=0
+            )
+            db.add(product_sales)
+            farmer_stats.unique_products += 1
+        product_sales.quantity += quantity
+        product_sales.order_count += 1
+        farmer_stats.total_quantity += quantity
+    for farmer_id, farmer in farmers.items():
+        farmer.total_sales = float(stats[farmer_id].total_quantity)
+        farmer.esg_score = calculate_esg_score_from_totals(stats[farmer_id].total_quantity, stats[farmer_id].unique_products)[0]
+    return farmers
+
+
+def rebuild_esg_stats(db: Session, tenant_id: Optional[int] = None) -> int:
+    """Repair job: recomputes every farmer's stats, esg_score and total_sales from the orders table. Returns the farmer count."""
+    farmer_query = select(Farmer.id, Farmer.tenant_id)
+    if tenant_id is not None:
+        farmer_query = farmer_query.where(Farmer.tenant_id == tenant_id)
+    farmers = dict(db.execute(farmer_query).all())
+    if not farmers:
+        return 0
+
+    sales_query = (
+        select(Product.farmer_id, Order.product_id, func.sum(Order.quantity), func.count(Order.id))
+        .join(Product, Order.product_id == Product.id)
+        .group_by(Product.farmer_id, Order.product_id)
+    )
+    if tenant_id is not None:
+        sales_query = sales_query.join(Farmer, Product.farmer_id == Farmer.id).where(Farmer.tenant_id == tenant_id)
+    sales = [
+        {"farmer_id": farmer_id, "product_id": product_id, "tenant_id": farmers[farmer_id], "quantity": int(quantity or 0), "order_count": order_count}
+        for farmer_id, product_id, quantity, order_count in db.execute(sales_query).all()
+        if farmer_id in farmers
+    ]
+    totals = {farmer_id: [0, 0] for farmer_id in farmers}
+    for row in sales:
+        totals[row["farmer_id"]][0] += row["quantity"]
+        totals[row["farmer_id"]][1] += 1
+
+    farmer_ids = list(farmers)
+    db.execute(delete(FarmerProductSales).where(FarmerProductSales.farmer_id.in_(farmer_ids)))
+    db.execute(delete(FarmerEsgStats).where(FarmerEsgStats.farmer_id.in_(farmer_ids)))
+    if sales:
+        db.execute(insert(FarmerProductSales), sales)
+    db.execute(insert(FarmerEsgStats), [
+        {"farmer_id": farmer_id, "tenant_id": farmers[farmer_id], "total_quantity": total, "unique_products": unique}
+        for farmer_id, (total, unique) in totals.items()
+    ])
+    db.execute(update(Farmer), [
+        {
+            "id": farmer_id,
+            "total_sales": float(total),
+            "esg_score": calculate_esg_score_from_totals(total, unique)[0] if unique else 0.0,
+        }
+        for farmer_id, (total, unique) in totals.items()
+    ])
+    db.commit()
+    return len(farmers)
+
+
+def check_esg_consistency(db: Session, tenant_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Compares each farmer's stored esg_score and total_sales with calculate_esg_score over their orders; returns the mismatches."""
+    farmer_query = db.query(Farmer)
+    if tenant_id is not None:
+        farmer_query = farmer_query.filter(Farmer.tenant_id == tenant_id)
+    farmers = farmer_query.all()
+    rows = db.execute(
+        select(Product.farmer_id, Order.product_id, Order.quantity)
+        .join(Product, Order.product_id == Product.id)
+        .where(Product.farmer_id.in_([farmer.id for farmer in farmers]))
+    ).all()
+    orders = pd.DataFrame(rows, columns=["farmer_id", "product_id", "quantity"])
+    by_farmer = dict(tuple(orders.groupby("farmer_id")))
+
+    mismatches = []
+    for farmer in farmers:
+        farmer_orders = by_farmer.get(farmer.id, orders.iloc[:0])
+        expected_score = calculate_esg_score(farmer_orders)[0]
+        expected_sales = float(farmer_orders["quantity"].sum())
+        if abs((farmer.esg_score or 0.0) - expected_score) > ESG_TOLERANCE or abs((farmer.total_sales or 0.0) - expected_sales) > ESG_TOLERANCE:
+            mismatches.append({
+                "farmer_id": farmer.id,
+                "tenant_id": farmer.tenant_id,
+                "esg_score": farmer.esg_score,
+                "expected_esg_score": expected_score,
+                "total_sales": farmer.total_sales,
+                "expected_total_sales": expected_sales,
+            })
+    return mismatches
+
+
+def main(argv: List[str]):
+    if not argv or argv[0] not in ("rebuild", "check"):
+        print("Usage: python -m api.services.esg_stats rebuild|check [tenant_id]")
+        return 2
+    from api.main import SessionLocal
+    tenant_id = int(argv[1]) if len(argv) > 1 else None
+    db = SessionLocal()
+    try:
+        if argv[0] == "rebuild":
+            print(f"Rebuilt ESG stats for {rebuild_esg_stats(db, tenant_id)} farmers.")
+            return 0
+        mismatches = check_esg_consistency(db, tenant_id)
+        for mismatch in mismatches:
+            print(f"Farmer {mismatch['farmer_id']}: esg_score {mismatch['esg_score']} (expected {mismatch['expected_esg_score']}), "
+                  f"total_sales {mismatch['total_sales']} (expected {mismatch['expected_total_sales']})")
+        print(f"{len(mismatches)} inconsistent farmers.")
+        return 1 if mismatches else 0
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from redis.exceptions import RedisError
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+# Deletes the in-flight marker only if it is still ours, so a request that outlived its lock never clears another's
+_RELEASE_PENDING = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class IdempotencyError(Exception):
+    """Base class; status_code is the HTTP status callers should answer with."""
+    status_code = 400
+
+
+class IdempotencyKeyInvalid(IdempotencyError):
+    """The Idempotency-Key header is empty or too long."""
+    status_code = 400
+
+
+class IdempotencyKeyReused(IdempotencyError):
+    """The key was already used with a different request body."""
+    status_code = 422
+
+
+class IdempotencyInProgress(IdempotencyError):
+    """A request with the same key is still running after the wait timeout."""
+    status_code = 409
+
+
+def fingerprint(scope: str, payload: Dict[str, Any]) -> str:
+    """Digest of the operation and its canonical JSON body; a key may only be replayed for an identical request."""
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{scope}\n{body}".encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Makes retried POSTs safe: the first request with an Idempotency-Key runs the handler and stores
+    its response in Redis for ttl_s; later requests with the same key (per tenant and operation) get
+    that response back without running the handler again.
+    One key holds either an in-flight marker, set with SET NX so only one request runs the handler,
+    or the finished response, so a replay costs a single GET. Concurrent duplicates poll until the
+    response appears. A handler that raises releases the key so the client can retry.
+    Redis failures fall back to running the handler without idempotency.
+    """
+
+    def __init__(self, redis_client, ttl_s: int = 86400, lock_timeout_ms: int = 30000, wait_timeout_ms: int = 10000,
+                 poll_interval_ms: int = 50):
+        self.redis = redis_client
+        self.ttl_s = ttl_s
+        self.lock_timeout_ms = lock_timeout_ms
+        self.wait_timeout_ms = wait_timeout_ms
+        self.poll_interval_ms = poll_interval_ms
+        self._release_pending = redis_client.register_script(_RELEASE_PENDING)
+        self._stats_lock = threading.Lock()
+        self._stats = {"executed": 0, "replayed": 0, "waited": 0, "conflicts": 0, "mismatches": 0, "errors": 0}
+
+    @staticmethod
+    def _key(tenant_id: int, scope: str, idempotency_key: str) -> str:
+        return f"idem:{tenant_id}:{scope}:{idempotency_key}"
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _begin(self, key: str, request_fingerprint: str) -> Tuple[str, Any]:
+        """One step of the protocol: ("replay", response), ("run", marker), ("wait", None) or ("bypass", None) without Redis."""
+        try:
+            raw = self.redis.get(key)
+            if raw is None:
+                marker = json.dumps({"state": "pending", "fingerprint": request_fingerprint, "token": uuid.uuid4().hex})
+                if self.redis.set(key, marker, nx=True, px=self.lock_timeout_ms):
+                    return "run", marker
+                raw = self.redis.get(key) # Lost the race to a concurrent duplicate
+                if raw is None:
+                    return "wait", None
+        except RedisError as e:
+            print(f"Idempotency store unavailable, running request without it: {e}")
+            self._count("errors")
+            return "bypass", None
+        entry = json.loads(raw)
+        if entry["fingerprint"] != request_fingerprint:
+            self._count("mismatches")
+            raise IdempotencyKeyReused("Idempotency-Key was already used for a different request")
+        if entry["state"] == "done":
+            return "replay", entry["response"]
+        return "wait", None
+
+    def _finish(self, key: str, request_fingerprint: str, response: Any):
+        entry = json.dumps({"state": "done", "fingerprint": request_fingerprint, "response": response})
+        try:
+            self.redis.set(key, entry, ex=self.ttl_s)
+        except RedisError as e:
+            print(f"Failed to store idempotent response: {e}")
+            self._count("errors")
+
+    def _release(self, key: str, marker: str):
+        try:
+            self._release_pending(keys=[key], args=[marker])
+        except RedisError:
+            self._count("errors")
+
+    def _prepare(self, tenant_id: int, scope: str, idempotency_key: str, payload: Dict[str, Any]) -> Tuple[str, str]:
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            raise IdempotencyKeyInvalid(f"{IDEMPOTENCY_KEY_HEADER} must be 1-{MAX_KEY_LENGTH} characters")
+        return self._key(tenant_id, scope, idempotency_key), fingerprint(scope, payload)
+
+    def _timed_out(self):
+        self._count("conflicts")
+        raise IdempotencyInProgress("A request with this Idempotency-Key is still in progress")
+
+    def run(self, tenant_id: int, scope: str, idempotency_key: Optional[str], payload: Dict[str, Any],
+            compute: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Returns (response, replayed). compute() must return a JSON-serializable response.
+        Without an idempotency key the request simply runs.
+        """
+        if idempotency_key is None:
+            return compute(), False
+        key, request_fingerprint = self._prepare(tenant_id, scope, idempotency_key, payload)
+        deadline = time.monotonic() + self.wait_timeout_ms / 1000
+        waited = False
+        while True:
+            step, value = self._begin(key, request_fingerprint)
+            if step == "replay":
+                self._count("waited" if waited else "replayed")
+                return value, True
+            if step == "bypass":
+                return compute(), False
+            if step == "run":
+                return self._run(key, request_fingerprint, value, compute), False
+            if time.monotonic() >= deadline:
+                self._timed_out()
+            waited = True
+            time.sleep(self.poll_interval_ms / 1000)
+
+    def _run(self, key: str, request_fingerprint: str, marker: str, compute: Callable[[], Any]) -> Any:
+        try:
+            response = compute()
+        except BaseException:
+            self._release(key, marker)
+            raise
+        self._finish(key, request_fingerprint, response)
+        self._count("executed")
+        return response
+
+    async def run_async(self, tenant_id: int, scope: str, idempotency_key: Optional[str], payload: Dict[str, Any],
+                        compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """run for async handlers: Redis calls go to a worker thread and waiting does not block the event loop."""
+        if idempotency_key is None:
+            return await compute(), False
+        key, request_fingerprint = self._prepare(tenant_id, scope, idempotency_key, payload)
+        deadline = time.monotonic() + self.wait_timeout_ms / 1000
+        waited = False
+        while True:
+            step, value = await asyncio.to_thread(self._begin, key, request_fingerprint)
+            if step == "replay":
+                self._count("waited" if waited else "replayed")
+                return value, True
+            if step == "bypass":
+                return await compute(), False
+            if step == "run":
+                try:
+                    response = await compute()
+                except BaseException:
+                    await asyncio.to_thread(self._release, key, value)
+                    raise
+                await asyncio.to_thread(self._finish, key, request_fingerprint, response)
+                self._count("executed")
+                return response, False
+            if time.monotonic() >= deadline:
+                self._timed_out()
+            waited = True
+            await asyncio.sleep(self.poll_interval_ms / 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return dict(self._stats)
@@ -0,0 +1,80 @@
+import re
+import numpy as np
+from typing import Tuple
+
+AGGREGATIONS = ("min", "max", "mean", "last")
+
+_BUCKET_UNITS_MS = {"s": 1_000, "m": 60_000, "h": 3_600_000, "d": 86_400_000}
+_BUCKET_PATTERN = re.compile(r"^(\d+)([smhd])$")
+
+def parse_bucket(bucket: str) -> int:
+    """Parses a bucket width such as '30s', '1m', '15m', '1h' or '1d' into milliseconds."""
+    match = _BUCKET_PATTERN.match(bucket.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid bucket '{bucket}'. Use a positive width like 1m, 15m or 1h.")
+    return int(match.group(1)) * _BUCKET_UNITS_MS[match.group(2)]
+
+def bucket_aggregate(timestamps: np.ndarray, values: np.ndarray, bucket_ms: int, agg: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Aggregates chronologically ordered readings into fixed-width time buckets.
+    values is shaped (channels, n); NaN (missing) readings are ignored, and a channel with no
+    readings in a bucket stays NaN. Returns (bucket start timestamps, aggregated values).
+    """
+    if agg not in AGGREGATIONS:
+        raise ValueError(f"Invalid agg '{agg}'. Use one of: {', '.join(AGGREGATIONS)}.")
+    if len(timestamps) == 0:
+        return timestamps[:0], values[:, :0]
+
+    bucket_ids = timestamps // bucket_ms
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket_ids)) + 1))
+    bucket_timestamps = bucket_ids[starts] * bucket_ms
+    missing = np.isnan(values)
+
+    if agg == "min":
+        result = np.fmin.reduceat(values, starts, axis=1)
+    elif agg == "max":
+        result = np.fmax.reduceat(values, starts, axis=1)
+    elif agg == "mean":
+        sums = np.add.reduceat(np.where(missing, 0.0, values), starts, axis=1)
+        counts = np.add.reduceat(~missing, starts, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    else: # last
+        positions = np.where(missing, -1, np.arange(values.shape[1]))
+        last_positions = np.maximum.reduceat(positions, starts, axis=1)
+        result = np.where(last_positions >= 0, np.take_along_axis(values, np.maximum(last_positions, 0), axis=1), np.nan)
+    return bucket_timestamps, result
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling: returns the indices of 'threshold' points
+    that preserve the visual shape of the (x, y) series. Triangle areas within each bucket are
+    computed vectorized; only the walk across buckets is sequential.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    edges = np.floor(np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+def lttb_downsample(timestamps: np.ndarray, values: np.ndarray, channel_index: int, points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Downsamples readings to 'points' rows with LTTB, driven by one channel; readings missing that channel are skipped."""
+    present = np.flatnonzero(~np.isnan(values[channel_index]))
+    timestamps, values = timestamps[present], values[:, present]
+    indices = lttb_indices(timestamps, values[channel_index], points)
+    return timestamps[indices], values[:, indices]
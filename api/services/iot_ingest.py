@@ -0,0 +1,176 @@
+import json
+import math
+import datetime
+import numpy as np
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from api.models import IoTReading
+from api.services.iot_store import IOT_CHANNELS, IoTTimeSeriesStore, to_epoch_ms
+from api.services.iot_persistence import IoTWriteBehindQueue
+
+# Called with (tenant_id, device_id, timestamps, values) after a device's readings are stored
+IngestListener = Callable[[int, str, np.ndarray, np.ndarray], None]
+
+try:
+    import msgpack
+except ImportError: # msgpack is optional; only the binary codec depends on it
+    msgpack = None
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+MAX_DEVICE_ID_LENGTH = IoTReading.__table__.c.device_id.type.length # Longer ids would fail the write-behind INSERT
+# Epoch milliseconds representable as a datetime (years 1 to 9999); anything else cannot be stored or queried
+MIN_EPOCH_MS = (datetime.datetime.min - datetime.datetime(1970, 1, 1)) // datetime.timedelta(milliseconds=1)
+MAX_EPOCH_MS = (datetime.datetime.max - datetime.datetime(1970, 1, 1)) // datetime.timedelta(milliseconds=1)
+
+
+class IoTBatchTooLarge(Exception):
+    """Raised when a bulk upload exceeds the configured row limit."""
+
+
+class _MalformedRow:
+    """Placeholder for a row that could not be decoded, so it can be reported as a reject."""
+    __slots__ = ("detail",)
+
+    def __init__(self, detail: str):
+        self.detail = detail
+
+
+async def decode_ndjson(chunks: AsyncIterator[bytes], max_rows: int) -> List[Any]:
+    """Decodes a streamed NDJSON body line by line; undecodable lines become _MalformedRow entries."""
+    rows: List[Any] = []
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        _decode_lines(lines, rows, max_rows)
+    _decode_lines([pending], rows, max_rows)
+    return rows
+
+def _decode_lines(lines: List[bytes], rows: List[Any], max_rows: int):
+    for line in lines:
+        if not line.strip():
+            continue
+        if len(rows) >= max_rows:
+            raise IoTBatchTooLarge(f"Bulk upload exceeds {max_rows} rows")
+        try:
+            rows.append(json.loads(line))
+        except ValueError as e:
+            rows.append(_MalformedRow(f"Invalid JSON: {e}"))
+
+async def decode_msgpack(chunks: AsyncIterator[bytes], max_rows: int) -> List[Any]:
+    """
+    Decodes a streamed msgpack body holding either one array of readings or a sequence of maps.
+    An array's length is checked against max_rows from its header, before any of its rows are decoded.
+    """
+    if msgpack is None:
+        raise RuntimeError("msgpack is not installed")
+    unpacker = msgpack.Unpacker(raw=False)
+    rows: List[Any] = []
+    remaining = 0 # Rows of the current array not decoded yet
+    async for chunk in chunks:
+        unpacker.feed(chunk)
+        while True:
+            try:
+                if remaining:
+                    rows.append(unpacker.unpack())
+                    remaining -= 1
+                    continue
+                try:
+                    remaining = unpacker.read_array_header()
+                except ValueError: # Not an array: a single reading (or corrupt data, which unpack reports)
+                    rows.append(unpacker.unpack())
+            except msgpack.OutOfData:
+                break
+            if len(rows) + remaining > max_rows:
+                raise IoTBatchTooLarge(f"Bulk upload exceeds {max_rows} rows")
+    if remaining:
+        raise ValueError(f"Truncated array: {remaining} rows missing")
+    return rows
+
+
+def _parse_timestamp(value: Any, default_ms: int) -> int:
+    """Accepts ISO-8601 strings or epoch milliseconds; missing timestamps default to the server time."""
+    if value is None:
+        return default_ms
+    if isinstance(value, bool):
+        raise ValueError("timestamp must be an ISO-8601 string or epoch milliseconds")
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            raise ValueError("timestamp must be finite")
+        epoch_ms = int(value)
+    elif isinstance(value, str):
+        epoch_ms = to_epoch_ms(datetime.datetime.fromisoformat(value))
+    else:
+        raise ValueError("timestamp must be an ISO-8601 string or epoch milliseconds")
+    if not MIN_EPOCH_MS <= epoch_ms <= MAX_EPOCH_MS:
+        raise ValueError("timestamp is out of range")
+    return epoch_ms
+
+def _parse_channel(row: Dict[str, Any], name: str) -> float:
+    value = row.get(name)
+    if value is None:
+        return math.nan
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name} must be a number or null")
+    return float(value)
+
+def validate_rows(rows: List[Any]) -> Tuple[Dict[str, Tuple[List[int], List[Tuple[float, ...]]]], List[Dict[str, Any]]]:
+    """
+    Validates decoded rows as one batch without building per-row Pydantic models.
+    Returns accepted readings grouped by device_id as (timestamps, channel tuples), plus per-row rejects.
+    """
+    default_ms = to_epoch_ms(datetime.datetime.now(datetime.timezone.utc))
+    by_device: Dict[str, Tuple[List[int], List[Tuple[float, ...]]]] = {}
+    errors: List[Dict[str, Any]] = []
+    for index, row in enumerate(rows):
+        if isinstance(row, _MalformedRow):
+            errors.append({"row": index, "detail": row.detail})
+            continue
+        if not isinstance(row, dict):
+            errors.append({"row": index, "detail": "Row must be an object"})
+            continue
+        device_id = row.get("device_id")
+        if not isinstance(device_id, str) or not device_id:
+            errors.append({"row": index, "detail": "device_id is required"})
+            continue
+        if len(device_id) > MAX_DEVICE_ID_LENGTH:
+            errors.append({"row": index, "detail": f"device_id must be at most {MAX_DEVICE_ID_LENGTH} characters"})
+            continue
+        try:
+            epoch_ms = _parse_timestamp(row.get("timestamp"), default_ms)
+            readings = tuple(_parse_channel(row, name) for name in IOT_CHANNELS)
+        except (ValueError, TypeError, OverflowError) as e:
+            errors.append({"row": index, "detail": str(e)})
+            continue
+        columns = by_device.get(device_id)
+        if columns is None:
+            columns = by_device[device_id] = ([], [])
+        columns[0].append(epoch_ms)
+        columns[1].append(readings)
+    return by_device, errors
+
+def ingest_rows(store: IoTTimeSeriesStore, tenant_id: int, rows: List[Any], writer: IoTWriteBehindQueue = None,
+                on_ingest: Optional[IngestListener] = None) -> Dict[str, Any]:
+    """
+    Validates a decoded batch and appends every accepted reading into the store in one pass per device.
+    With a writer, the accepted readings are queued for persistence first; IoTQueueFull propagates
+    before anything is stored so the whole batch can be retried. on_ingest is called once per device.
+    """
+    by_device, errors = validate_rows(rows)
+    columns = {
+        device_id: (
+            np.fromiter(timestamps, dtype=np.int64, count=len(timestamps)),
+            np.array(readings, dtype=np.float64).T,
+        )
+        for device_id, (timestamps, readings) in by_device.items()
+    }
+    if writer is not None:
+        writer.offer(tenant_id, columns)
+    accepted = 0
+    for device_id, (timestamps, values) in columns.items():
+        store.extend(tenant_id, device_id, timestamps, values)
+        if on_ingest is not None:
+            on_ingest(tenant_id, device_id, timestamps, values)
+        accepted += len(timestamps)
+    return {"accepted": accepted, "rejected": len(errors), "errors": errors}
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import time
+import numpy as np
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Set, Tuple
+from api.services.iot_store import IOT_CHANNELS, from_epoch_ms
+
+TopicKey = Tuple[int, str]
+
+
+def encode_frame(device_id: str, timestamps: np.ndarray, values: np.ndarray) -> str:
+    """Encodes a batch of readings as the JSON text sent to every live subscriber."""
+    readings = []
+    for i, epoch_ms in enumerate(timestamps.tolist()):
+        reading = {"timestamp": from_epoch_ms(epoch_ms).isoformat()}
+        for name, value in zip(IOT_CHANNELS, values[:, i].tolist()):
+            reading[name] = None if value != value else value # NaN marks a missing value
+        readings.append(reading)
+    return json.dumps({"device_id": device_id, "readings": readings})
+
+
+class LiveSubscriber:
+    """One connected dashboard: a bounded frame queue that drops the oldest frame when the consumer falls behind."""
+
+    def __init__(self, max_queue: int):
+        self.frames: Deque[Tuple[str, float]] = deque(maxlen=max_queue)
+        self._ready = asyncio.Event()
+
+    def push(self, frame: str, published_at: float) -> bool:
+        """Queues a frame; returns True if the oldest queued frame had to be dropped."""
+        dropped = len(self.frames) == self.frames.maxlen
+        self.frames.append((frame, published_at))
+        self._ready.set()
+        return dropped
+
+    async def next_frame(self) -> Tuple[str, float]:
+        while not self.frames:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.frames.popleft()
+
+
+class IoTLiveHub:
+    """
+    Fans newly ingested readings out to live subscribers per (tenant_id, device_id).
+    Each publish encodes a single frame shared by all subscribers of the topic; nothing is
+    encoded when a topic has no subscribers. Must be used from the event loop thread.
+    """
+
+    def __init__(self, max_queue: int = 32):
+        self.max_queue = max_queue
+        self._topics: Dict[TopicKey, Set[LiveSubscriber]] = {}
+        self._stats = {"published_frames": 0, "delivered_frames": 0, "dropped_frames": 0,
+                       "last_broadcast_ms": 0.0, "max_broadcast_ms": 0.0, "total_broadcast_ms": 0.0}
+
+    def subscribe(self, tenant_id: int, device_id: str) -> LiveSubscriber:
+        subscriber = LiveSubscriber(self.max_queue)
+        self._topics.setdefault((tenant_id, device_id), set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, tenant_id: int, device_id: str, subscriber: LiveSubscriber):
+        key = (tenant_id, device_id)
+        subscribers = self._topics.get(key)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._topics[key]
+
+    def has_subscribers(self, tenant_id: int, device_id: str) -> bool:
+        return (tenant_id, device_id) in self._topics
+
+    def publish(self, tenant_id: int, device_id: str, timestamps: np.ndarray, values: np.ndarray):
+        subscribers = self._topics.get((tenant_id, device_id))
+        if not subscribers or len(timestamps) == 0:
+            return
+        frame = encode_frame(device_id, timestamps, values)
+        published_at = time.perf_counter()
+        for subscriber in subscribers:
+            if subscriber.push(frame, published_at):
+                self._stats["dropped_frames"] += 1
+        self._stats["published_frames"] += 1
+
+    def record_delivery(self, published_at: float):
+        """Called by a connection after sending a frame; tracks publish-to-send latency."""
+        elapsed_ms = (time.perf_counter() - published_at) * 1000
+        self._stats["delivered_frames"] += 1
+        self._stats["last_broadcast_ms"] = elapsed_ms
+        self._stats["max_broadcast_ms"] = max(self._stats["max_broadcast_ms"], elapsed_ms)
+        self._stats["total_broadcast_ms"] += elapsed_ms
+
+    def stats(self, tenant_id: Optional[int] = None) -> Dict[str, Any]:
+        topics = {key: subs for key, subs in self._topics.items() if tenant_id is None or key[0] == tenant_id}
+        delivered = self._stats["delivered_frames"]
+        return {
+            "connections": sum(len(subs) for subs in topics.values()),
+            "topics": {device_id: len(subs) for (_, device_id), subs in topics.items()},
+            "avg_broadcast_ms": self._stats["total_broadcast_ms"] / delivered if delivered else 0.0,
+            **{key: value for key, value in self._stats.items() if key != "total_broadcast_ms"},
+        }
@@ -0,0 +1,253 @@
+import asyncio
+import time
+import numpy as np
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InterfaceError, OperationalError
+from api.models import IoTReading
+from api.services.iot_store import IOT_CHANNELS
+from api.services.iot_segments import IoTSegmentStore
+
+# One queued unit of work: (tenant_id, device_id, timestamps, values shaped (channels, n))
+IoTChunk = Tuple[int, str, np.ndarray, np.ndarray]
+
+# Failures worth retrying as they are (lost connection, deadlock, lock wait, I/O); anything else is blamed on the rows
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, OSError)
+
+
+class IoTQueueFull(Exception):
+    """Raised when the write-behind queue cannot take more readings; callers should answer 429."""
+
+
+class IoTWriteBehindQueue:
+    """
+    Write-behind pipeline persisting IoT readings to the iot_readings table and/or segment files.
+    Ingest handlers offer columnar chunks and return immediately; a background task drains them
+    every 'batch_size' rows or 'flush_interval_ms', whichever comes first, appending each chunk to
+    its device's segment (when a segment store is given) and writing multi-row INSERTs (when an engine is given).
+    The queue is bounded in rows: offers that would exceed 'max_pending_rows' are refused so the
+    caller can answer 429. Must be started and stopped from the event loop that serves requests.
+    A failed write is retried up to 'max_retries' times with exponential backoff from 'retry_backoff_ms'.
+    INSERTs still failing on a transient error go back to the front of the queue, so an outage costs
+    backpressure, not readings. Any other failure is blamed on the rows: the batch is split in halves
+    until the failing rows are isolated, and only those are dead-lettered (kept in dead_letters()).
+    """
+
+    def __init__(self, engine: Optional[Engine], max_pending_rows: int = 100000, batch_size: int = 500, flush_interval_ms: int = 1000,
+                 segments: Optional[IoTSegmentStore] = None, max_retries: int = 3, retry_backoff_ms: int = 200,
+                 dead_letter_capacity: int = 1000):
+        self.engine = engine
+        self.segments = segments
+        self.max_pending_rows = max_pending_rows
+        self.batch_size = batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self.max_retries = max_retries
+        self.retry_backoff_ms = retry_backoff_ms
+        self._dead_letters: Deque[Dict[str, Any]] = deque(maxlen=dead_letter_capacity)
+        self._chunks: Deque[IoTChunk] = deque()
+        self._pending_rows = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._stats = {
+            "flushes": 0,
+            "flushed_rows": 0,
+            "failed_rows": 0, # Dead-lettered
+            "retries": 0,
+            "requeued_rows": 0,
+            "rejected_rows": 0,
+            "max_queue_depth": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    def offer(self, tenant_id: int, columns: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        """
+        Queues {device_id: (timestamps, values)} without blocking, all or nothing.
+        Raises IoTQueueFull when the rows do not fit. When the pipeline is not running
+        (e.g. persistence disabled) readings stay memory-only.
+        """
+        if not self.running:
+            return
+        n = sum(len(timestamps) for timestamps, _ in columns.values())
+        if self._pending_rows + n > self.max_pending_rows:
+            self._stats["rejected_rows"] += n
+            raise IoTQueueFull(f"IoT ingest queue is full ({self._pending_rows} rows pending)")
+        for device_id, (timestamps, values) in columns.items():
+            self._chunks.append((tenant_id, device_id, timestamps, values))
+        self._pending_rows += n
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._pending_rows)
+        if self._pending_rows >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        print(f"IoT write-behind pipeline started (batch_size={self.batch_size}, flush_interval_ms={self.flush_interval_ms})")
+
+    async def stop(self, timeout: float = 10.0):
+        """Stops accepting readings and drains everything already queued before returning."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            print(f"IoT write-behind pipeline did not drain within {timeout}s; {self._pending_rows} rows lost")
+        self._task = None
+        print("IoT write-behind pipeline stopped.")
+
+    async def _run(self):
+        while True:
+            if not self._closing and self._pending_rows < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            while self._chunks:
+                await self._flush(self._take_batch())
+                if not self._closing and self._pending_rows < self.batch_size:
+                    break
+            if self._closing and not self._chunks:
+                return
+
+    def _take_batch(self) -> List[IoTChunk]:
+        """Pops whole chunks until at least 'batch_size' rows are collected."""
+        chunks: List[IoTChunk] = []
+        rows = 0
+        while self._chunks and rows < self.batch_size:
+            chunk = self._chunks.popleft()
+            chunks.append(chunk)
+            rows += len(chunk[2])
+        self._pending_rows -= rows
+        return chunks
+
+    async def _flush(self, chunks: List[IoTChunk]):
+        rows = sum(len(chunk[2]) for chunk in chunks)
+        started = time.perf_counter()
+        written, failed, requeued = chunks, 0, []
+        if self.engine is not None:
+            written, failed, requeued = await self._write(self._insert_chunks, chunks, requeue=True)
+        if self.segments is not None and written:
+            # Requeued rows are appended when their INSERT succeeds, so segments never hold them twice
+            failed += (await self._write(self._append_segments, written, requeue=False))[1]
+        if requeued:
+            requeued_rows = sum(len(chunk[2]) for chunk in requeued)
+            self._chunks.extendleft(reversed(requeued))
+            self._pending_rows += requeued_rows
+            self._stats["requeued_rows"] += requeued_rows
+            print(f"IoT write-behind requeued {requeued_rows} rows after {self.max_retries} retries")
+            await asyncio.sleep(self.retry_backoff_ms / 1000 * 2 ** self.max_retries)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._stats["flushes"] += 1
+        self._stats["flushed_rows"] += rows - failed - sum(len(chunk[2]) for chunk in requeued)
+        self._stats["failed_rows"] += failed
+        self._stats["last_flush_ms"] = elapsed_ms
+        self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+        self._stats["total_flush_ms"] += elapsed_ms
+
+    async def _write(self, step: Callable[[List[IoTChunk]], None], chunks: List[IoTChunk],
+                     requeue: bool) -> Tuple[List[IoTChunk], int, List[IoTChunk]]:
+        """
+        Runs step(chunks) in a worker thread with retries. Returns (chunks done, rows dead-lettered,
+        chunks to requeue); done includes dead-lettered rows, which no retry would ever write.
+        """
+        error: Exception = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._stats["retries"] += 1
+                await asyncio.sleep(self.retry_backoff_ms / 1000 * 2 ** (attempt - 1))
+            try:
+                await asyncio.to_thread(step, chunks)
+                return chunks, 0, []
+            except TRANSIENT_ERRORS as e:
+                error = e
+            except Exception as e:
+                error = e
+                break # Retrying the same rows would fail the same way
+        if requeue and isinstance(error, TRANSIENT_ERRORS):
+            return [], 0, chunks
+        if len(chunks) == 1 and len(chunks[0][2]) == 1:
+            self._dead_letter(chunks[0], step.__name__, error)
+            return chunks, 1, []
+        done, failed, requeued = [], 0, []
+        for half in self._split(chunks):
+            half_done, half_failed, half_requeued = await self._write(step, half, requeue)
+            done += half_done
+            failed += half_failed
+            requeued += half_requeued
+        return done, failed, requeued
+
+    @staticmethod
+    def _split(chunks: List[IoTChunk]) -> Tuple[List[IoTChunk], List[IoTChunk]]:
+        """Halves a batch by chunks, or a single chunk by rows."""
+        if len(chunks) > 1:
+            return chunks[:len(chunks) // 2], chunks[len(chunks) // 2:]
+        tenant_id, device_id, timestamps, values = chunks[0]
+        middle = len(timestamps) // 2
+        return ([(tenant_id, device_id, timestamps[:middle], values[:, :middle])],
+                [(tenant_id, device_id, timestamps[middle:], values[:, middle:])])
+
+    def _dead_letter(self, chunk: IoTChunk, step: str, error: Exception):
+        tenant_id, device_id, timestamps, values = chunk
+        print(f"IoT write-behind dead-lettered a reading of device {device_id[:64]} (tenant {tenant_id}) in {step}: {error}")
+        self._dead_letters.append({
+            "tenant_id": tenant_id,
+            "device_id": device_id,
+            "timestamp_ms": int(timestamps[0]),
+            **{name: None if np.isnan(value) else float(value) for name, value in zip(IOT_CHANNELS, values[:, 0])},
+            "step": step,
+            "error": str(error),
+        })
+
+    def dead_letters(self) -> List[Dict[str, Any]]:
+        """The most recent readings that could not be persisted, oldest first."""
+        return list(self._dead_letters)
+
+    def _append_segments(self, chunks: List[IoTChunk]):
+        for tenant_id, device_id, timestamps, values in chunks:
+            self.segments.append(tenant_id, device_id, timestamps, values)
+
+    def _insert_chunks(self, chunks: List[IoTChunk]):
+        self._insert(self._to_rows(chunks))
+
+    @staticmethod
+    def _to_rows(chunks: List[IoTChunk]) -> List[Dict[str, Any]]:
+        rows: List[Dict[str, Any]] = []
+        for tenant_id, device_id, timestamps, values in chunks:
+            channels = [[None if np.isnan(v) else float(v) for v in column] for column in values]
+            for i, epoch_ms in enumerate(timestamps.tolist()):
+                row = {"tenant_id": tenant_id, "device_id": device_id, "timestamp_ms": epoch_ms}
+                for name, column in zip(IOT_CHANNELS, channels):
+                    row[name] = column[i]
+                rows.append(row)
+        return rows
+
+    def _insert(self, rows: List[Dict[str, Any]]):
+        # One transaction per flush, one multi-row INSERT per 'batch_size' rows
+        with self.engine.begin() as conn:
+            for start in range(0, len(rows), self.batch_size):
+                conn.execute(insert(IoTReading).values(rows[start:start + self.batch_size]))
+
+    def stats(self) -> Dict[str, Any]:
+        flushes = self._stats["flushes"]
+        return {
+            "running": self.running,
+            "queue_depth": self._pending_rows,
+            "dead_letters": len(self._dead_letters),
+            "max_pending_rows": self.max_pending_rows,
+            "avg_flush_ms": self._stats["total_flush_ms"] / flushes if flushes else 0.0,
+            **{key: value for key, value in self._stats.items() if key != "total_flush_ms"},
+        }
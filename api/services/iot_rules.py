@@ -0,0 +1,173 @@
+import itertools
+import numpy as np
+from collections import deque
+from typing import Any, Deque, Dict, List, Tuple
+from api.services.iot_store import IOT_CHANNELS
+
+RULE_KINDS = ("threshold", "duration", "rate")
+# threshold/duration rules compare against a fixed value; rate rules compare against the window extreme
+RULE_DIRECTIONS = {"threshold": ("above", "below"), "duration": ("above", "below"), "rate": ("rise", "fall")}
+
+_KIND_DURATION, _KIND_RATE = RULE_KINDS.index("duration"), RULE_KINDS.index("rate")
+
+
+def validate_rule(rule: Dict[str, Any]):
+    """Raises ValueError if a rule definition is inconsistent."""
+    if rule["kind"] not in RULE_KINDS:
+        raise ValueError(f"Invalid kind '{rule['kind']}'. Use one of: {', '.join(RULE_KINDS)}.")
+    if rule["channel"] not in IOT_CHANNELS:
+        raise ValueError(f"Invalid channel '{rule['channel']}'. Use one of: {', '.join(IOT_CHANNELS)}.")
+    directions = RULE_DIRECTIONS[rule["kind"]]
+    if rule["direction"] not in directions:
+        raise ValueError(f"Invalid direction '{rule['direction']}' for {rule['kind']} rules. Use one of: {', '.join(directions)}.")
+    if rule["kind"] != "threshold" and rule.get("window_s", 0) <= 0:
+        raise ValueError(f"{rule['kind']} rules need a positive window_s")
+
+
+class _MonotonicWindow:
+    """Sliding-window minimum (or maximum) over the last window_ms of readings, amortized O(1) per reading."""
+    __slots__ = ("window_ms", "sign", "_items")
+
+    def __init__(self, window_ms: int, track_max: bool):
+        self.window_ms = window_ms
+        self.sign = -1.0 if track_max else 1.0 # Store negated values to reuse the min logic for max
+        self._items: Deque[Tuple[int, float]] = deque()
+
+    def push(self, epoch_ms: int, value: float) -> float:
+        items = self._items
+        while items and items[0][0] < epoch_ms - self.window_ms:
+            items.popleft()
+        if value == value: # Skip missing (NaN) readings
+            signed = self.sign * value
+            while items and items[-1][1] >= signed:
+                items.pop()
+            items.append((epoch_ms, signed))
+        return self.sign * items[0][1] if items else np.nan
+
+
+class _CompiledRules:
+    """A tenant's rules laid out as parallel arrays so each reading is checked against all of them at once."""
+
+    def __init__(self, rules: List[Dict[str, Any]], version: int):
+        self.version = version
+        self.rules = rules
+        self.channel = np.array([IOT_CHANNELS.index(r["channel"]) for r in rules], dtype=np.int64)
+        self.kind = np.array([RULE_KINDS.index(r["kind"]) for r in rules], dtype=np.int64)
+        self.sign = np.array([1.0 if r["direction"] in ("above", "rise") else -1.0 for r in rules])
+        self.value = np.array([r["value"] for r in rules], dtype=np.float64)
+        self.window_ms = np.array([r.get("window_s", 0) * 1000 for r in rules], dtype=np.float64)
+        self.cooldown_ms = np.array([r["cooldown_s"] * 1000 for r in rules], dtype=np.float64)
+        self.is_duration = self.kind == _KIND_DURATION
+        self.is_rate = self.kind == _KIND_RATE
+        # Rate rules sharing channel, window and direction share one sliding window per device
+        self.rate_groups: List[Tuple[int, int, bool]] = []
+        self.rate_group = np.full(len(rules), -1, dtype=np.int64)
+        for i, r in enumerate(rules):
+            if r["kind"] == "rate":
+                group = (IOT_CHANNELS.index(r["channel"]), int(r["window_s"] * 1000), r["direction"] == "fall")
+                if group not in self.rate_groups:
+                    self.rate_groups.append(group)
+                self.rate_group[i] = self.rate_groups.index(group)
+
+    def applies_to(self, device_id: str) -> np.ndarray:
+        return np.array([r.get("device_id") in (None, device_id) for r in self.rules], dtype=bool)
+
+
+class _DeviceRuleState:
+    """Per-device, per-rule state: when each condition started holding and when each rule may fire again."""
+    __slots__ = ("version", "applies", "since", "cooldown_until", "windows")
+
+    def __init__(self, compiled: _CompiledRules, device_id: str):
+        n = len(compiled.rules)
+        self.version = compiled.version
+        self.applies = compiled.applies_to(device_id)
+        self.since = np.full(n, np.nan)
+        self.cooldown_until = np.full(n, -np.inf)
+        self.windows = [_MonotonicWindow(window_ms, track_max) for _, window_ms, track_max in compiled.rate_groups]
+
+
+class IoTRuleEngine:
+    """
+    Evaluates tenant-defined alert rules incrementally as readings arrive:
+      - threshold: channel above/below value
+      - duration:  channel above/below value continuously for window_s
+      - rate:      channel rose/fell by at least value within window_s
+    State per device and rule is O(1) (rate rules keep an amortized O(1) monotonic window).
+    A firing rule is suppressed for cooldown_s per device, measured in reading time.
+    """
+
+    def __init__(self):
+        self._rules: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        self._compiled: Dict[int, _CompiledRules] = {}
+        self._states: Dict[Tuple[int, str], _DeviceRuleState] = {}
+        self._ids = itertools.count(1)
+        self._versions = itertools.count(1)
+
+    def add_rule(self, tenant_id: int, rule: Dict[str, Any]) -> Dict[str, Any]:
+        validate_rule(rule)
+        rule = {**rule, "id": next(self._ids)}
+        self._rules.setdefault(tenant_id, {})[rule["id"]] = rule
+        self._recompile(tenant_id)
+        return rule
+
+    def remove_rule(self, tenant_id: int, rule_id: int) -> bool:
+        if self._rules.get(tenant_id, {}).pop(rule_id, None) is None:
+            return False
+        self._recompile(tenant_id)
+        return True
+
+    def list_rules(self, tenant_id: int) -> List[Dict[str, Any]]:
+        return list(self._rules.get(tenant_id, {}).values())
+
+    def _recompile(self, tenant_id: int):
+        # Rule changes reset device state for the tenant; it is rebuilt lazily on the next reading
+        rules = self.list_rules(tenant_id)
+        if rules:
+            self._compiled[tenant_id] = _CompiledRules(rules, next(self._versions))
+        else:
+            self._compiled.pop(tenant_id, None)
+
+    def has_rules(self, tenant_id: int) -> bool:
+        return tenant_id in self._compiled
+
+    def evaluate(self, tenant_id: int, device_id: str, timestamps: np.ndarray, values: np.ndarray) -> List[Dict[str, Any]]:
+        """Feeds readings (values shaped (channels, n)) in order and returns the alerts that fired."""
+        compiled = self._compiled.get(tenant_id)
+        if compiled is None:
+            return []
+        state = self._states.get((tenant_id, device_id))
+        if state is None or state.version != compiled.version:
+            state = self._states[(tenant_id, device_id)] = _DeviceRuleState(compiled, device_id)
+        alerts = []
+        for i, epoch_ms in enumerate(timestamps.tolist()):
+            for index in self._step(compiled, state, epoch_ms, values[:, i]):
+                rule = compiled.rules[index]
+                alerts.append({
+                    "rule_id": rule["id"],
+                    "rule_name": rule["name"],
+                    "device_id": device_id,
+                    "timestamp_ms": epoch_ms,
+                    "channel": rule["channel"],
+                    "value": float(values[compiled.channel[index], i]),
+                    "line_user_id": rule.get("line_user_id"),
+                })
+        return alerts
+
+    @staticmethod
+    def _step(compiled: _CompiledRules, state: _DeviceRuleState, epoch_ms: int, column: np.ndarray) -> np.ndarray:
+        current = column[compiled.channel]
+        present = ~np.isnan(current)
+        reference = compiled.value
+        if state.windows:
+            extremes = np.array([window.push(epoch_ms, column[channel]) for window, (channel, _, _) in zip(state.windows, compiled.rate_groups)])
+            # Rate rules measure the change from the window's extreme; the others compare with their value directly
+            reference = np.where(compiled.is_rate, extremes[compiled.rate_group], compiled.value)
+        with np.errstate(invalid="ignore"):
+            change = compiled.sign * (current - reference)
+            holds = np.where(compiled.is_rate, change >= compiled.value, change > 0) & present & state.applies
+        # Duration tracking: start the clock when a condition begins, clear it when a present reading breaks it
+        state.since = np.where(holds, np.where(np.isnan(state.since), float(epoch_ms), state.since), np.where(present, np.nan, state.since))
+        met = holds & (~compiled.is_duration | (epoch_ms - state.since >= compiled.window_ms))
+        fired = np.flatnonzero(met & (epoch_ms >= state.cooldown_until))
+        state.cooldown_until[fired] = epoch_ms + compiled.cooldown_ms[fired]
+        return fired
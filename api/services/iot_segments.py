@@ -0,0 +1,320 @@
+import asyncio
+import mmap
+import os
+import threading
+import time
+import numpy as np
+from urllib.parse import quote, unquote
+from typing import Dict, List, Optional, Tuple
+from api.services.iot_store import IOT_CHANNELS, IoTTimeSeriesStore
+
+# Fixed-width little-endian record: epoch-ms timestamp followed by one float64 per channel (40 bytes)
+SEGMENT_RECORD = np.dtype([("timestamp_ms", "<i8")] + [(name, "<f8") for name in IOT_CHANNELS])
+SEGMENT_SUFFIX = ".seg"
+# Every Nth timestamp of a segment is kept in memory as its sparse time index
+INDEX_STRIDE = 1024
+
+Columns = Tuple[np.ndarray, np.ndarray]
+
+def _empty_columns() -> Columns:
+    return np.empty(0, dtype=np.int64), np.empty((len(IOT_CHANNELS), 0), dtype=np.float64)
+
+def _to_columns(records: np.ndarray) -> Columns:
+    return records["timestamp_ms"].astype(np.int64), np.vstack([records[name] for name in IOT_CHANNELS])
+
+def _sorted_unique(timestamps: np.ndarray, values: np.ndarray) -> Columns:
+    """Sorts readings by time; on duplicate timestamps the one that came later in the input wins."""
+    if len(timestamps) < 2 or np.all(timestamps[1:] > timestamps[:-1]):
+        return timestamps, values
+    order = np.argsort(timestamps, kind="stable")
+    timestamps, values = timestamps[order], values[:, order]
+    keep = np.append(timestamps[1:] != timestamps[:-1], True)
+    return timestamps[keep], values[:, keep]
+
+def _merge_columns(pieces: List[Columns]) -> Columns:
+    """Merges time-ordered pieces given from oldest to newest write."""
+    pieces = [piece for piece in pieces if len(piece[0])]
+    if not pieces:
+        return _empty_columns()
+    if len(pieces) == 1:
+        return pieces[0]
+    return _sorted_unique(np.concatenate([piece[0] for piece in pieces]), np.concatenate([piece[1] for piece in pieces], axis=1))
+
+
+class _Segment:
+    """One append-only segment file: strictly increasing records plus its sparse time index."""
+    __slots__ = ("path", "seq", "count", "min_ts", "max_ts", "sparse", "_records")
+
+    def __init__(self, path: str, seq: int):
+        self.path = path
+        self.seq = seq
+        self.count = 0
+        self.min_ts = 0
+        self.max_ts = 0
+        self.sparse = np.empty(0, dtype=np.int64)
+        self._records: Optional[np.ndarray] = None
+
+    def records(self) -> np.ndarray:
+        """Zero-copy structured view over the memory-mapped file."""
+        if self._records is None or len(self._records) != self.count:
+            with open(self.path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # The mapping stays alive for as long as views into it exist
+            self._records = np.frombuffer(mapped, dtype=SEGMENT_RECORD, count=self.count)
+        return self._records
+
+    def load(self):
+        self.count = os.path.getsize(self.path) // SEGMENT_RECORD.itemsize
+        self._records = None
+        if self.count:
+            timestamps = self.records()["timestamp_ms"]
+            self.min_ts, self.max_ts = int(timestamps[0]), int(timestamps[-1])
+            self.sparse = timestamps[::INDEX_STRIDE].astype(np.int64)
+
+    def append(self, records: np.ndarray):
+        with open(self.path, "ab") as f:
+            f.write(records.tobytes())
+        first_new = -(-self.count // INDEX_STRIDE) * INDEX_STRIDE # First index stride position not yet indexed
+        if self.count == 0:
+            self.min_ts = int(records["timestamp_ms"][0])
+        self.sparse = np.concatenate((self.sparse, records["timestamp_ms"][first_new - self.count::INDEX_STRIDE].astype(np.int64)))
+        self.count += len(records)
+        self.max_ts = int(records["timestamp_ms"][-1])
+
+
+
+class _SegmentView:
+    """
+    A segment as it was when taken under the store lock. It holds its own mapping, which keeps the data
+    readable after compaction removes or replaces the file (an unlinked file lives on while mapped).
+    """
+    __slots__ = ("records", "sparse", "min_ts", "max_ts")
+
+    def __init__(self, segment: _Segment):
+        self.records = segment.records()
+        self.sparse = segment.sparse
+        self.min_ts = segment.min_ts
+        self.max_ts = segment.max_ts
+
+    def search(self, epoch_ms: int, side: str) -> int:
+        """Binary search through the sparse index, then within a single INDEX_STRIDE block of the mapped file."""
+        block = int(np.searchsorted(self.sparse, epoch_ms, side=side))
+        if block == 0:
+            return 0
+        start = (block - 1) * INDEX_STRIDE
+        end = min(block * INDEX_STRIDE, len(self.records))
+        return start + int(np.searchsorted(self.records["timestamp_ms"][start:end], epoch_ms, side=side))
+
+
+class IoTSegmentStore:
+    """
+    On-disk storage for long-term IoT history: per-device append-only segment files of SEGMENT_RECORD
+    records under root/<tenant_id>/<device_id>/<seq>.seg. Each segment is strictly time-ordered; a batch
+    that is not newer than the active segment starts a new one, so segments may overlap and reads merge
+    them (later segments win on duplicate timestamps). Reads go through mmap and numpy.frombuffer
+    on views taken under the lock, so they may run while compact() merges small segments and drops
+    those past the retention window.
+    """
+
+    def __init__(self, root: str, segment_max_records: int = 1_000_000, retention_days: int = 180):
+        self.root = root
+        self.segment_max_records = segment_max_records
+        self.retention_days = retention_days
+        self._devices: Dict[Tuple[int, str], List[_Segment]] = {}
+        self._lock = threading.Lock()
+        self._compaction_task: Optional[asyncio.Task] = None
+
+    def _device_dir(self, tenant_id: int, device_id: str) -> str:
+        return os.path.join(self.root, str(tenant_id), quote(device_id, safe=""))
+
+    def _segments(self, tenant_id: int, device_id: str) -> List[_Segment]:
+        """Returns the device's segments ordered by sequence, loading their index from disk on first use."""
+        key = (tenant_id, device_id)
+        segments = self._devices.get(key)
+        if segments is None:
+            segments = []
+            directory = self._device_dir(tenant_id, device_id)
+            if os.path.isdir(directory):
+                for name in sorted(os.listdir(directory)):
+                    if name.endswith(SEGMENT_SUFFIX):
+                        segment = _Segment(os.path.join(directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+                        segment.load()
+                        if segment.count:
+                            segments.append(segment)
+            self._devices[key] = segments
+        return segments
+
+    def _new_segment(self, tenant_id: int, device_id: str, segments: List[_Segment]) -> _Segment:
+        directory = self._device_dir(tenant_id, device_id)
+        os.makedirs(directory, exist_ok=True)
+        seq = segments[-1].seq + 1 if segments else 0
+        segment = _Segment(os.path.join(directory, f"{seq:08d}{SEGMENT_SUFFIX}"), seq)
+        segments.append(segment)
+        return segment
+
+    def has_device(self, tenant_id: int, device_id: str) -> bool:
+        with self._lock:
+            return bool(self._segments(tenant_id, device_id))
+
+    def devices(self, tenant_id: int) -> List[str]:
+        """Lists the device_ids with history on disk for a tenant."""
+        directory = os.path.join(self.root, str(tenant_id))
+        if not os.path.isdir(directory):
+            return []
+        return sorted(unquote(name) for name in os.listdir(directory))
+
+    def append(self, tenant_id: int, device_id: str, timestamps: np.ndarray, values: np.ndarray):
+        """Appends a batch of readings; the batch is sorted and deduplicated (last reading wins) first."""
+        if len(timestamps) == 0:
+            return
+        timestamps, values = _sorted_unique(timestamps, values)
+        records = np.empty(len(timestamps), dtype=SEGMENT_RECORD)
+        records["timestamp_ms"] = timestamps
+        for i, name in enumerate(IOT_CHANNELS):
+            records[name] = values[i]
+        with self._lock:
+            segments = self._segments(tenant_id, device_id)
+            active = segments[-1] if segments else None
+            if active is None or active.count >= self.segment_max_records or records["timestamp_ms"][0] <= active.max_ts:
+                active = self._new_segment(tenant_id, device_id, segments)
+            active.append(records)
+
+    def read_range(self, tenant_id: int, device_id: str, since_ms: Optional[int] = None, until_ms: Optional[int] = None) -> Columns:
+        """Returns readings with since_ms <= timestamp <= until_ms in chronological order."""
+        with self._lock:
+            segments = [_SegmentView(segment) for segment in self._segments(tenant_id, device_id)
+                        if not ((since_ms is not None and segment.max_ts < since_ms) or (until_ms is not None and segment.min_ts > until_ms))]
+        pieces = []
+        for segment in segments:
+            lo = segment.search(since_ms, "left") if since_ms is not None else 0
+            hi = segment.search(until_ms, "right") if until_ms is not None else len(segment.records)
+            pieces.append(_to_columns(segment.records[lo:hi]))
+        return _merge_columns(pieces)
+
+    def tail_before(self, tenant_id: int, device_id: str, before_ms: Optional[int], k: int) -> Columns:
+        """Returns the latest k readings strictly older than before_ms (or overall when None)."""
+        with self._lock:
+            segments = [_SegmentView(segment) for segment in self._segments(tenant_id, device_id)
+                        if before_ms is None or segment.min_ts < before_ms]
+        pieces = []
+        for segment in segments:
+            hi = segment.search(before_ms, "left") if before_ms is not None else len(segment.records)
+            pieces.append(_to_columns(segment.records[max(0, hi - k):hi]))
+        timestamps, values = _merge_columns(pieces)
+        return timestamps[-k:], values[:, -k:]
+
+    def compact(self, tenant_id: int, device_id: str, now_ms: Optional[int] = None) -> Dict[str, int]:
+        """
+        Drops segments entirely older than the retention window, trims expired records from the rest
+        and merges runs of small segments (under a quarter of segment_max_records) into one.
+        """
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        cutoff_ms = now_ms - self.retention_days * 86_400_000
+        small = self.segment_max_records // 4
+        removed = merged = 0
+        with self._lock:
+            segments = self._segments(tenant_id, device_id)
+            for segment in [s for s in segments if s.max_ts < cutoff_ms]:
+                os.remove(segment.path)
+                segments.remove(segment)
+                removed += 1
+
+            runs: List[List[_Segment]] = [[]]
+            for segment in segments:
+                if segment.count < small or segment.min_ts < cutoff_ms:
+                    runs[-1].append(segment)
+                elif runs[-1]:
+                    runs.append([])
+            for run in runs:
+                if not run or (len(run) == 1 and run[0].min_ts >= cutoff_ms):
+                    continue
+                timestamps, values = _merge_columns([_to_columns(segment.records()) for segment in run])
+                keep = timestamps >= cutoff_ms
+                records = np.empty(int(keep.sum()), dtype=SEGMENT_RECORD)
+                records["timestamp_ms"] = timestamps[keep]
+                for i, name in enumerate(IOT_CHANNELS):
+                    records[name] = values[i][keep]
+                # The merged file takes the newest sequence of the run so write precedence is preserved
+                target = run[-1]
+                temp_path = target.path + ".compact"
+                with open(temp_path, "wb") as f:
+                    f.write(records.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, target.path)
+                for segment in run[:-1]:
+                    os.remove(segment.path)
+                    segments.remove(segment)
+                target.load()
+                if not target.count:
+                    os.remove(target.path)
+                    segments.remove(target)
+                merged += len(run)
+        return {"removed_segments": removed, "merged_segments": merged}
+
+    def compact_all(self) -> Dict[str, int]:
+        totals = {"removed_segments": 0, "merged_segments": 0}
+        if not os.path.isdir(self.root):
+            return totals
+        for tenant_dir in os.listdir(self.root):
+            if not tenant_dir.isdigit():
+                continue
+            for device_id in self.devices(int(tenant_dir)):
+                for key, value in self.compact(int(tenant_dir), device_id).items():
+                    totals[key] += value
+        return totals
+
+    async def start_compaction(self, interval_s: int):
+        """Runs compact_all() in a worker thread every interval_s seconds."""
+        async def _loop():
+            while True:
+                await asyncio.sleep(interval_s)
+                try:
+                    result = await asyncio.to_thread(self.compact_all)
+                    print(f"IoT segment compaction finished: {result}")
+                except Exception as e:
+                    print(f"IoT segment compaction failed: {e}")
+        if self._compaction_task is None:
+            self._compaction_task = asyncio.create_task(_loop())
+
+    async def stop_compaction(self):
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+            try:
+                await self._compaction_task
+            except asyncio.CancelledError:
+                pass
+            self._compaction_task = None
+
+
+def read_history(store: IoTTimeSeriesStore, segments: Optional[IoTSegmentStore], tenant_id: int, device_id: str,
+                 since_ms: Optional[int] = None, until_ms: Optional[int] = None) -> Optional[Columns]:
+    """
+    Reads [since_ms, until_ms] across hot and cold storage. The in-memory series is authoritative from
+    its oldest reading onward; older readings come from segments. Returns None for an unknown device.
+    """
+    series = store.get_series(tenant_id, device_id)
+    hot_oldest = series.first_timestamp if series is not None else None
+    pieces = []
+    if segments is not None and (hot_oldest is None or since_ms is None or since_ms < hot_oldest):
+        cold_until = until_ms if hot_oldest is None else (hot_oldest - 1 if until_ms is None else min(until_ms, hot_oldest - 1))
+        if segments.has_device(tenant_id, device_id):
+            pieces.append(segments.read_range(tenant_id, device_id, since_ms, cold_until))
+        elif series is None:
+            return None
+    elif series is None:
+        return None
+    if series is not None:
+        pieces.append(series.window(since_ms, until_ms))
+    return _merge_columns(pieces)
+
+def read_latest(store: IoTTimeSeriesStore, segments: Optional[IoTSegmentStore], tenant_id: int, device_id: str, k: int) -> Optional[Columns]:
+    """Returns the latest k readings, topping up from segments when memory holds fewer than k."""
+    series = store.get_series(tenant_id, device_id)
+    hot = series.tail(k) if series is not None else None
+    if hot is not None and len(hot[0]) >= k:
+        return hot
+    if segments is None or not segments.has_device(tenant_id, device_id):
+        return hot
+    cold = segments.tail_before(tenant_id, device_id, series.first_timestamp if series is not None else None, k - (len(hot[0]) if hot else 0))
+    return _merge_columns([cold, hot]) if hot is not None else cold
@@ -0,0 +1,134 @@
+import time
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+from api.services.iot_store import IOT_CHANNELS, from_epoch_ms
+
+HOUR_MS = 3_600_000
+DAY_MS = 86_400_000
+
+
+class _PeriodStats:
+    """
+    Running count/mean/M2/min/max per channel for one hour or day, reset when a new period starts.
+    Batches are folded in with the Chan et al. pairwise form of Welford's update, so a batch of one
+    reading is exactly Welford's recurrence and larger batches cost one vectorized pass.
+    """
+    __slots__ = ("period_ms", "offset_ms", "period", "count", "mean", "m2", "min", "max")
+
+    def __init__(self, period_ms: int, offset_ms: int):
+        self.period_ms = period_ms
+        self.offset_ms = offset_ms
+        self.period = -1
+        self._reset(-1)
+
+    def _reset(self, period: int):
+        channels = len(IOT_CHANNELS)
+        self.period = period
+        self.count = np.zeros(channels, dtype=np.int64)
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+        self.min = np.full(channels, np.nan)
+        self.max = np.full(channels, np.nan)
+
+    def period_of(self, epoch_ms: np.ndarray) -> np.ndarray:
+        return (epoch_ms + self.offset_ms) // self.period_ms
+
+    def update(self, timestamps: np.ndarray, values: np.ndarray):
+        periods = self.period_of(timestamps)
+        # Readings for a period that has already been reset no longer count
+        for period in np.unique(periods[periods >= self.period]).tolist():
+            if period != self.period:
+                self._reset(period)
+            self._add(values[:, periods == period])
+
+    def _add(self, values: np.ndarray):
+        present = ~np.isnan(values)
+        count_b = present.sum(axis=1)
+        if not count_b.any():
+            return
+        filled = np.where(present, values, 0.0)
+        mean_b = filled.sum(axis=1) / np.maximum(count_b, 1)
+        m2_b = (np.where(present, values - mean_b[:, None], 0.0) ** 2).sum(axis=1)
+        count = self.count + count_b
+        delta = mean_b - self.mean
+        safe = np.maximum(count, 1)
+        self.mean = self.mean + delta * count_b / safe
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.count * count_b / safe
+        self.count = count
+        self.min = np.fmin(self.min, np.fmin.reduce(values, axis=1))
+        self.max = np.fmax(self.max, np.fmax.reduce(values, axis=1))
+
+    def summary(self, now_ms: int) -> Dict[str, Any]:
+        """Per-channel count, min, max, mean and (population) stddev for the period containing now_ms."""
+        current = int(self.period_of(np.int64(now_ms)))
+        channels = {}
+        for i, name in enumerate(IOT_CHANNELS):
+            count = int(self.count[i]) if self.period == current else 0
+            channels[name] = {
+                "count": count,
+                "min": float(self.min[i]) if count else None,
+                "max": float(self.max[i]) if count else None,
+                "mean": float(self.mean[i]) if count else None,
+                "stddev": float(np.sqrt(self.m2[i] / count)) if count else None,
+            }
+        return {"since": from_epoch_ms(current * self.period_ms - self.offset_ms), "channels": channels}
+
+
+class DeviceRunningStats:
+    """Running summaries of one device: the current hour, the current day and the last reading time."""
+    __slots__ = ("hourly", "daily", "last_seen_ms", "total_readings")
+
+    def __init__(self, offset_ms: int = 0):
+        self.hourly = _PeriodStats(HOUR_MS, offset_ms)
+        self.daily = _PeriodStats(DAY_MS, offset_ms)
+        self.last_seen_ms: Optional[int] = None
+        self.total_readings = 0
+
+    def update(self, timestamps: np.ndarray, values: np.ndarray):
+        if len(timestamps) == 0:
+            return
+        self.hourly.update(timestamps, values)
+        self.daily.update(timestamps, values)
+        newest = int(timestamps.max())
+        self.last_seen_ms = newest if self.last_seen_ms is None else max(self.last_seen_ms, newest)
+        self.total_readings += len(timestamps)
+
+
+class IoTDeviceStatsStore:
+    """
+    O(1)-per-read running statistics for every device, keyed by (tenant_id, device_id) and updated
+    on ingest. Hours and days are aligned to UTC shifted by utc_offset_minutes (e.g. 480 for local
+    midnight in Taiwan); a period with no readings yet reports empty channels.
+    """
+
+    def __init__(self, utc_offset_minutes: int = 0):
+        self.offset_ms = utc_offset_minutes * 60_000
+        self._devices: Dict[Tuple[int, str], DeviceRunningStats] = {}
+
+    def clear(self):
+        self._devices.clear()
+
+    def update(self, tenant_id: int, device_id: str, timestamps: np.ndarray, values: np.ndarray):
+        stats = self._devices.get((tenant_id, device_id))
+        if stats is None:
+            stats = self._devices[(tenant_id, device_id)] = DeviceRunningStats(self.offset_ms)
+        stats.update(timestamps, values)
+
+    def summary(self, tenant_id: int, device_id: str, now_ms: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Returns the device summary, or None if the device has never reported."""
+        stats = self._devices.get((tenant_id, device_id))
+        if stats is None:
+            return None
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        return {
+            "device_id": device_id,
+            "last_seen": from_epoch_ms(stats.last_seen_ms),
+            "total_readings": stats.total_readings,
+            "hourly": stats.hourly.summary(now_ms),
+            "daily": stats.daily.summary(now_ms),
+        }
+
+    def summaries(self, tenant_id: int, now_ms: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Summaries of all of a tenant's devices, ordered by device_id."""
+        device_ids = sorted(device_id for tenant, device_id in self._devices if tenant == tenant_id)
+        return [self.summary(tenant_id, device_id, now_ms) for device_id in device_ids]
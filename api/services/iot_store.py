@@ -0,0 +1,223 @@
+import numpy as np
+import datetime
+from typing import Dict, List, Optional, Tuple
+from api.schemas import IoTData
+
+# Sensor channels stored as columns, in this order, for every device series
+IOT_CHANNELS: Tuple[str, ...] = ("temperature", "humidity", "soil_moisture", "light_intensity")
+
+def to_epoch_ms(timestamp: datetime.datetime) -> int:
+    """Converts a datetime to UTC epoch milliseconds (naive datetimes are treated as UTC)."""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+def from_epoch_ms(epoch_ms: int) -> datetime.datetime:
+    """Converts UTC epoch milliseconds back to an aware datetime."""
+    return datetime.datetime.fromtimestamp(epoch_ms / 1000, tz=datetime.timezone.utc)
+
+def _build_iot_data(device_id: str, epoch_ms: int, column: np.ndarray) -> IoTData:
+    fields = {name: (None if np.isnan(column[i]) else float(column[i])) for i, name in enumerate(IOT_CHANNELS)}
+    return IoTData(device_id=device_id, timestamp=from_epoch_ms(epoch_ms), **fields)
+
+def to_iot_data(device_id: str, timestamps: np.ndarray, values: np.ndarray) -> List[IoTData]:
+    """Materializes columnar slices into IoTData objects at the response edge."""
+    return [_build_iot_data(device_id, int(timestamps[i]), values[:, i]) for i in range(len(timestamps))]
+
+
+class DeviceSeries:
+    """
+    Fixed-capacity ring buffer holding one device's readings as columns, kept ordered by timestamp.
+    Timestamps are int64 epoch milliseconds; channel values are float64 with NaN marking missing values.
+    Once full, the oldest reading is overwritten, so memory stays bounded at
+    capacity * (8 + 8 * len(IOT_CHANNELS)) bytes per device.
+    In-order readings append in O(1); late readings are merged into place and a reading with
+    the same timestamp as a stored one replaces it, so each timestamp appears at most once.
+    """
+    __slots__ = ("device_id", "capacity", "timestamps", "values", "_head", "_size")
+
+    def __init__(self, device_id: str, capacity: int):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.device_id = device_id
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.full((len(IOT_CHANNELS), capacity), np.nan, dtype=np.float64)
+        self._head = 0 # Next write position
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index: int) -> IoTData:
+        """Builds a single IoTData for the reading at a chronological index (supports negative indices)."""
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("reading index out of range")
+        pos = (self._head - self._size + index) % self.capacity
+        return self._build(int(self.timestamps[pos]), self.values[:, pos])
+
+    @property
+    def first_timestamp(self) -> Optional[int]:
+        return int(self.timestamps[(self._head - self._size) % self.capacity]) if self._size else None
+
+    @property
+    def last_timestamp(self) -> Optional[int]:
+        return int(self.timestamps[(self._head - 1) % self.capacity]) if self._size else None
+
+    def append(self, epoch_ms: int, readings: Tuple[Optional[float], ...]):
+        """Appends one reading; O(1) when it is newer than every stored reading."""
+        if self._size and epoch_ms <= self.timestamps[(self._head - 1) % self.capacity]:
+            column = np.array([[np.nan if value is None else value] for value in readings], dtype=np.float64)
+            self._merge(np.array([epoch_ms], dtype=np.int64), column)
+            return
+        pos = self._head
+        self.timestamps[pos] = epoch_ms
+        column = self.values[:, pos]
+        for i, value in enumerate(readings):
+            column[i] = np.nan if value is None else value
+        self._head = (pos + 1) % self.capacity
+        if self._size < self.capacity:
+            self._size += 1
+
+    def extend(self, timestamps: np.ndarray, values: np.ndarray):
+        """Appends a batch of readings (values shaped (channels, n)), merging it into place if it is not strictly newer."""
+        if len(timestamps) == 0:
+            return
+        in_order = len(timestamps) == 1 or bool(np.all(timestamps[1:] > timestamps[:-1]))
+        if not in_order or (self._size and timestamps[0] <= self.timestamps[(self._head - 1) % self.capacity]):
+            self._merge(timestamps, values)
+            return
+        self._write(timestamps, values)
+
+    def _write(self, timestamps: np.ndarray, values: np.ndarray):
+        """Writes strictly increasing readings after the newest stored one with at most two slice copies."""
+        n = len(timestamps)
+        if n >= self.capacity:
+            # Only the newest 'capacity' readings survive; lay them out from position 0
+            self.timestamps[:] = timestamps[-self.capacity:]
+            self.values[:, :] = values[:, -self.capacity:]
+            self._head = 0
+            self._size = self.capacity
+            return
+        pos = self._head
+        first = min(n, self.capacity - pos)
+        self.timestamps[pos:pos + first] = timestamps[:first]
+        self.values[:, pos:pos + first] = values[:, :first]
+        if first < n:
+            self.timestamps[:n - first] = timestamps[first:]
+            self.values[:, :n - first] = values[:, first:]
+        self._head = (pos + n) % self.capacity
+        self._size = min(self._size + n, self.capacity)
+
+    def _merge(self, timestamps: np.ndarray, values: np.ndarray):
+        """
+        Sorted merge of late or unordered readings. Only the stored suffix newer than the batch's
+        oldest reading is rewritten, so cost is proportional to how late the batch is.
+        On duplicate timestamps the most recently received reading wins.
+        """
+        split = self._search(int(timestamps.min()), "left")
+        suffix_timestamps, suffix_values = self._slice(split, self._size)
+        merged_timestamps = np.concatenate((suffix_timestamps, timestamps))
+        merged_values = np.concatenate((suffix_values, values), axis=1)
+        order = np.argsort(merged_timestamps, kind="stable")
+        merged_timestamps, merged_values = merged_timestamps[order], merged_values[:, order]
+        keep = np.append(merged_timestamps[1:] != merged_timestamps[:-1], True)
+        # Drop the suffix and write the merged run back; overflow evicts the oldest readings
+        self._head = (self._head - (self._size - split)) % self.capacity
+        self._size = split
+        self._write(merged_timestamps[keep], merged_values[:, keep])
+
+    def _search(self, epoch_ms: int, side: str) -> int:
+        """Binary search for a timestamp over the logical (chronological) order of the ring."""
+        start = (self._head - self._size) % self.capacity
+        if start + self._size <= self.capacity:
+            return int(np.searchsorted(self.timestamps[start:start + self._size], epoch_ms, side=side))
+        older = self.timestamps[start:]
+        index = int(np.searchsorted(older, epoch_ms, side=side))
+        if index < len(older):
+            return index
+        return len(older) + int(np.searchsorted(self.timestamps[:self._head], epoch_ms, side=side))
+
+    def _slice(self, lo: int, hi: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Copies logical positions [lo, hi) out of the ring in chronological order."""
+        k = max(0, hi - lo)
+        start = (self._head - self._size + lo) % self.capacity
+        if start + k <= self.capacity:
+            return self.timestamps[start:start + k].copy(), self.values[:, start:start + k].copy()
+        first = self.capacity - start
+        timestamps = np.concatenate((self.timestamps[start:], self.timestamps[:k - first]))
+        values = np.concatenate((self.values[:, start:], self.values[:, :k - first]), axis=1)
+        return timestamps, values
+
+    def tail(self, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the latest k readings in chronological order as (timestamps, values) arrays in O(k)."""
+        k = max(0, min(k, self._size))
+        return self._slice(self._size - k, self._size)
+
+    def window(self, since_ms: Optional[int] = None, until_ms: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns readings with since_ms <= timestamp <= until_ms, located by binary search, in O(log n + k)."""
+        lo = self._search(since_ms, "left") if since_ms is not None else 0
+        hi = self._search(until_ms, "right") if until_ms is not None else self._size
+        return self._slice(lo, hi)
+
+    def to_iot_data(self, timestamps: np.ndarray, values: np.ndarray) -> List[IoTData]:
+        return to_iot_data(self.device_id, timestamps, values)
+
+    def _build(self, epoch_ms: int, column: np.ndarray) -> IoTData:
+        return _build_iot_data(self.device_id, epoch_ms, column)
+
+
+class IoTTimeSeriesStore:
+    """
+    In-memory IoT store keyed by tenant_id, then device_id, with one DeviceSeries per device.
+    Indexing by tenant_id returns that tenant's {device_id: DeviceSeries} mapping.
+    """
+
+    def __init__(self, capacity: int = 8640):
+        self.capacity = capacity
+        self._tenants: Dict[int, Dict[str, DeviceSeries]] = {}
+
+    def __contains__(self, tenant_id: int) -> bool:
+        return tenant_id in self._tenants
+
+    def __getitem__(self, tenant_id: int) -> Dict[str, DeviceSeries]:
+        return self._tenants[tenant_id]
+
+    def clear(self):
+        self._tenants.clear()
+
+    def get_series(self, tenant_id: int, device_id: str) -> Optional[DeviceSeries]:
+        return self._tenants.get(tenant_id, {}).get(device_id)
+
+    def series(self, tenant_id: int, device_id: str) -> DeviceSeries:
+        """Returns the series for a device, creating an empty one on first use."""
+        devices = self._tenants.setdefault(tenant_id, {})
+        series = devices.get(device_id)
+        if series is None:
+            series = devices[device_id] = DeviceSeries(device_id, self.capacity)
+        return series
+
+    def append(self, tenant_id: int, data: IoTData):
+        """Appends a validated reading to its device series."""
+        readings = tuple(getattr(data, name) for name in IOT_CHANNELS)
+        self.series(tenant_id, data.device_id).append(to_epoch_ms(data.timestamp), readings)
+
+    def extend(self, tenant_id: int, device_id: str, timestamps: np.ndarray, values: np.ndarray):
+        """Appends a columnar batch of readings for one device."""
+        self.series(tenant_id, device_id).extend(timestamps, values)
+
+    def latest(self, tenant_id: int, device_id: str, limit: int) -> Optional[List[IoTData]]:
+        """Returns the latest 'limit' readings as IoTData, or None if the device is unknown."""
+        series = self.get_series(tenant_id, device_id)
+        if series is None:
+            return None
+        timestamps, values = series.tail(limit)
+        return series.to_iot_data(timestamps, values)
+
+
+def reading_columns(data: IoTData) -> Tuple[np.ndarray, np.ndarray]:
+    """Converts a single IoTData into (timestamps, values) columns of length one."""
+    values = np.array([[np.nan if getattr(data, name) is None else getattr(data, name)] for name in IOT_CHANNELS], dtype=np.float64)
+    return np.array([to_epoch_ms(data.timestamp)], dtype=np.int64), values
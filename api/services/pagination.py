@@ -0,0 +1,98 @@
+import base64
+import binascii
+import datetime
+import json
+from typing import Any, List, Optional, Tuple
+from sqlalchemy import Select, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Query
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(tenant_id: int, last_id: int, last_key: Any = None) -> str:
+    """Opaque token pointing just past 'last_id' (and its sort key, if the listing has one) in a tenant's listing."""
+    payload = {"t": tenant_id, "id": last_id}
+    if last_key is not None:
+        payload["k"] = last_key.isoformat() if isinstance(last_key, datetime.datetime) else last_key
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _decode(cursor: str, tenant_id: int) -> dict:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if payload["t"] != tenant_id or not isinstance(payload["id"], int):
+            raise ValueError
+    except (binascii.Error, UnicodeDecodeError, ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+    return payload
+
+
+def decode_cursor(cursor: str, tenant_id: int) -> int:
+    """Returns the last id seen; raises ValueError for malformed cursors or cursors of another tenant."""
+    return _decode(cursor, tenant_id)["id"]
+
+
+def _decode_sort_key(cursor: str, tenant_id: int, sort_column) -> Tuple[int, Any]:
+    payload = _decode(cursor, tenant_id)
+    if "k" not in payload:
+        raise ValueError("Invalid cursor") # Issued for a listing sorted by id only
+    last_key = payload["k"]
+    if last_key is not None and sort_column.type.python_type is datetime.datetime:
+        try:
+            last_key = datetime.datetime.fromisoformat(last_key)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+    return payload["id"], last_key
+
+
+def _seek(query, id_column, tenant_id: int, offset: int, cursor: Optional[str], sort_column, descending: bool):
+    # Works on an ORM Query and on a select() alike (both have order_by/filter/offset/limit)
+    order = [sort_column, id_column] if sort_column is not None else [id_column]
+    query = query.order_by(*[column.desc() if descending else column for column in order])
+    if cursor:
+        if offset:
+            raise ValueError("Use either cursor or offset, not both")
+        if sort_column is None:
+            last_id = decode_cursor(cursor, tenant_id)
+            query = query.filter(id_column < last_id if descending else id_column > last_id)
+        else:
+            last_id, last_key = _decode_sort_key(cursor, tenant_id, sort_column)
+            past_key = sort_column < last_key if descending else sort_column > last_key
+            past_id = id_column < last_id if descending else id_column > last_id
+            query = query.filter(or_(past_key, and_(sort_column == last_key, past_id)))
+    elif offset:
+        query = query.offset(offset)
+    return query
+
+
+def _page(rows: List[Any], tenant_id: int, limit: int, sort_column) -> Tuple[List[Any], Optional[str]]:
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last_key = getattr(rows[-1], sort_column.key) if sort_column is not None else None
+    return rows, encode_cursor(tenant_id, rows[-1].id, last_key)
+
+
+def paginate(query: Query, id_column, tenant_id: int, limit: int, offset: int = 0, cursor: Optional[str] = None,
+             sort_column=None, descending: bool = False) -> Tuple[List[Any], Optional[str]]:
+    """
+    Pages a tenant-filtered query ordered by id, or by (sort_column, id) when sort_column is given,
+    ascending or descending.
+    With a cursor, seeks past the last row seen ('id > last id', or the row-value equivalent on
+    (sort_column, id)) so every page costs the same on an index ending in those columns;
+    otherwise falls back to offset/limit. Either way returns (rows, next_cursor), where next_cursor is
+    None on the last page. Raises ValueError for an invalid cursor or a cursor combined with an offset.
+    sort_column must not be NULL for rows of the listing.
+    """
+    query = _seek(query, id_column, tenant_id, offset, cursor, sort_column, descending)
+    rows = query.limit(limit + 1).all() # One extra row tells whether another page exists
+    return _page(rows, tenant_id, limit, sort_column)
+
+
+async def paginate_async(db: AsyncSession, statement: Select, id_column, tenant_id: int, limit: int, offset: int = 0,
+                         cursor: Optional[str] = None, sort_column=None, descending: bool = False) -> Tuple[List[Any], Optional[str]]:
+    """paginate for an AsyncSession: pages the entities selected by a tenant-filtered select()."""
+    statement = _seek(statement, id_column, tenant_id, offset, cursor, sort_column, descending)
+    rows = (await db.execute(statement.limit(limit + 1))).scalars().all()
+    return _page(list(rows), tenant_id, limit, sort_column)
@@ -0,0 +1,164 @@
+import asyncio
+import multiprocessing
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Describes columns copied into one shared memory block: {"name": block name, "columns": [(column, dtype, shape, offset)]}
+ColumnSpec = Dict[str, Any]
+
+_ALIGNMENT = 64
+
+
+class ProcessPoolBusy(Exception):
+    """Raised when the analytics pool already has 'max_pending' tasks; callers should answer 503."""
+
+
+class ProcessPoolTimeout(Exception):
+    """Raised when an analytics task does not finish within its timeout."""
+
+
+def share_columns(columns: Dict[str, np.ndarray]) -> Tuple[SharedMemory, ColumnSpec]:
+    """
+    Copies numeric columns into one shared memory block so a worker process can map them without pickling.
+    The caller owns the block: close() and unlink() it once the task has finished.
+    """
+    arrays = {name: np.ascontiguousarray(column) for name, column in columns.items()}
+    for name, array in arrays.items():
+        if array.dtype.hasobject:
+            raise ValueError(f"Column '{name}' has dtype {array.dtype}; only numeric columns can be shared")
+    offsets, size = [], 0
+    for array in arrays.values():
+        offsets.append(size)
+        size += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+    shm = SharedMemory(create=True, size=max(size, 1))
+    spec = {"name": shm.name, "columns": []}
+    for (name, array), offset in zip(arrays.items(), offsets):
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf, offset=offset)[...] = array
+        spec["columns"].append((name, array.dtype.str, array.shape, offset))
+    return shm, spec
+
+
+def attach_columns(spec: ColumnSpec) -> Tuple[SharedMemory, Dict[str, np.ndarray]]:
+    """
+    Maps columns shared with share_columns as zero-copy arrays (in the worker process).
+    Drop every array (and anything viewing them) before calling close() on the returned block.
+    """
+    shm = SharedMemory(name=spec["name"])
+    columns = {
+        name: np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+        for name, dtype, shape, offset in spec["columns"]
+    }
+    return shm, columns
+
+
+class AnalyticsProcessPool:
+    """
+    Managed ProcessPoolExecutor for CPU-heavy pandas/NumPy work, so it neither blocks the event loop
+    nor holds the GIL that the thread pool serving sync endpoints needs.
+    At most 'max_pending' tasks are queued or running; further submissions raise ProcessPoolBusy.
+    A task exceeding its timeout raises ProcessPoolTimeout to the caller; the worker finishes it in the
+    background and it keeps its slot (and its shared memory) until then.
+    When the pool is not started (e.g. disabled), tasks run in the default thread pool instead.
+    Started and stopped from api/main.py.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 8, task_timeout_s: float = 60.0):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.task_timeout_s = task_timeout_s
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "timed_out": 0,
+                       "last_task_ms": 0.0, "max_task_ms": 0.0, "total_task_ms": 0.0}
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def start(self):
+        if self._executor is not None:
+            return
+        # spawn: workers never inherit locks, sockets or DB connections held by this process
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        print(f"Analytics process pool started (max_workers={self.max_workers}, max_pending={self.max_pending})")
+
+    def stop(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+        print("Analytics process pool stopped.")
+
+    async def submit(self, fn: Callable, *args, timeout_s: Optional[float] = None, on_done: Optional[Callable[[], None]] = None) -> Any:
+        """
+        Runs fn(*args) in a worker process (fn and args must be picklable) and awaits its result.
+        on_done() runs once the task has really finished, even after the caller gave up on a timeout,
+        or right away when the task is not accepted.
+        """
+        if self._pending >= self.max_pending:
+            self._stats["rejected"] += 1
+            if on_done is not None:
+                on_done()
+            raise ProcessPoolBusy(f"Analytics pool is busy ({self._pending} tasks pending)")
+        timeout_s = self.task_timeout_s if timeout_s is None else timeout_s
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(self._executor, fn, *args)
+        except Exception:
+            self._stats["failed"] += 1
+            if on_done is not None:
+                on_done()
+            raise
+        # A timed-out task keeps running in its worker, so its slot is only released when the worker is done with it
+        self._pending += 1
+        future.add_done_callback(lambda future: self._task_done(future, on_done))
+        self._stats["submitted"] += 1
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout_s)
+        except asyncio.TimeoutError:
+            self._stats["timed_out"] += 1
+            raise ProcessPoolTimeout(f"Analytics task {getattr(fn, '__name__', fn)} exceeded {timeout_s}s")
+        except Exception:
+            self._stats["failed"] += 1
+            raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._stats["completed"] += 1
+        self._stats["last_task_ms"] = elapsed_ms
+        self._stats["max_task_ms"] = max(self._stats["max_task_ms"], elapsed_ms)
+        self._stats["total_task_ms"] += elapsed_ms
+        return result
+
+    def _task_done(self, future: asyncio.Future, on_done: Optional[Callable[[], None]]):
+        self._pending -= 1
+        if not future.cancelled():
+            future.exception() # Retrieved here, so the error of a task nobody awaits any more is not reported as unhandled
+        if on_done is not None:
+            on_done()
+
+    async def submit_columns(self, fn: Callable, columns: Dict[str, np.ndarray], *args, timeout_s: Optional[float] = None) -> Any:
+        """
+        Like submit, but ships numeric columns through shared memory: fn receives a ColumnSpec
+        (to pass to attach_columns) followed by args. The block is released once the worker is done with it.
+        """
+        shm, spec = share_columns(columns)
+
+        def release():
+            shm.close()
+            shm.unlink()
+
+        return await self.submit(fn, spec, *args, timeout_s=timeout_s, on_done=release)
+
+    def stats(self) -> Dict[str, Any]:
+        completed = self._stats["completed"]
+        return {
+            "running": self.running,
+            "max_workers": self.max_workers,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "avg_task_ms": self._stats["total_task_ms"] / completed if completed else 0.0,
+            **{key: value for key, value in self._stats.items() if key != "total_task_ms"},
+        }
@@ -0,0 +1,309 @@
+import asyncio
+import re
+import sys
+import threading
+import time
+import unicodedata
+import numpy as np
+from array import array
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Gram codes: 3 tag bits above two 21-bit code points (every Unicode code point fits in 21 bits)
+_CHAR_BITS = 21
+_TAG_SHIFT = 2 * _CHAR_BITS
+_UNIGRAM, _BIGRAM, _PREFIX1, _PREFIX2 = 1, 2, 3, 4
+_WORD = re.compile(r"\w+")
+_FIRST_CHUNK = 64 # Candidates checked per step while scanning a posting list; doubles each step
+
+ProductRow = Tuple[int, Optional[str]] # (product id, name)
+RowLoader = Callable[[], Awaitable[Sequence[ProductRow]]]
+
+
+def normalize(text: Optional[str]) -> str:
+    """Search key of a name or query: NFKC (full-width -> half-width), case-folded words joined by single spaces."""
+    return " ".join(_WORD.findall(unicodedata.normalize("NFKC", text or "").casefold()))
+
+
+def _code(tag: int, first: int, second: int = 0) -> int:
+    return (tag << _TAG_SHIFT) | (first << _CHAR_BITS) | second
+
+
+def _grams(key: str) -> List[int]:
+    """Gram codes of a normalized name: every character, every adjacent pair within a word, and its first one and two characters."""
+    if not key:
+        return []
+    grams = {_code(_PREFIX1, ord(key[0]))}
+    if len(key) > 1 and key[1] != " ":
+        grams.add(_code(_PREFIX2, ord(key[0]), ord(key[1])))
+    for word in key.split(" "):
+        grams.update(_code(_UNIGRAM, 0, ord(char)) for char in word)
+        grams.update(_code(_BIGRAM, ord(a), ord(b)) for a, b in zip(word, word[1:]))
+    return sorted(grams)
+
+
+def _query_grams(words: List[str]) -> Tuple[List[int], int]:
+    """Codes a match must contain (bigrams, or the unigram of one-character words) and the code of the prefix."""
+    grams = set()
+    for word in words:
+        if len(word) == 1:
+            grams.add(_code(_UNIGRAM, 0, ord(word)))
+        grams.update(_code(_BIGRAM, ord(a), ord(b)) for a, b in zip(word, word[1:]))
+    first = words[0]
+    prefix = _code(_PREFIX2, ord(first[0]), ord(first[1])) if len(first) > 1 else _code(_PREFIX1, ord(first[0]))
+    return sorted(grams), prefix
+
+
+class _TenantIndex:
+    """
+    One tenant's index. The base part is built in bulk with its documents ordered by (name length, product id),
+    so scanning any posting list in document order visits shorter (better ranked) names first; its postings are
+    slices of one int32 array addressed through a sorted array of gram codes. Products added afterwards go to a
+    small append-only delta with per-gram arrays, scanned in full and merged by rank.
+    """
+
+    def __init__(self, rows: Sequence[ProductRow]):
+        started = time.perf_counter()
+        product_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        names = [row[1] or "" for row in rows]
+        keys = [normalize(name) for name in names]
+        lengths = np.fromiter((len(key) for key in keys), dtype=np.int32, count=len(keys))
+        order = np.lexsort((product_ids, lengths))
+        self.product_ids = product_ids[order]
+        self.lengths = lengths[order]
+        names = [names[i] for i in order.tolist()]
+        keys = [keys[i] for i in order.tolist()]
+        encoded = [name.encode() for name in names]
+        self.names = b"".join(encoded)
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=self.offsets[1:])
+        self.gram_codes, self.gram_starts, self.postings = self._build_postings(keys)
+        self.size = len(self.product_ids)
+        # Delta: products added since the build, numbered from self.size on
+        self.delta_ids: List[int] = []
+        self.delta_names: List[str] = []
+        self.delta_lengths: List[int] = []
+        self.delta_postings: Dict[int, array] = {}
+        self.built_at = time.time()
+        self.build_ms = (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def _build_postings(keys: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        if not keys:
+            return empty
+        # All keys as one array of code points, each followed by a separator (code point 0)
+        chars = np.frombuffer("\0".join(keys).encode("utf-32-le") + b"\0\0\0\0", dtype=np.uint32).astype(np.int64)
+        lengths = np.fromiter((len(key) for key in keys), dtype=np.int64, count=len(keys))
+        docs = np.repeat(np.arange(len(keys), dtype=np.int64), lengths + 1)
+        starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1]))
+        in_word = (chars != 0) & (chars != ord(" "))
+        first, second = chars[:-1], chars[1:]
+        pair = in_word[:-1] & in_word[1:]
+        has = lengths > 0
+        has_two = (lengths > 1) & pair[np.minimum(starts, len(pair) - 1)]
+        codes = np.concatenate((
+            (_UNIGRAM << _TAG_SHIFT) | chars[in_word],
+            (_BIGRAM << _TAG_SHIFT) | (first[pair] << _CHAR_BITS) | second[pair],
+            (_PREFIX1 << _TAG_SHIFT) | (chars[starts[has]] << _CHAR_BITS),
+            (_PREFIX2 << _TAG_SHIFT) | (chars[starts[has_two]] << _CHAR_BITS) | chars[starts[has_two] + 1],
+        ))
+        gram_docs = np.concatenate((docs[in_word], docs[:-1][pair], np.flatnonzero(has), np.flatnonzero(has_two)))
+        # Sort by (code, doc) and drop repeated grams within a name
+        order = np.lexsort((gram_docs, codes))
+        codes, gram_docs = codes[order], gram_docs[order]
+        keep = np.ones(len(codes), dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (gram_docs[1:] != gram_docs[:-1])
+        codes, gram_docs = codes[keep], gram_docs[keep].astype(np.int32)
+        boundaries = np.flatnonzero(np.diff(codes)) + 1
+        gram_codes = codes[np.concatenate(([0], boundaries))] if len(codes) else codes
+        gram_starts = np.concatenate(([0], boundaries, [len(codes)])).astype(np.int64)
+        return gram_codes, gram_starts, gram_docs
+
+    def add(self, product_id: int, name: Optional[str]):
+        key = normalize(name)
+        doc = self.size + len(self.delta_ids)
+        self.delta_ids.append(product_id)
+        self.delta_names.append(name or "")
+        self.delta_lengths.append(len(key))
+        for code in _grams(key):
+            posting = self.delta_postings.get(code)
+            if posting is None:
+                posting = self.delta_postings[code] = array("i")
+            posting.append(doc)
+
+    def base_posting(self, code: int) -> np.ndarray:
+        i = int(np.searchsorted(self.gram_codes, code))
+        if i == len(self.gram_codes) or self.gram_codes[i] != code:
+            return self.postings[:0]
+        return self.postings[self.gram_starts[i]:self.gram_starts[i + 1]]
+
+    def delta_posting(self, code: int) -> np.ndarray:
+        return np.array(self.delta_postings.get(code, ()), dtype=np.int32)
+
+    def name(self, doc: int) -> str:
+        if doc < self.size:
+            return self.names[self.offsets[doc]:self.offsets[doc + 1]].decode()
+        return self.delta_names[doc - self.size]
+
+    def rank(self, doc: int) -> Tuple[int, int]:
+        if doc < self.size:
+            return int(self.lengths[doc]), int(self.product_ids[doc])
+        return self.delta_lengths[doc - self.size], self.delta_ids[doc - self.size]
+
+    def product_id(self, doc: int) -> int:
+        return int(self.product_ids[doc]) if doc < self.size else self.delta_ids[doc - self.size]
+
+    def contains(self, product_ids: np.ndarray) -> np.ndarray:
+        return np.isin(product_ids, self.product_ids) | np.isin(product_ids, np.array(self.delta_ids, dtype=np.int64))
+
+    def memory_bytes(self) -> Dict[str, int]:
+        base = sum(a.nbytes for a in (self.product_ids, self.lengths, self.offsets, self.gram_codes, self.gram_starts, self.postings))
+        delta = (sys.getsizeof(self.delta_postings) + sum(sys.getsizeof(p) for p in self.delta_postings.values())
+                 + sum(sys.getsizeof(name) for name in self.delta_names) + 3 * sys.getsizeof(self.delta_ids))
+        return {"names": len(self.names), "postings": base, "delta": delta, "total": len(self.names) + base + delta}
+
+
+def _scan(driver: np.ndarray, others: List[np.ndarray], accept: Callable[[int], bool], want: Optional[int], skip: set) -> List[int]:
+    """Documents of 'driver' present in every posting of 'others' and accepted, in document order; stops after 'want'."""
+    hits, start, chunk_size = [], 0, _FIRST_CHUNK
+    while start < len(driver):
+        chunk = driver[start:start + chunk_size]
+        start += chunk_size
+        chunk_size *= 2
+        for other in others:
+            if not len(chunk):
+                break
+            positions = np.minimum(np.searchsorted(other, chunk), len(other) - 1)
+            chunk = chunk[other[positions] == chunk] if len(other) else chunk[:0]
+        for doc in chunk.tolist():
+            if doc not in skip and accept(doc):
+                hits.append(doc)
+                if want is not None and len(hits) == want:
+                    return hits
+    return hits
+
+
+class ProductSearchIndex:
+    """
+    In-memory product name search per tenant, over an inverted index of character n-grams: every character
+    and every adjacent pair (CJK bigrams work without word segmentation), plus the first one and two
+    characters of each name for prefix (typeahead) lookups. Names and queries are NFKC-normalized and case-folded.
+    Results rank names starting with the query first, then names containing it; shorter names first within each.
+    A tenant's index is built lazily from the database on its first search, updated in place by add() when a
+    product is created, and rebuilt in the background once it is older than max_age_s (catching products created
+    by other workers) or its delta of added products grows past delta_rebuild_fraction of the base.
+    """
+
+    def __init__(self, max_age_s: int = 300, delta_rebuild_fraction: float = 0.1, min_delta_rebuild: int = 10000):
+        self.max_age_s = max_age_s
+        self.delta_rebuild_fraction = delta_rebuild_fraction
+        self.min_delta_rebuild = min_delta_rebuild
+        self._indexes: Dict[int, _TenantIndex] = {}
+        self._pending: Dict[int, List[Tuple[int, Optional[str]]]] = {} # Products created while a build is loading
+        self._build_locks: Dict[int, asyncio.Lock] = {}
+        self._lock = threading.Lock()
+
+    def is_built(self, tenant_id: int) -> bool:
+        return tenant_id in self._indexes
+
+    def needs_refresh(self, tenant_id: int) -> bool:
+        index = self._indexes.get(tenant_id)
+        if index is None:
+            return True
+        delta_limit = max(self.min_delta_rebuild, self.delta_rebuild_fraction * index.size)
+        return time.time() - index.built_at > self.max_age_s or len(index.delta_ids) > delta_limit
+
+    async def ensure_built(self, tenant_id: int, load: RowLoader):
+        """Builds the tenant's index from load() unless it exists; concurrent callers wait for one build."""
+        if tenant_id in self._indexes:
+            return
+        async with self._build_locks.setdefault(tenant_id, asyncio.Lock()):
+            if tenant_id not in self._indexes:
+                await self._build(tenant_id, load)
+
+    async def refresh(self, tenant_id: int, load: RowLoader):
+        """Rebuilds the tenant's index from load() while the current one keeps serving; skipped if a build is running."""
+        lock = self._build_locks.setdefault(tenant_id, asyncio.Lock())
+        if lock.locked():
+            return
+        async with lock:
+            await self._build(tenant_id, load)
+
+    async def _build(self, tenant_id: int, load: RowLoader):
+        with self._lock:
+            self._pending[tenant_id] = [] # Capture products created from before the snapshot on
+        try:
+            rows = await load()
+            index = await asyncio.to_thread(_TenantIndex, rows)
+        except BaseException:
+            with self._lock:
+                self._pending.pop(tenant_id, None)
+            raise
+        with self._lock:
+            pending = self._pending.pop(tenant_id, [])
+            if pending:
+                missing = ~index.contains(np.array([product_id for product_id, _ in pending], dtype=np.int64))
+                for (product_id, name), add in zip(pending, missing.tolist()):
+                    if add:
+                        index.add(product_id, name)
+            self._indexes[tenant_id] = index
+        print(f"Product search index for tenant {tenant_id}: {index.size} products in {index.build_ms:.0f} ms")
+
+    def add(self, tenant_id: int, product_id: int, name: Optional[str]):
+        """Indexes a newly created product (a no-op for tenants whose index is not built yet)."""
+        with self._lock:
+            if tenant_id in self._pending:
+                self._pending[tenant_id].append((product_id, name))
+            index = self._indexes.get(tenant_id)
+            if index is not None:
+                index.add(product_id, name)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def search(self, tenant_id: int, query: str, limit: int = 10, prefix_only: bool = False) -> List[Dict[str, Any]]:
+        """Ranked matches as {"product_id", "name", "match": "prefix" | "contains"}; the index must be built."""
+        index = self._indexes[tenant_id]
+        words = normalize(query).split()
+        if not words or limit <= 0:
+            return []
+        grams, prefix = _query_grams(words)
+
+        def matches(doc: int, as_prefix: bool) -> bool:
+            key = normalize(index.name(doc))
+            return (not as_prefix or key.startswith(words[0])) and all(word in key for word in words)
+
+        hits: List[Tuple[int, str]] = []
+        seen: set = set()
+        for as_prefix in (True, False) if not prefix_only else (True,):
+            want = limit - len(hits)
+            if want <= 0:
+                break
+            codes = [prefix] + grams if as_prefix else grams
+            found = []
+            for posting in (index.base_posting, index.delta_posting):
+                postings = sorted((posting(code) for code in codes), key=len)
+                accept = lambda doc: matches(doc, as_prefix)
+                # Base documents are in rank order, so the scan stops after 'want'; the delta is small and checked in full
+                found.extend(_scan(postings[0], postings[1:], accept, want if posting == index.base_posting else None, seen))
+            found = sorted(found, key=index.rank)[:want]
+            seen.update(found)
+            hits.extend((doc, "prefix" if as_prefix else "contains") for doc in found)
+        return [{"product_id": index.product_id(doc), "name": index.name(doc), "match": match} for doc, match in hits]
+
+    def stats(self) -> Dict[int, Dict[str, Any]]:
+        """Per-tenant size, age and memory of the built indexes."""
+        with self._lock:
+            indexes = dict(self._indexes)
+        return {
+            tenant_id: {
+                "products": index.size + len(index.delta_ids),
+                "delta_products": len(index.delta_ids),
+                "grams": len(index.gram_codes),
+                "build_ms": round(index.build_ms, 1),
+                "age_s": round(time.time() - index.built_at, 1),
+                "memory_bytes": index.memory_bytes(),
+            }
+            for tenant_id, index in indexes.items()
+        }
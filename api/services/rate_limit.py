@@ -0,0 +1,258 @@
+import asyncio
+import json
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+from redis.exceptions import RedisError
+from starlette.routing import compile_path, get_route_path
+
+KEY_PREFIX = "ratelimit"
+MAX_LOCAL_BUCKETS = 10000 # Least recently used in-process buckets beyond this are dropped
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+# Token buckets for a tenant (KEYS[1]) and one of its routes (KEYS[2]), updated together: a request
+# takes a token from both or from neither. ARGV: now_ms, rate, burst, route_rate, route_burst (tokens/s).
+# A bucket is stored as a hash {tokens, ts} and expires once it would be full again.
+# Returns {1, 0, ""} when allowed, {0, retry_after_ms, scope} when the tenant or route bucket is empty.
+_TAKE = """
+local now = tonumber(ARGV[1])
+local function level(key, rate, burst)
+    local bucket = redis.call("HMGET", key, "tokens", "ts")
+    local tokens, ts = tonumber(bucket[1]), tonumber(bucket[2])
+    if tokens == nil then
+        return burst
+    end
+    return math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+end
+local rates = {tonumber(ARGV[2]), tonumber(ARGV[4])}
+local bursts = {tonumber(ARGV[3]), tonumber(ARGV[5])}
+local levels = {level(KEYS[1], rates[1], bursts[1]), level(KEYS[2], rates[2], bursts[2])}
+local scopes = {"tenant", "route"}
+local wait, scope = 0, ""
+for i = 1, 2 do
+    if levels[i] < 1 and (1 - levels[i]) * 1000 / rates[i] > wait then
+        wait, scope = (1 - levels[i]) * 1000 / rates[i], scopes[i]
+    end
+end
+if scope ~= "" then
+    return {0, math.ceil(wait), scope}
+end
+for i = 1, 2 do
+    redis.call("HSET", KEYS[i], "tokens", tostring(levels[i] - 1), "ts", ARGV[1])
+    redis.call("PEXPIRE", KEYS[i], math.ceil(bursts[i] * 1000 / rates[i]) + 1000)
+end
+return {1, 0, ""}
+"""
+
+
+def route_key(method: str, path: str) -> str:
+    """
+    Route bucket name for a request that matches no route: numeric path segments (ids) are folded so
+    /products/7 and /products/8 share a bucket. Matched requests use their route template instead.
+    """
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+
+
+class TokenBucketLimiter:
+    """
+    Per-tenant and per-route token buckets in Redis, shared by every worker. plans maps a plan name to
+    {"rate", "burst", "route_rate", "route_burst"}: a tenant may make rate requests per second on average
+    and burst at once, and no more than route_rate/route_burst of them on a single route.
+    Each check is one Lua call. If Redis fails, checks use in-process buckets (the same limits, per worker)
+    for fallback_s before Redis is tried again, so an outage costs one timeout, not one per request.
+    """
+
+    def __init__(self, redis_client, plans: Dict[str, Dict[str, float]], tenant_plans: Optional[Dict[int, str]] = None,
+                 default_plan: str = "standard", anonymous_plan: str = "free", fallback_s: float = 5.0):
+        self.redis = redis_client
+        self.plans = plans
+        self.tenant_plans = tenant_plans or {}
+        self.default_plan = default_plan
+        self.anonymous_plan = anonymous_plan
+        self.fallback_s = fallback_s
+        for name in {default_plan, anonymous_plan, *self.tenant_plans.values()}:
+            if name not in plans:
+                raise ValueError(f"Unknown rate limit plan '{name}'; configured plans: {', '.join(plans)}")
+        self._take = redis_client.register_script(_TAKE) if redis_client is not None else None
+        self._redis_down_until = 0.0
+        self._local: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._tenants: Dict[str, Dict[str, int]] = {}
+        self._stats = {"redis_errors": 0, "local_checks": 0, "shed": 0}
+
+    def plan_for(self, tenant_id: Optional[int]) -> Tuple[str, Dict[str, float]]:
+        name = self.anonymous_plan if tenant_id is None else self.tenant_plans.get(tenant_id, self.default_plan)
+        return name, self.plans[name]
+
+    def check(self, tenant_id: Optional[int], client: str, route: str) -> Tuple[bool, float, str]:
+        """
+        Takes a token for this request: (allowed, retry_after_s, scope). Requests without a tenant are
+        limited per client address under the anonymous plan.
+        """
+        _, plan = self.plan_for(tenant_id)
+        subject = f"t:{tenant_id}" if tenant_id is not None else f"ip:{client}"
+        # The tenant in braces is the hash tag: both buckets live in one cluster slot, as the script requires
+        keys = [f"{KEY_PREFIX}:{{{subject}}}", f"{KEY_PREFIX}:{{{subject}}}:{route}"]
+        now_ms = int(time.time() * 1000)
+        allowed, retry_after_ms, scope = None, 0, ""
+        if self._take is not None and time.monotonic() >= self._redis_down_until:
+            try:
+                allowed, retry_after_ms, scope = self._take(keys=keys, args=[now_ms, plan["rate"], plan["burst"], plan["route_rate"], plan["route_burst"]])
+                allowed = bool(allowed)
+                scope = scope.decode() if isinstance(scope, bytes) else scope
+            except RedisError as e:
+                print(f"Rate limiter falling back to in-process buckets for {self.fallback_s}s: {e}")
+                allowed = None
+                with self._lock:
+                    self._stats["redis_errors"] += 1
+                self._redis_down_until = time.monotonic() + self.fallback_s
+        if allowed is None:
+            allowed, retry_after_ms, scope = self._take_local(keys, int(time.time() * 1000), plan)
+        self._count(f"t:{tenant_id}" if tenant_id is not None else "anonymous", allowed, scope)
+        return allowed, retry_after_ms / 1000, scope
+
+    def _take_local(self, keys, now_ms: int, plan: Dict[str, float]) -> Tuple[bool, float, str]:
+        """The script's algorithm on this worker's buckets."""
+        limits = ((plan["rate"], plan["burst"], "tenant"), (plan["route_rate"], plan["route_burst"], "route"))
+        with self._lock:
+            self._stats["local_checks"] += 1
+            levels = []
+            for key, (rate, burst, _) in zip(keys, limits):
+                bucket = self._local.get(key)
+                levels.append(burst if bucket is None else min(burst, bucket[0] + max(0, now_ms - bucket[1]) * rate / 1000))
+            wait, scope = 0.0, ""
+            for level, (rate, _, name) in zip(levels, limits):
+                if level < 1 and (1 - level) * 1000 / rate > wait:
+                    wait, scope = (1 - level) * 1000 / rate, name
+            if scope:
+                return False, math.ceil(wait), scope
+            for key, level in zip(keys, levels):
+                self._local[key] = [level - 1, now_ms]
+                self._local.move_to_end(key)
+            while len(self._local) > MAX_LOCAL_BUCKETS:
+                self._local.popitem(last=False)
+        return True, 0, ""
+
+    def _count(self, subject: str, allowed: bool, scope: str):
+        with self._lock:
+            counters = self._tenants.get(subject)
+            if counters is None:
+                counters = self._tenants[subject] = {"allowed": 0, "rejected": 0, "route_rejected": 0}
+            if allowed:
+                counters["allowed"] += 1
+            else:
+                counters["rejected"] += 1
+                counters["route_rejected"] += scope == "route"
+
+    def count_shed(self):
+        with self._lock:
+            self._stats["shed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                "redis_fallback_for_s": round(max(self._redis_down_until - time.monotonic(), 0.0), 1),
+                "local_buckets": len(self._local),
+                "tenants": {subject: dict(counters) for subject, counters in self._tenants.items()},
+            }
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware answering 429 with Retry-After once a tenant's or route's bucket is empty, and 503
+    (load shedding) once max_in_flight requests are already running in this worker (0: no limit).
+    The tenant comes from the bearer token via resolve_tenant (None when it does not verify).
+    Route buckets are keyed by the method and the route template the request matches (e.g.
+    "GET /api/v1/iot/devices/{device_id}"), so all values of a path parameter, numeric or not, share a bucket.
+    Paths starting with one of exempt_paths, routes in exempt_routes (the same form, e.g.
+    "POST /api/v1/iot/data") and CORS preflights are never limited.
+    Token verification and the Redis call block, so each check runs in a worker thread.
+    """
+
+    def __init__(self, app, limiter: TokenBucketLimiter, resolve_tenant: Callable[[str], Optional[int]],
+                 exempt_paths: Tuple[str, ...] = (), exempt_routes: Tuple[str, ...] = (), max_in_flight: int = 0):
+        self.app = app
+        self.limiter = limiter
+        self.resolve_tenant = resolve_tenant
+        self.exempt_paths = tuple(exempt_paths)
+        self.exempt_routes = frozenset(exempt_routes)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._routes: Optional[List[Tuple[Pattern, frozenset, str]]] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"].startswith(self.exempt_paths):
+            await self.app(scope, receive, send)
+            return
+        route = self._route(scope)
+        if route in self.exempt_routes:
+            await self.app(scope, receive, send)
+            return
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self.limiter.count_shed()
+            await _reject(send, 503, 1, "Server is overloaded, retry shortly")
+            return
+
+        token = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, credentials = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer" and credentials:
+                    token = credentials
+                break
+        client = scope["client"][0] if scope.get("client") else "unknown"
+        # Counted from here, so requests waiting on their check are not let past max_in_flight
+        self.in_flight += 1
+        try:
+            allowed, retry_after_s, limited = await asyncio.to_thread(self._check, token, client, route)
+            if not allowed:
+                await _reject(send, 429, retry_after_s, f"Rate limit exceeded for this {limited}")
+                return
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    def _route(self, scope) -> str:
+        """Method and template of the route this request will be dispatched to (route_key if none matches)."""
+        path = get_route_path(scope)
+        for regex, methods, template in self._route_table(scope):
+            if scope["method"] in methods and regex.match(path):
+                return f"{scope['method']} {template}"
+        return route_key(scope["method"], scope["path"])
+
+    def _route_table(self, scope) -> List[Tuple[Pattern, frozenset, str]]:
+        """
+        (regex, methods, template) of every documented route, in the router's order, built on first use.
+        The check runs before routing, so scope["route"] is not set yet; the OpenAPI paths are the one public
+        listing of full templates (router prefixes included) across FastAPI versions.
+        """
+        if self._routes is None:
+            app = scope.get("app") or self.app # scope["app"] is set, unless this middleware wraps the app itself
+            paths = app.openapi().get("paths", {}) if hasattr(app, "openapi") else {}
+            self._routes = [
+                (compile_path(template)[0], frozenset(method.upper() for method in operations) | ({"HEAD"} if "get" in operations else set()), template)
+                for template, operations in paths.items()
+            ]
+        return self._routes
+
+    def _check(self, token: Optional[str], client: str, route: str) -> Tuple[bool, float, str]:
+        tenant_id = self.resolve_tenant(token) if token is not None else None
+        return self.limiter.check(tenant_id, client, route)
+
+
+async def _reject(send, status_code: int, retry_after_s: float, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after_s))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from redis.exceptions import RedisError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+PIN_KEY_PREFIX = "rw-pin"
+MAX_LOCAL_PINS = 10000 # Expired local pins are pruned once this many are tracked
+
+
+def client_key(authorization: Optional[str], host: Optional[str]) -> str:
+    """Identifies a client for read-your-writes: a digest of its bearer token, or its address without one."""
+    return hashlib.sha256((authorization or f"host:{host}").encode()).hexdigest()[:32]
+
+
+class ReplicaRouter:
+    """
+    Routes read-only sessions to read replicas, round-robin, falling back to the primary.
+    A replica is ejected for eject_s after eject_after_failures consecutive connection errors
+    (reported by get_read_db or by the periodic SELECT 1 health check) and rejoins once the
+    ejection ends and it answers again.
+    Read-your-writes: after a client writes, its reads go to the primary for pin_s, covering
+    replication lag. Pins are kept in this process and in Redis, so every worker honours them.
+    """
+
+    def __init__(self, primary: async_sessionmaker, replicas: List[Tuple[str, AsyncEngine]], redis_client=None, pin_s: float = 5.0,
+                 eject_after_failures: int = 3, eject_s: float = 30.0, check_timeout_s: float = 2.0):
+        self.primary = primary
+        self.engines = dict(replicas)
+        self.redis = redis_client
+        self.pin_s = pin_s
+        self.eject_after_failures = eject_after_failures
+        self.eject_s = eject_s
+        self.check_timeout_s = check_timeout_s
+        self._names = [name for name, _ in replicas]
+        self._sessions = {name: async_sessionmaker(engine, autoflush=False, expire_on_commit=False) for name, engine in replicas}
+        self._replicas = {name: {"reads": 0, "failures": 0, "errors": 0, "ejections": 0, "ejected_until": 0.0} for name in self._names}
+        self._next = 0
+        self._pins: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stats = {"primary_reads": 0, "pinned_reads": 0, "fallback_reads": 0, "pins": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._names)
+
+    def _pick(self) -> Optional[str]:
+        """Next replica in round-robin order that is not ejected."""
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self._names)):
+                name = self._names[self._next % len(self._names)]
+                self._next += 1
+                if self._replicas[name]["ejected_until"] <= now:
+                    self._replicas[name]["reads"] += 1
+                    return name
+        return None
+
+    async def route(self, key: str) -> Tuple[Optional[str], async_sessionmaker]:
+        """(replica name, session factory) for a read by this client; (None, primary) when pinned or no replica is healthy."""
+        if not self._names:
+            self._count("primary_reads")
+            return None, self.primary
+        if await self.is_pinned(key):
+            self._count("pinned_reads")
+            return None, self.primary
+        name = self._pick()
+        if name is None:
+            self._count("fallback_reads")
+            return None, self.primary
+        return name, self._sessions[name]
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    async def pin(self, key: str):
+        """Sends this client's reads to the primary for the next pin_s seconds."""
+        until = time.monotonic() + self.pin_s
+        with self._lock:
+            if len(self._pins) >= MAX_LOCAL_PINS:
+                now = time.monotonic()
+                self._pins = {k: v for k, v in self._pins.items() if v > now}
+            self._pins[key] = until
+            self._stats["pins"] += 1
+        if self.redis is not None:
+            try:
+                await asyncio.to_thread(self.redis.set, f"{PIN_KEY_PREFIX}:{key}", 1, px=int(self.pin_s * 1000))
+            except RedisError as e:
+                print(f"Failed to share read-your-writes pin: {e}")
+
+    async def is_pinned(self, key: str) -> bool:
+        if self._pins.get(key, 0.0) > time.monotonic():
+            return True
+        if self.redis is None:
+            return False
+        try:
+            return bool(await asyncio.to_thread(self.redis.exists, f"{PIN_KEY_PREFIX}:{key}"))
+        except RedisError:
+            return True # Unknown: the primary is always consistent
+
+    def record_success(self, name: str):
+        with self._lock:
+            self._replicas[name]["failures"] = 0
+
+    def record_failure(self, name: str):
+        with self._lock:
+            replica = self._replicas[name]
+            replica["failures"] += 1
+            replica["errors"] += 1
+            if replica["failures"] >= self.eject_after_failures and replica["ejected_until"] <= time.monotonic():
+                replica["ejected_until"] = time.monotonic() + self.eject_s
+                replica["ejections"] += 1
+                print(f"Read replica {name} ejected for {self.eject_s}s after {replica['failures']} consecutive failures")
+
+    async def check(self) -> Dict[str, bool]:
+        """Runs SELECT 1 on every replica, ejected ones included, and records the outcome."""
+        async def ping(name: str) -> bool:
+            try:
+                async with self.engines[name].connect() as conn:
+                    await asyncio.wait_for(conn.execute(text("SELECT 1")), self.check_timeout_s)
+            except Exception:
+                self.record_failure(name)
+                return False
+            self.record_success(name)
+            return True
+
+        results = await asyncio.gather(*(ping(name) for name in self._names))
+        return dict(zip(self._names, results))
+
+    async def start(self, interval_s: float):
+        """Runs check() every interval_s seconds."""
+        async def _loop():
+            while True:
+                await asyncio.sleep(interval_s)
+                await self.check()
+        if self._names and self._task is None:
+            self._task = asyncio.create_task(_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for engine in self.engines.values():
+            await engine.dispose()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats["replicas"] = {
+                name: {**{k: v for k, v in replica.items() if k != "ejected_until"},
+                       "ejected_for_s": round(max(replica["ejected_until"] - now, 0.0), 1)}
+                for name, replica in self._replicas.items()
+            }
+        return stats
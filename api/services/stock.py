@@ -0,0 +1,390 @@
+import asyncio
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from redis.exceptions import RedisError
+from sqlalchemy import bindparam, update
+from sqlalchemy.engine import Engine
+from api.models import Product
+
+# Keys of a tenant's stock, all sharing the {tenant} hash tag so every script runs within one cluster slot:
+#   stock:{t}:p          hash {available, held}: units that can be reserved, and units held by open reservations
+#   stock:{t}:p:holds    hash reservation id -> quantity
+#   stock:{t}:p:expiry   sorted set reservation id -> expiry (epoch ms)
+#   stock:{t}:active     sorted set of "t:p" members: earliest open reservation expiry per product, for the expiry sweep
+#   stock:{t}:dirty      sorted set of "t:p" members: change counter per product whose on-hand stock (available + held) is not yet in MySQL
+# stock:tenants lists the tenants with stock loaded, so the sweep and reconciliation can find their sorted sets.
+TENANTS_KEY = "stock:tenants"
+
+def active_key(tenant_id: int) -> str:
+    return f"stock:{{{tenant_id}}}:active"
+
+def dirty_key(tenant_id: int) -> str:
+    return f"stock:{{{tenant_id}}}:dirty"
+
+# Shared by the scripts below: update_active keeps a product's earliest hold expiry in the tenant's active set,
+# release_expired returns its expired holds to 'available'
+_RELEASE_EXPIRED = """
+local function update_active(expiry, active, member)
+    local next_expiry = redis.call("zrange", expiry, 0, 0, "WITHSCORES")[2]
+    if next_expiry then
+        redis.call("zadd", active, next_expiry, member)
+    else
+        redis.call("zrem", active, member)
+    end
+end
+
+local function release_expired(stock, holds, expiry, active, member, now)
+    for _, id in ipairs(redis.call("zrangebyscore", expiry, "-inf", now)) do
+        local quantity = redis.call("hget", holds, id)
+        if quantity then
+            redis.call("hincrby", stock, "available", quantity)
+            redis.call("hincrby", stock, "held", -quantity)
+            redis.call("hdel", holds, id)
+        end
+        redis.call("zrem", expiry, id)
+    end
+    update_active(expiry, active, member)
+end
+"""
+
+# KEYS: stock, holds, expiry, active. ARGV: member, now, quantity, reservation id, expires at.
+# Returns the units left, -1 if the product's stock is not loaded, -2 if there are not enough units,
+# or -3 if the quantity is not positive (a negative hold would add units).
+_RESERVE = _RELEASE_EXPIRED + """
+local quantity = tonumber(ARGV[3])
+if not quantity or quantity <= 0 then
+    return -3
+end
+release_expired(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[1], ARGV[2])
+local available = tonumber(redis.call("hget", KEYS[1], "available"))
+if not available then
+    return -1
+end
+if available < quantity then
+    return -2
+end
+redis.call("hincrby", KEYS[1], "available", -quantity)
+redis.call("hincrby", KEYS[1], "held", quantity)
+redis.call("hset", KEYS[2], ARGV[4], quantity)
+redis.call("zadd", KEYS[3], ARGV[5], ARGV[4])
+update_active(KEYS[3], KEYS[4], ARGV[1])
+return available - quantity
+"""
+
+# KEYS: stock, holds, expiry, active, dirty. ARGV: member, now, reservation id, "confirm" or "release".
+# Confirming sells the held units (on-hand stock drops, so the product is marked dirty); releasing
+# returns them to 'available'. Returns the quantity, or 0 if the reservation expired or does not exist.
+_FINISH = _RELEASE_EXPIRED + """
+release_expired(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[1], ARGV[2])
+local quantity = redis.call("hget", KEYS[2], ARGV[3])
+if not quantity then
+    return 0
+end
+redis.call("hdel", KEYS[2], ARGV[3])
+redis.call("zrem", KEYS[3], ARGV[3])
+redis.call("hincrby", KEYS[1], "held", -quantity)
+if ARGV[4] == "confirm" then
+    redis.call("zincrby", KEYS[5], 1, ARGV[1])
+else
+    redis.call("hincrby", KEYS[1], "available", quantity)
+end
+update_active(KEYS[3], KEYS[4], ARGV[1])
+return tonumber(quantity)
+"""
+
+# KEYS: stock, holds, expiry, active. ARGV: member, now, reservation id, new expiry.
+# Returns the quantity held, or 0 if the reservation expired or does not exist.
+_RENEW = _RELEASE_EXPIRED + """
+release_expired(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[1], ARGV[2])
+local quantity = redis.call("hget", KEYS[2], ARGV[3])
+if not quantity then
+    return 0
+end
+redis.call("zadd", KEYS[3], ARGV[4], ARGV[3])
+update_active(KEYS[3], KEYS[4], ARGV[1])
+return tonumber(quantity)
+"""
+
+# KEYS: stock, holds, expiry, active, dirty. ARGV: member, now, units available for sale. Returns on-hand stock.
+_SET_AVAILABLE = _RELEASE_EXPIRED + """
+release_expired(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[1], ARGV[2])
+redis.call("hset", KEYS[1], "available", ARGV[3])
+redis.call("hsetnx", KEYS[1], "held", 0)
+redis.call("zincrby", KEYS[5], 1, ARGV[1])
+return tonumber(ARGV[3]) + tonumber(redis.call("hget", KEYS[1], "held"))
+"""
+
+# KEYS: stock, holds, expiry, active. ARGV: member, now.
+_SWEEP = _RELEASE_EXPIRED + """
+release_expired(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[1], ARGV[2])
+"""
+
+# KEYS: dirty. ARGV: member, counter seen before the write. Leaves products changed since then for the next batch.
+_CLEAN = """
+if redis.call("zscore", KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call("zrem", KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+class StockError(Exception):
+    """Base class; status_code is the HTTP status callers should answer with."""
+    status_code = 409
+
+
+class OutOfStock(StockError):
+    """Not enough units left to reserve."""
+    status_code = 409
+
+
+class ReservationExpired(StockError):
+    """The reservation was released (its hold expired) before it was confirmed."""
+    status_code = 409
+
+
+class StockUnavailable(StockError):
+    """Redis cannot be reached; reservations are refused rather than risking overselling."""
+    status_code = 503
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _parse_member(member) -> Tuple[int, int]:
+    """(tenant_id, product_id) of a "t:p" sorted set member."""
+    tenant_id, product_id = (member.decode() if isinstance(member, bytes) else member).split(":")
+    return int(tenant_id), int(product_id)
+
+
+class StockReservations:
+    """
+    Inventory for flash sales: stock is counted in Redis and each reservation is one Lua script, so
+    concurrent buyers of the same product never wait on a MySQL row lock and can never oversell.
+    A reservation holds units for hold_ttl_s; confirming it (on payment) sells them, and holds that
+    expire are returned to stock by the next script touching the product or by the periodic sweep.
+    products.stock stores on-hand units (available + held) and is written behind: confirmations and
+    stock changes mark the product dirty, and reconcile() writes dirty products to MySQL in batches.
+    A product's counters are loaded from products.stock on its first reservation.
+    """
+
+    def __init__(self, redis_client, engine: Optional[Engine] = None, hold_ttl_s: int = 900, reconcile_batch_size: int = 500):
+        self.redis = redis_client
+        self.engine = engine
+        self.hold_ttl_s = hold_ttl_s
+        self.reconcile_batch_size = reconcile_batch_size
+        self._reserve = redis_client.register_script(_RESERVE)
+        self._finish = redis_client.register_script(_FINISH)
+        self._renew = redis_client.register_script(_RENEW)
+        self._set_available = redis_client.register_script(_SET_AVAILABLE)
+        self._sweep = redis_client.register_script(_SWEEP)
+        self._clean = redis_client.register_script(_CLEAN)
+        self._task: Optional[asyncio.Task] = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"reserved": 0, "sold_out": 0, "confirmed": 0, "released": 0, "expired_confirms": 0,
+                       "swept": 0, "reconciled": 0, "reconcile_batches": 0, "errors": 0}
+
+    @staticmethod
+    def _keys(tenant_id: int, product_id: int) -> Tuple[List[str], str]:
+        stock = f"stock:{{{tenant_id}}}:{product_id}"
+        return [stock, f"{stock}:holds", f"{stock}:expiry", active_key(tenant_id)], f"{tenant_id}:{product_id}"
+
+    def _tenants(self) -> List[int]:
+        return sorted(int(tenant_id) for tenant_id in self.redis.smembers(TENANTS_KEY))
+
+    def _count(self, name: str, n: int = 1):
+        with self._stats_lock:
+            self._stats[name] += n
+
+    def _call(self, script, keys: List[str], args: List[Any]) -> Any:
+        try:
+            return script(keys=keys, args=args)
+        except RedisError as e:
+            self._count("errors")
+            raise StockUnavailable(f"Stock service unavailable: {e}")
+
+    def reserve(self, tenant_id: int, product_id: int, quantity: int, db_stock: int) -> str:
+        """
+        Holds 'quantity' units and returns the reservation id. db_stock (products.stock) seeds the
+        counters if the product has none in Redis yet. Raises OutOfStock or StockUnavailable, and
+        ValueError for a quantity that is not positive.
+        """
+        if quantity <= 0:
+            raise ValueError(f"Reservation quantity must be positive, got {quantity}")
+        keys, member = self._keys(tenant_id, product_id)
+        reservation_id = uuid.uuid4().hex
+        for _ in range(2):
+            now = _now_ms()
+            left = self._call(self._reserve, keys, [member, now, quantity, reservation_id, now + self.hold_ttl_s * 1000])
+            if left == -1:
+                try:
+                    self.redis.sadd(TENANTS_KEY, tenant_id)
+                    self.redis.hsetnx(keys[0], "available", db_stock) # Loses to a concurrent load or set, which is fine
+                    self.redis.hsetnx(keys[0], "held", 0)
+                except RedisError as e:
+                    self._count("errors")
+                    raise StockUnavailable(f"Stock service unavailable: {e}")
+                continue
+            if left == -3:
+                raise ValueError(f"Reservation quantity must be positive, got {quantity}")
+            if left == -2:
+                self._count("sold_out")
+                raise OutOfStock(f"Not enough stock for product {product_id}")
+            self._count("reserved")
+            return reservation_id
+        raise StockUnavailable(f"Stock for product {product_id} could not be loaded")
+
+    def confirm(self, tenant_id: int, product_id: int, reservation_id: str) -> int:
+        """Sells the reserved units; returns the quantity. Raises ReservationExpired if the hold is gone."""
+        keys, member = self._keys(tenant_id, product_id)
+        quantity = self._call(self._finish, keys + [dirty_key(tenant_id)], [member, _now_ms(), reservation_id, "confirm"])
+        if not quantity:
+            self._count("expired_confirms")
+            raise ReservationExpired("The stock reservation for this order has expired")
+        self._count("confirmed")
+        return quantity
+
+    def renew(self, tenant_id: int, product_id: int, reservation_id: str) -> int:
+        """
+        Holds the reserved units for another hold_ttl_s, e.g. before charging for them; returns the quantity.
+        Raises ReservationExpired if the hold is gone.
+        """
+        keys, member = self._keys(tenant_id, product_id)
+        now = _now_ms()
+        quantity = self._call(self._renew, keys, [member, now, reservation_id, now + self.hold_ttl_s * 1000])
+        if not quantity:
+            self._count("expired_confirms")
+            raise ReservationExpired("The stock reservation for this order has expired")
+        return quantity
+
+    def release(self, tenant_id: int, product_id: int, reservation_id: str) -> int:
+        """Returns the reserved units to stock (e.g. when the order could not be saved); 0 if already released."""
+        keys, member = self._keys(tenant_id, product_id)
+        try:
+            quantity = self._call(self._finish, keys + [dirty_key(tenant_id)], [member, _now_ms(), reservation_id, "release"])
+        except StockUnavailable as e:
+            print(f"Failed to release stock reservation {reservation_id}, it expires in {self.hold_ttl_s}s: {e}")
+            return 0
+        if quantity:
+            self._count("released")
+        return quantity
+
+    def set_available(self, tenant_id: int, product_id: int, available: int) -> int:
+        """Sets the units available for sale (open reservations stay held); returns on-hand stock."""
+        keys, member = self._keys(tenant_id, product_id)
+        try:
+            self.redis.sadd(TENANTS_KEY, tenant_id)
+        except RedisError as e:
+            self._count("errors")
+            raise StockUnavailable(f"Stock service unavailable: {e}")
+        return self._call(self._set_available, keys + [dirty_key(tenant_id)], [member, _now_ms(), available])
+
+    def levels(self, tenant_id: int, product_id: int) -> Optional[Dict[str, int]]:
+        """Live {available, held} of a product, or None if its stock is not loaded in Redis."""
+        keys, _ = self._keys(tenant_id, product_id)
+        try:
+            available, held = self.redis.hmget(keys[0], "available", "held")
+        except RedisError as e:
+            self._count("errors")
+            raise StockUnavailable(f"Stock service unavailable: {e}")
+        if available is None:
+            return None
+        return {"available": int(available), "held": int(held or 0)}
+
+    def release_expired(self, limit: int = 1000) -> int:
+        """Returns expired holds to stock for products nobody has touched since; returns the products swept."""
+        swept = 0
+        for tenant_id in self._tenants():
+            members = self.redis.zrangebyscore(active_key(tenant_id), "-inf", _now_ms(), start=0, num=limit - swept)
+            for member in members:
+                keys, member = self._keys(*_parse_member(member))
+                self._sweep(keys=keys, args=[member, _now_ms()])
+            swept += len(members)
+            if swept >= limit:
+                break
+        self._count("swept", swept)
+        return swept
+
+    def reconcile(self) -> int:
+        """
+        Writes on-hand stock of up to reconcile_batch_size dirty products to MySQL in one transaction;
+        returns the number written. Products changed again meanwhile stay dirty for the next batch.
+        """
+        dirty = []
+        for tenant_id in self._tenants():
+            members = self.redis.zrange(dirty_key(tenant_id), 0, self.reconcile_batch_size - len(dirty) - 1, withscores=True)
+            dirty += [(tenant_id, member, counter) for member, counter in members]
+            if len(dirty) >= self.reconcile_batch_size:
+                break
+        if not dirty:
+            return 0
+        products = [_parse_member(member) for _, member, _ in dirty]
+        pipe = self.redis.pipeline(transaction=False)
+        for tenant_id, product_id in products:
+            pipe.hmget(self._keys(tenant_id, product_id)[0][0], "available", "held")
+        rows = [
+            {"b_tenant_id": tenant_id, "b_id": product_id, "stock": int(available) + int(held or 0)}
+            for (tenant_id, product_id), (available, held) in zip(products, pipe.execute())
+            if available is not None
+        ]
+        if rows:
+            statement = (update(Product.__table__)
+                         .where(Product.id == bindparam("b_id"), Product.tenant_id == bindparam("b_tenant_id"))
+                         .values(stock=bindparam("stock")))
+            with self.engine.begin() as conn:
+                conn.execute(statement, rows)
+        for tenant_id, member, counter in dirty:
+            self._clean(keys=[dirty_key(tenant_id)], args=[member, int(counter)])
+        self._count("reconciled", len(rows))
+        self._count("reconcile_batches")
+        return len(rows)
+
+    def _tick(self) -> int:
+        self.release_expired()
+        written = 0
+        while True:
+            batch = self.reconcile()
+            written += batch
+            if batch < self.reconcile_batch_size:
+                return written
+
+    async def start(self, interval_ms: int):
+        """Runs the expiry sweep and reconciliation in a worker thread every interval_ms."""
+        async def _loop():
+            while True:
+                await asyncio.sleep(interval_ms / 1000)
+                try:
+                    await asyncio.to_thread(self._tick)
+                except Exception as e:
+                    self._count("errors")
+                    print(f"Stock reconciliation failed: {e}")
+        if self._task is None:
+            self._task = asyncio.create_task(_loop())
+            print(f"Stock reconciler started (interval_ms={interval_ms}, batch_size={self.reconcile_batch_size})")
+
+    async def stop(self):
+        """Stops the loop and writes what is still dirty."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await asyncio.to_thread(self._tick)
+        except Exception as e:
+            print(f"Final stock reconciliation failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        try:
+            stats["dirty_products"] = sum(self.redis.zcard(dirty_key(tenant_id)) for tenant_id in self._tenants())
+        except RedisError:
+            pass
+        return stats
@@ -0,0 +1,99 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def token_digest(token: str) -> bytes:
+    """Cache key for a bearer token; the token itself is never kept in memory."""
+    return hashlib.sha256(token.encode()).digest()
+
+
+class TokenCache:
+    """
+    LRU cache of the claims of verified JWTs, so a token reused on every request is decoded and its
+    signature checked once instead of per request.
+    An entry lives until the token's exp, and never longer than max_ttl_s (which bounds how long a
+    rotated signing key keeps being honoured). At most max_entries tokens are kept; 0 disables the cache.
+    revoke() evicts a token and refuses it until its exp, cached or not. Revocations are kept in this
+    process only: with several workers, call it in each (e.g. from a Redis pub/sub subscriber).
+    """
+
+    def __init__(self, max_entries: int = 10000, max_ttl_s: float = 300.0):
+        self.max_entries = max_entries
+        self.max_ttl_s = max_ttl_s
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._revoked: Dict[bytes, float] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "revoked_rejections": 0}
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        """A copy of the cached claims, or None when the token has to be verified."""
+        if not self.max_entries:
+            return None
+        key = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+        return dict(claims)
+
+    def put(self, token: str, claims: Dict[str, Any], exp: Optional[float] = None):
+        """Caches the claims of a token that just passed verification; exp is its expiry as a Unix timestamp."""
+        if not self.max_entries:
+            return
+        expires_at = time.time() + self.max_ttl_s
+        if exp is not None:
+            expires_at = min(expires_at, float(exp))
+        key = token_digest(token)
+        with self._lock:
+            if key in self._revoked: # Revoked while it was being verified
+                return
+            self._entries[key] = (dict(claims), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def is_revoked(self, token: str) -> bool:
+        if not self._revoked:
+            return False
+        key = token_digest(token)
+        with self._lock:
+            until = self._revoked.get(key)
+            if until is None:
+                return False
+            if until <= time.time():
+                del self._revoked[key]
+                return False
+            self._stats["revoked_rejections"] += 1
+        return True
+
+    def revoke(self, token: str, exp: Optional[float] = None) -> bool:
+        """Evicts the token and refuses it until exp (max_ttl_s from now without one). True if it was cached."""
+        now = time.time()
+        key = token_digest(token)
+        with self._lock:
+            if len(self._revoked) >= self.max_entries:
+                self._revoked = {k: until for k, until in self._revoked.items() if until > now}
+            self._revoked[key] = float(exp) if exp is not None else now + self.max_ttl_s
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        """Drops every cached token (e.g. after rotating the signing key); revocations are kept."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "size": len(self._entries), "revoked": len(self._revoked), "max_entries": self.max_entries}
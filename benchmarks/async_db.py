@@ -0,0 +1,129 @@
+"""
+Load benchmark for sync (threadpool + Session) vs async (event loop + AsyncSession) request handlers.
+Serves the product listing both ways from one uvicorn worker and drives it with many concurrent clients.
+Run from the repository root: python -m benchmarks.async_db [clients] [requests_per_client] [latency_ms] [DATABASE_URL]
+Defaults to 500 clients on a temporary SQLite file. SQLite answers without any network wait, so latency_ms
+adds a simulated database round trip per request (a blocking sleep in the sync handler, an awaited one in the
+async handler). Pass a MySQL URL (mysql+pymysql://...) and latency_ms 0 to measure the production setup.
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import httpx
+import numpy as np
+from fastapi import Depends, FastAPI
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from api.main import async_database_url
+from api.models import Base, Product
+from api.services.pagination import paginate, paginate_async
+
+PORT = 8765
+PAGE_SIZE = 20
+
+def make_app(url: str, latency_ms: float) -> FastAPI:
+    engine = create_engine(url)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
+    async_engine = create_async_engine(async_database_url(url))
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    app = FastAPI()
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def get_async_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    @app.get("/sync/products")
+    def sync_products(db=Depends(get_db)):
+        if latency_ms:
+            time.sleep(latency_ms / 1000) # Holds the threadpool thread, as a blocking driver does
+        rows, _ = paginate(db.query(Product).filter(Product.tenant_id == 1), Product.id, 1, PAGE_SIZE)
+        return [{"id": row.id, "name": row.name, "price": row.price} for row in rows]
+
+    @app.get("/async/products")
+    async def async_products(db=Depends(get_async_db)):
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        rows, _ = await paginate_async(db, select(Product).where(Product.tenant_id == 1), Product.id, 1, PAGE_SIZE)
+        return [{"id": row.id, "name": row.name, "price": row.price} for row in rows]
+
+    return app
+
+def _serve(url: str, latency_ms: float):
+    import uvicorn
+    # Long keep-alive: with hundreds of clients queued, idle connections must not be closed under them
+    uvicorn.run(make_app(url, latency_ms), host="127.0.0.1", port=PORT, log_level="warning", timeout_keep_alive=120)
+
+async def _load(path: str, clients: int, requests_per_client: int):
+    # Minimal keep-alive HTTP/1.1 client: all connections are opened before the clock starts, and the
+    # per-request client work is small, so the numbers reflect the server rather than the load generator
+    request = f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode()
+    latencies = []
+    start = asyncio.Event()
+
+    async def run_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await start.wait()
+        for _ in range(requests_per_client):
+            started = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            if not head.startswith(b"HTTP/1.1 200"):
+                raise RuntimeError(f"{path} answered {head.splitlines()[0].decode()}")
+            length = next(int(line.split(b":")[1]) for line in head.lower().split(b"\r\n") if line.startswith(b"content-length:"))
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+        writer.close()
+
+    connections = [await asyncio.open_connection("127.0.0.1", PORT) for _ in range(clients)]
+    tasks = [asyncio.create_task(run_client(reader, writer)) for reader, writer in connections]
+    started = time.perf_counter()
+    start.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    print(f"{path:18s} {len(latencies) / elapsed:8.0f} req/s   p50 {p50:8.1f} ms   p99 {p99:8.1f} ms")
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    requests_per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    url = sys.argv[4] if len(sys.argv) > 4 else f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'products.db')}"
+    engine = create_engine(url)
+    Base.metadata.drop_all(bind=engine, tables=[Product.__table__])
+    Base.metadata.create_all(bind=engine, tables=[Product.__table__])
+    with engine.begin() as conn:
+        conn.execute(Product.__table__.insert(), [
+            {"id": i, "tenant_id": 1 + i % 2, "name": f"product {i}", "price": 10.0, "farmer_id": 1} for i in range(1, 10_001)
+        ])
+    engine.dispose()
+
+    server = multiprocessing.get_context("spawn").Process(target=_serve, args=(url, latency_ms), daemon=True)
+    server.start()
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"http://127.0.0.1:{PORT}/docs")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("Benchmark server did not start")
+        print(f"{clients} concurrent clients x {requests_per_client} requests, {latency_ms:g} ms simulated database latency")
+        for path in ("/sync/products", "/async/products"):
+            asyncio.run(_load(path, min(clients, 20), 5)) # Warm up connections
+            asyncio.run(_load(path, clients, requests_per_client))
+    finally:
+        server.terminate()
+
+if __name__ == "__main__":
+    main()
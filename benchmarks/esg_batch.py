@@ -0,0 +1,37 @@
+"""
+Benchmark for tenant-wide ESG scoring: one calculate_esg_score call per farmer vs one batch pass.
+Run from the repository root: python -m benchmarks.esg_batch [farmers] [orders]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from api.services.esg_calculator import calculate_esg_score, calculate_esg_scores
+
+def main():
+    num_farmers = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    num_orders = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000_000
+    rng = np.random.default_rng(0)
+    farmer_ids = rng.integers(1, num_farmers + 1, size=num_orders)
+    orders = pd.DataFrame({
+        "farmer_id": farmer_ids,
+        "product_id": farmer_ids * 100 + rng.integers(0, 8, size=num_orders),
+        "quantity": rng.integers(1, 20, size=num_orders),
+    })
+    print(f"{num_farmers:,d} farmers, {num_orders:,d} orders")
+
+    started = time.perf_counter()
+    scalar = {farmer_id: calculate_esg_score(farmer_orders)[0] for farmer_id, farmer_orders in orders.groupby("farmer_id")}
+    scalar_s = time.perf_counter() - started
+    print(f"{'per-farmer calculate_esg_score':35s} {scalar_s:8.2f} s")
+
+    started = time.perf_counter()
+    batch = calculate_esg_scores(orders)
+    batch_s = time.perf_counter() - started
+    print(f"{'calculate_esg_scores (one pass)':35s} {batch_s:8.2f} s ({scalar_s / batch_s:.1f}x faster)")
+
+    mismatches = sum(scalar[farmer_id] != score for farmer_id, score in zip(batch["farmer_id"].tolist(), batch["esg_score"].tolist()))
+    print(f"Mismatched scores: {mismatches}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark for the decode + batch validation + columnar append stages of bulk IoT ingest.
+ingest_rows runs without a writer or on_ingest listener, so the figures leave out what the route adds
+on top: queueing for the write-behind pipeline, running stats, live fan-out and alert rules, and HTTP.
+Run from the repository root: python -m benchmarks.iot_bulk_ingest [rows]
+"""
+import asyncio
+import json
+import sys
+import time
+from api.services import iot_ingest
+from api.services.iot_store import IoTTimeSeriesStore
+
+TARGET_ROWS_PER_SEC = 50_000
+
+def _make_rows(num_rows: int, num_devices: int = 500):
+    base_ms = 1_700_000_000_000
+    return [
+        {
+            "device_id": f"sensor-{i % num_devices:04d}",
+            "timestamp": base_ms + i * 10,
+            "temperature": 20.0 + (i % 50) * 0.1,
+            "humidity": 55.5,
+            "soil_moisture": 31.2 if i % 7 else None,
+        }
+        for i in range(num_rows)
+    ]
+
+async def _chunks(body: bytes, chunk_size: int = 64 * 1024):
+    for start in range(0, len(body), chunk_size):
+        yield body[start:start + chunk_size]
+
+def _run(label: str, body: bytes, decoder, num_rows: int):
+    store = IoTTimeSeriesStore(capacity=8640)
+    started = time.perf_counter()
+    rows = asyncio.run(decoder(_chunks(body), num_rows))
+    result = iot_ingest.ingest_rows(store, 1, rows)
+    elapsed = time.perf_counter() - started
+    rate = result["accepted"] / elapsed
+    verdict = "OK" if rate >= TARGET_ROWS_PER_SEC else "BELOW TARGET"
+    print(f"{label:8s} {result['accepted']:>9,d} rows decoded, validated and appended in {elapsed:6.3f}s -> {rate:>10,.0f} rows/s [{verdict}]")
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rows = _make_rows(num_rows)
+    ndjson_body = b"\n".join(json.dumps(row).encode() for row in rows)
+    _run("ndjson", ndjson_body, iot_ingest.decode_ndjson, num_rows)
+    if iot_ingest.msgpack is not None:
+        _run("msgpack", iot_ingest.msgpack.packb(rows), iot_ingest.decode_msgpack, num_rows)
+    else:
+        print("msgpack  skipped (msgpack not installed)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Benchmark for time-range lookups on a single large IoT device series.
+Run from the repository root: python -m benchmarks.iot_range_query [points]
+"""
+import sys
+import time
+import numpy as np
+from api.services.iot_store import IOT_CHANNELS, DeviceSeries
+
+def _time(label: str, fn, repeat: int = 200):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed_us = (time.perf_counter() - started) / repeat * 1e6
+    print(f"{label:40s} {elapsed_us:10.1f} us/query ({len(result[0]):,d} readings)")
+
+def main():
+    num_points = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    base_ms = 1_700_000_000_000
+    series = DeviceSeries("sensor-big", capacity=num_points)
+    timestamps = base_ms + np.arange(num_points, dtype=np.int64) * 1_000
+    values = np.random.default_rng(0).normal(25.0, 3.0, size=(len(IOT_CHANNELS), num_points))
+    series.extend(timestamps, values)
+    print(f"Loaded {len(series):,d} readings")
+
+    middle = base_ms + (num_points // 2) * 1_000
+    _time("1 minute window (60 readings)", lambda: series.window(middle, middle + 59_000))
+    _time("1 hour window (3,600 readings)", lambda: series.window(middle, middle + 3_599_000))
+    _time("latest 20 readings", lambda: series.tail(20))
+
+    late = DeviceSeries("sensor-late", capacity=num_points)
+    late.extend(timestamps, values)
+    started = time.perf_counter()
+    for i in range(1_000):
+        late.append(int(timestamps[-1 - (i % 10) * 7]) - 500, (20.0, None, None, None))
+    print(f"{'late insert 10-70 readings behind head':40s} {(time.perf_counter() - started) / 1_000 * 1e6:10.1f} us/insert")
+
+if __name__ == "__main__":
+    main()
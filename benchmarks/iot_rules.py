@@ -0,0 +1,50 @@
+"""
+Benchmark for per-reading alert rule evaluation cost.
+Run from the repository root: python -m benchmarks.iot_rules [rules] [readings]
+"""
+import sys
+import time
+import numpy as np
+from api.services.iot_rules import IoTRuleEngine
+from api.services.iot_store import IOT_CHANNELS
+
+def _rules(count: int):
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        kind = ("threshold", "duration", "rate")[i % 3]
+        direction = ("rise", "fall")[i % 2] if kind == "rate" else ("above", "below")[i % 2]
+        yield {
+            "name": f"rule-{i}",
+            "kind": kind,
+            "channel": IOT_CHANNELS[i % len(IOT_CHANNELS)],
+            "direction": direction,
+            "value": float(rng.uniform(1.0, 10.0) if kind == "rate" else rng.uniform(10.0, 40.0)),
+            "window_s": 0 if kind == "threshold" else int(rng.choice([300, 900, 3600])),
+            "cooldown_s": 3600,
+            "device_id": None,
+            "line_user_id": None,
+        }
+
+def main():
+    num_rules = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000
+    num_readings = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    engine = IoTRuleEngine()
+    for rule in _rules(num_rules):
+        engine.add_rule(1, rule)
+
+    timestamps = 1_700_000_000_000 + np.arange(num_readings, dtype=np.int64) * 10_000
+    values = np.random.default_rng(1).normal(25.0, 6.0, size=(len(IOT_CHANNELS), num_readings))
+    started = time.perf_counter()
+    alerts = 0
+    for i in range(num_readings):
+        alerts += len(engine.evaluate(1, "sensor-bench", timestamps[i:i + 1], values[:, i:i + 1]))
+    per_reading_us = (time.perf_counter() - started) / num_readings * 1e6
+    print(f"{num_rules:,d} rules, {num_readings:,d} readings one at a time: {per_reading_us:.1f} us/reading "
+          f"({per_reading_us * 1000 / num_rules:.1f} ns/rule), {alerts:,d} alerts")
+
+    started = time.perf_counter()
+    engine.evaluate(1, "sensor-bench-batch", timestamps, values)
+    print(f"{'same readings as one bulk batch':45s} {(time.perf_counter() - started) / num_readings * 1e6:.1f} us/reading")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Microbenchmark of per-request authentication cost in get_current_user.
+Compares the previous dependency (jwt.decode and a new HTTPException on every call) with the cached
+one, for a token reused on every request (cache hit), a token seen for the first time (cache miss)
+and an invalid token (failure path).
+Run from the repository root: python -m benchmarks.jwt_auth [calls]
+"""
+import sys
+import time
+from datetime import timedelta
+import numpy as np
+from fastapi import HTTPException, status
+from jose import JWTError, jwt
+from api.main import create_access_token, get_current_user, settings, token_cache
+
+REPEATS = 5
+
+def previous_get_current_user(token: str):
+    """get_current_user before the cache, for the baseline."""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.algorithm])
+        username: str = payload.get("sub")
+        tenant_id: int = payload.get("tenant_id")
+        if username is None or tenant_id is None:
+            raise credentials_exception
+        return {"username": username, "tenant_id": tenant_id}
+    except JWTError as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Invalid token: {e}",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+def per_call_us(verify, tokens) -> float:
+    """Best of REPEATS runs, in microseconds per call."""
+    runs = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        for token in tokens:
+            try:
+                verify(token)
+            except HTTPException:
+                pass
+        runs.append((time.perf_counter() - started) / len(tokens) * 1e6)
+    return float(np.min(runs))
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    claims = {"sub": "agribridge_user", "tenant_id": 1, "role": "farmer"}
+    reused = [create_access_token(claims, timedelta(minutes=30))] * calls
+    fresh = [create_access_token({**claims, "sub": f"user{i}"}, timedelta(minutes=30)) for i in range(calls)]
+    invalid = [reused[0][:-4] + "AAAA"] * calls
+
+    def cache_miss(token):
+        token_cache.clear() # Every call verifies, then caches
+        return get_current_user(token)
+
+    print(f"{calls} calls per case, best of {REPEATS}, µs per call")
+    print(f"{'case':24s} {'previous':>10s} {'cached':>10s} {'speedup':>8s}")
+    for label, tokens, cached in (("reused token (hit)", reused, get_current_user),
+                                  ("new token (miss)", fresh, cache_miss),
+                                  ("invalid token", invalid, get_current_user)):
+        before = per_call_us(previous_get_current_user, tokens)
+        token_cache.clear()
+        after = per_call_us(cached, tokens)
+        print(f"{label:24s} {before:10.2f} {after:10.2f} {before / after:7.1f}x")
+    print(f"cache: {token_cache.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Benchmark for per-page latency of offset vs cursor (keyset) pagination on a large tenant.
+Run from the repository root: python -m benchmarks.keyset_pagination [orders] [DATABASE_URL]
+Defaults to a temporary SQLite file; pass a MySQL URL to measure the production setup.
+"""
+import os
+import sys
+import tempfile
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from api.models import Base, Order
+from api.services.pagination import encode_cursor, paginate
+
+PAGE_SIZE = 20
+
+def _time_page(label: str, fn, repeat: int = 20):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        rows, _ = fn()
+    print(f"{label:40s} {(time.perf_counter() - started) / repeat * 1000:8.2f} ms/page ({len(rows)} rows)")
+
+def main():
+    num_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    url = sys.argv[2] if len(sys.argv) > 2 else f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'orders.db')}"
+    engine = create_engine(url)
+    Base.metadata.drop_all(bind=engine, tables=[Order.__table__])
+    Base.metadata.create_all(bind=engine, tables=[Order.__table__])
+    with engine.begin() as conn:
+        for start in range(0, num_orders, 50_000):
+            conn.execute(Order.__table__.insert(), [
+                {"id": i + 1, "tenant_id": 1 + i % 2, "product_id": 1, "quantity": 1, "total_price": 1.0, "buyer_id": 1, "status": "pending"}
+                for i in range(start, min(start + 50_000, num_orders))
+            ])
+    db = sessionmaker(bind=engine)()
+    query = db.query(Order).filter(Order.tenant_id == 1)
+    print(f"{num_orders:,d} orders, {PAGE_SIZE} per page")
+
+    for page in (1, 100, 10_000):
+        skipped = (page - 1) * PAGE_SIZE
+        # The cursor a client would hold after reading 'skipped' rows of tenant 1 (odd ids)
+        cursor = encode_cursor(1, 2 * skipped - 1) if skipped else None
+        _time_page(f"offset page {page:,d}", lambda: paginate(query, Order.id, 1, PAGE_SIZE, offset=skipped))
+        _time_page(f"cursor page {page:,d}", lambda: paginate(query, Order.id, 1, PAGE_SIZE, cursor=cursor))
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Latency and memory benchmark for the per-tenant product name search index (api/services/product_search.py).
+Builds one tenant's index from synthetic Chinese/English product names and replays typeahead sessions:
+every prefix of a product name as it is typed, plus infix queries taken from the middle of names.
+Run from the repository root: python -m benchmarks.product_search [products] [sessions]
+Defaults to 1,000,000 products and 2,000 typing sessions; the target is p99 typeahead latency under 1 ms.
+"""
+import asyncio
+import random
+import sys
+import time
+import numpy as np
+from api.services.product_search import ProductSearchIndex
+
+WORDS = ("有機 高山 蘋果 香蕉 芒果 鳳梨 高麗菜 青江菜 地瓜 玉米 稻米 糙米 茶葉 烏龍 紅茶 蜂蜜 雞蛋 土雞 鮮乳 禮盒 小農 嘉義 台東 "
+         "花蓮 屏東 宜蘭 有機米 紅心 芭樂 木瓜 文旦 柳丁 番茄 草莓 竹筍 香菇 金針 梅子 Apple Organic Rice Tea Honey 特級 精選 家庭號").split()
+
+def product_names(count: int, seed: int = 1):
+    generator = random.Random(seed)
+    for product_id in range(1, count + 1):
+        words = generator.sample(WORDS, generator.randint(2, 4))
+        yield product_id, "".join(words) + f" {generator.randint(1, 50)}kg"
+
+def timed(index: ProductSearchIndex, queries, prefix_only: bool):
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        index.search(1, query, 10, prefix_only)
+        latencies.append(time.perf_counter() - started)
+    return np.array(latencies) * 1000
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rows = list(product_names(count))
+    index = ProductSearchIndex()
+
+    async def load():
+        return rows
+
+    asyncio.run(index.ensure_built(1, load))
+    stats = index.stats()[1]
+    memory = stats["memory_bytes"]
+    print(f"{count} products: built in {stats['build_ms'] / 1000:.1f} s, {stats['grams']} grams, "
+          f"{memory['total'] / 2**20:.1f} MiB ({memory['total'] / count:.0f} bytes/product; "
+          f"names {memory['names'] / 2**20:.1f}, postings {memory['postings'] / 2**20:.1f} MiB)")
+
+    generator = random.Random(2)
+    samples = [rows[generator.randrange(count)][1] for _ in range(sessions)]
+    typed = [name[:length] for name in samples for length in range(1, min(len(name), 8) + 1)]
+    infix = [name[start:start + generator.randint(1, 4)] for name in samples for start in [generator.randrange(len(name) - 1)]]
+    for label, queries, prefix_only in (("typeahead (prefix_only)", typed, True), ("typeahead (ranked)", typed, False),
+                                        ("infix", infix, False)):
+        latencies = timed(index, queries, prefix_only)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{label:24s} {len(queries):6d} queries   p50 {p50:.3f} ms   p99 {p99:.3f} ms   max {latencies.max():.3f} ms")
+
+    started = time.perf_counter()
+    for product_id in range(count + 1, count + 1001):
+        index.add(1, product_id, f"新品有機蘋果{product_id}")
+    print(f"add: {(time.perf_counter() - started):.3f} ms per product")
+    latencies = timed(index, typed[:2000], False)
+    print(f"{'typeahead with 1000 added':24s} {len(latencies):6d} queries   p50 {np.percentile(latencies, 50):.3f} ms   "
+          f"p99 {np.percentile(latencies, 99):.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Overhead of the rate limiting middleware per request.
+Calls a minimal app directly over ASGI (no HTTP server, so the difference is the middleware's own cost)
+with a reused bearer token, without the middleware, with it checking Redis, and with it on in-process
+buckets (Redis unreachable). Limits are set high enough that every request is allowed. The measured
+route is registered after ROUTES others, about the size of the API, so the route lookup scans them all.
+Run from the repository root: python -m benchmarks.rate_limit [requests]
+Uses Redis at REDIS_URL (default redis://localhost:6379/15; the benchmark's buckets are deleted).
+"""
+import asyncio
+import os
+import sys
+import time
+import numpy as np
+import redis
+from fastapi import FastAPI
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+from api.main import create_access_token, request_tenant
+from api.services.rate_limit import RateLimitMiddleware, TokenBucketLimiter
+
+TENANT_ID = 9999
+PLANS = {"bench": {"rate": 1e9, "burst": 1e9, "route_rate": 1e9, "route_burst": 1e9}}
+REPEATS = 5
+ROUTES = 50
+
+def make_app(limiter=None):
+    app = FastAPI()
+    for i in range(ROUTES):
+        app.add_api_route(f"/api/v1/other{i}/{{item_id}}", lambda item_id: {}, methods=["GET"])
+
+    @app.get("/api/v1/products/{product_id}")
+    async def product(product_id: int):
+        return {"id": product_id}
+
+    if limiter is not None:
+        app.add_middleware(RateLimitMiddleware, limiter=limiter, resolve_tenant=request_tenant)
+    return app
+
+async def per_request_us(app, requests: int, token: str) -> np.ndarray:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/api/v1/products/101", "raw_path": b"/api/v1/products/101", "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"bench"), (b"authorization", f"Bearer {token}".encode())],
+        "client": ("127.0.0.1", 50000), "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            raise RuntimeError(f"Unexpected status {message['status']}")
+
+    timings = np.empty(requests)
+    for i in range(requests):
+        started = time.perf_counter()
+        await app(dict(scope), receive, send)
+        timings[i] = time.perf_counter() - started
+    return timings * 1e6
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    token = create_access_token({"sub": "bench", "tenant_id": TENANT_ID})
+    client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/15"), socket_timeout=0.05, retry=Retry(NoBackoff(), 0))
+    unreachable = redis.Redis(host="127.0.0.1", port=1, socket_connect_timeout=0.05, retry=Retry(NoBackoff(), 0))
+    cases = [
+        ("no middleware", make_app()),
+        ("redis buckets", make_app(TokenBucketLimiter(client, PLANS, default_plan="bench", anonymous_plan="bench"))),
+        ("in-process fallback", make_app(TokenBucketLimiter(unreachable, PLANS, default_plan="bench", anonymous_plan="bench", fallback_s=3600))),
+    ]
+    print(f"{requests} requests per case, best of {REPEATS} runs, µs per request")
+    baseline = None
+    for label, app in cases:
+        asyncio.run(per_request_us(app, 100, token)) # Warm up: token cache, script load, Redis fallback switch
+        runs = [asyncio.run(per_request_us(app, requests, token)) for _ in range(REPEATS)]
+        best = min(runs, key=np.median)
+        p50, p99 = np.percentile(best, [50, 99])
+        baseline = p50 if baseline is None else baseline
+        print(f"{label:22s} p50 {p50:8.1f}   p99 {p99:8.1f}   added p50 {p50 - baseline:8.1f}")
+    for key in client.scan_iter(f"ratelimit:{{t:{TENANT_ID}}}*"):
+        client.delete(key)
+
+if __name__ == "__main__":
+    main()
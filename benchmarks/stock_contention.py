@@ -0,0 +1,119 @@
+"""
+Contention benchmark for flash-sale stock: many buyers ordering the same product at once.
+Compares Redis reservations (api/services/stock.py, one Lua script per buyer) with the row-lock
+baseline of keeping stock in products.stock (SELECT ... FOR UPDATE, UPDATE, COMMIT per buyer),
+and checks that neither sells more units than there are.
+Run from the repository root: python -m benchmarks.stock_contention [buyers] [stock] [rtt_ms] [DATABASE_URL]
+Defaults to 1000 buyers for 100 units on a temporary SQLite file, with Redis at REDIS_URL
+(default redis://localhost:6379/15; the benchmark's keys are deleted). rtt_ms simulates one network
+round trip per statement; the row-lock baseline pays three of them while holding the lock.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import redis
+from sqlalchemy import create_engine, event, select, update
+from api.models import Base, Product
+from api.services.stock import TENANTS_KEY, OutOfStock, StockReservations
+
+TENANT_ID = 9999
+PRODUCT_ID = 1
+DB_POOL_SIZE = 50
+
+def run_buyers(buyers: int, buy) -> tuple:
+    """Starts every buyer thread at once; returns (units sold, elapsed seconds, per-buyer latencies)."""
+    barrier = threading.Barrier(buyers + 1)
+    sold, latencies = [], []
+
+    def buyer():
+        barrier.wait()
+        started = time.perf_counter()
+        if buy():
+            sold.append(1)
+        latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=buyer) for _ in range(buyers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return len(sold), time.perf_counter() - started, np.array(latencies) * 1000
+
+def report(label: str, buyers: int, stock: int, sold: int, elapsed: float, latencies: np.ndarray, left: int):
+    p50, p99 = np.percentile(latencies, [50, 99])
+    verdict = "ok" if sold == stock and left == 0 else "OVERSOLD" if sold > stock else "UNDERSOLD"
+    print(f"{label:22s} {buyers / elapsed:8.0f} buyers/s   p50 {p50:8.1f} ms   p99 {p99:8.1f} ms   sold {sold}/{stock}, left {left}: {verdict}")
+
+def redis_reservations(client, buyers: int, stock: int, rtt_ms: float):
+    reservations = StockReservations(client)
+    for key in client.scan_iter(f"stock:{{{TENANT_ID}}}:*"):
+        client.delete(key)
+    reservations.set_available(TENANT_ID, PRODUCT_ID, stock)
+
+    def buy() -> bool:
+        time.sleep(rtt_ms / 1000) # The script runs in one round trip
+        try:
+            reservations.reserve(TENANT_ID, PRODUCT_ID, 1, db_stock=stock)
+            return True
+        except OutOfStock:
+            return False
+
+    sold, elapsed, latencies = run_buyers(buyers, buy)
+    report("redis reservation", buyers, stock, sold, elapsed, latencies, reservations.levels(TENANT_ID, PRODUCT_ID)["available"])
+    for key in client.scan_iter(f"stock:{{{TENANT_ID}}}:*"):
+        client.delete(key)
+    client.srem(TENANTS_KEY, TENANT_ID)
+
+def db_row_lock(url: str, buyers: int, stock: int, rtt_ms: float):
+    engine = create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=0, pool_timeout=600,
+                           **({"connect_args": {"timeout": 600}} if url.startswith("sqlite") else {}))
+    if engine.dialect.name == "sqlite":
+        # SQLite has no FOR UPDATE; BEGIN IMMEDIATE takes the write lock up front, like the row lock on MySQL
+        @event.listens_for(engine, "connect")
+        def _autocommit_driver(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def _begin_immediate(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    Base.metadata.drop_all(bind=engine, tables=[Product.__table__])
+    Base.metadata.create_all(bind=engine, tables=[Product.__table__])
+    with engine.begin() as conn:
+        conn.execute(Product.__table__.insert(), [{"id": PRODUCT_ID, "tenant_id": TENANT_ID, "name": "高山水果禮盒", "price": 500.0,
+                                                   "farmer_id": 1, "stock": stock}])
+
+    def buy() -> bool:
+        with engine.begin() as conn:
+            left = conn.execute(select(Product.stock).where(Product.id == PRODUCT_ID).with_for_update()).scalar()
+            time.sleep(rtt_ms / 1000)
+            if left < 1:
+                return False
+            conn.execute(update(Product).where(Product.id == PRODUCT_ID).values(stock=Product.stock - 1))
+            time.sleep(rtt_ms / 1000)
+        time.sleep(rtt_ms / 1000) # COMMIT round trip; the lock is held until it arrives
+        return True
+
+    sold, elapsed, latencies = run_buyers(buyers, buy)
+    with engine.connect() as conn:
+        left = conn.execute(select(Product.stock).where(Product.id == PRODUCT_ID)).scalar()
+    report(f"db row lock ({engine.dialect.name})", buyers, stock, sold, elapsed, latencies, left)
+    engine.dispose()
+
+def main():
+    buyers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    stock = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rtt_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    url = sys.argv[4] if len(sys.argv) > 4 else f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'stock.db')}"
+    client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/15"), max_connections=buyers)
+    print(f"{buyers} concurrent buyers, {stock} units of one product, {rtt_ms:g} ms per round trip")
+    redis_reservations(client, buyers, stock, rtt_ms)
+    db_row_lock(url, buyers, stock, rtt_ms)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from multiprocessing.shared_memory import SharedMemory
+from api.services import process_pool
+from api.services.esg_calculator import calculate_esg_scores, calculate_esg_scores_offloaded
+from api.services.process_pool import AnalyticsProcessPool, ProcessPoolBusy, ProcessPoolTimeout, attach_columns, share_columns
+
+def _orders(num_farmers: int, num_orders: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    farmer_ids = rng.integers(1, num_farmers + 1, size=num_orders)
+    return pd.DataFrame({
+        "farmer_id": farmer_ids,
+        "product_id": farmer_ids * 100 + rng.integers(0, 6, size=num_orders),
+        "quantity": rng.integers(1, 60, size=num_orders),
+    })
+
+def _sum_after(spec, delay_s: float) -> float:
+    """Worker for submit_columns that only touches the shared block after a delay."""
+    time.sleep(delay_s)
+    shm, columns = attach_columns(spec)
+    total = float(columns["values"].sum())
+    del columns
+    shm.close()
+    return total
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = AnalyticsProcessPool(max_workers=2, max_pending=4, task_timeout_s=30)
+    pool.start()
+    yield pool
+    pool.stop()
+
+def test_shared_columns_round_trip():
+    columns = {"ids": np.arange(10, dtype=np.int64), "values": np.linspace(0, 1, 7)}
+    shm, spec = share_columns(columns)
+    try:
+        reader, mapped = attach_columns(spec)
+        assert mapped["ids"].tolist() == list(range(10))
+        assert np.array_equal(mapped["values"], columns["values"])
+        del mapped
+        reader.close()
+    finally:
+        shm.close()
+        shm.unlink()
+    with pytest.raises(ValueError):
+        share_columns({"names": np.array(["a", "b"], dtype=object)})
+
+def test_offloaded_esg_scores_match_in_process(pool):
+    orders = _orders(num_farmers=300, num_orders=20000)
+    expected = calculate_esg_scores(orders, farmer_ids=range(1, 302))
+    scores = asyncio.run(calculate_esg_scores_offloaded(pool, orders, farmer_ids=range(1, 302)))
+    pd.testing.assert_frame_equal(scores, expected)
+    empty = asyncio.run(calculate_esg_scores_offloaded(pool, pd.DataFrame(columns=["farmer_id", "product_id", "quantity"]), [1]))
+    assert empty["esg_score"].tolist() == [0.0]
+
+def test_pool_rejects_when_full_and_times_out(pool):
+    async def scenario():
+        pool.max_pending = 1
+        try:
+            slow = asyncio.ensure_future(pool.submit(time.sleep, 0.5))
+            await asyncio.sleep(0)
+            with pytest.raises(ProcessPoolBusy):
+                await pool.submit(time.sleep, 0)
+            await slow
+        finally:
+            pool.max_pending = 4
+        with pytest.raises(ProcessPoolTimeout):
+            await pool.submit(time.sleep, 0.5, timeout_s=0.05)
+        assert pool.stats()["pending"] == 1 # The worker is still sleeping
+        while pool.stats()["pending"]:
+            await asyncio.sleep(0.01)
+    asyncio.run(scenario())
+    assert pool.stats()["rejected"] >= 1 and pool.stats()["timed_out"] >= 1
+
+def test_timed_out_task_keeps_its_shared_memory_until_the_worker_finishes(pool, monkeypatch):
+    shared = []
+    def share(columns):
+        shm, spec = share_columns(columns)
+        shared.append(spec["name"])
+        return shm, spec
+    monkeypatch.setattr(process_pool, "share_columns", share)
+
+    async def scenario():
+        with pytest.raises(ProcessPoolTimeout):
+            await pool.submit_columns(_sum_after, {"values": np.arange(1000, dtype=np.float64)}, 0.5, timeout_s=0.05)
+        SharedMemory(name=shared[0]).close() # Not unlinked while the worker may still attach to it
+        while pool.stats()["pending"]:
+            await asyncio.sleep(0.01)
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=shared[0])
+        assert await pool.submit_columns(_sum_after, {"values": np.arange(1000, dtype=np.float64)}, 0) == 499500.0
+    asyncio.run(scenario())
+
+def test_light_request_p99_stays_flat_while_esg_jobs_run(pool):
+    """
+    Sync endpoints run in the thread pool; ESG jobs on the process pool must not stall them the way the
+    same jobs run in that thread pool (holding the GIL) do.
+    """
+    if (os.cpu_count() or 1) < 3:
+        pytest.skip("Needs a core per pool worker plus one for the event loop, or the jobs compete with it for CPU")
+    orders = _orders(num_farmers=10000, num_orders=2_000_000)
+
+    def light_handler():
+        return sum(range(200)) # Stands in for a cheap endpoint like GET /products
+
+    async def light_p99_ms(running) -> float:
+        latencies = []
+        while running() or not latencies:
+            started = time.perf_counter()
+            await asyncio.to_thread(light_handler)
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.002)
+        return float(np.percentile(latencies, 99)) * 1000
+
+    async def p99_while_running(run_job) -> float:
+        jobs = [asyncio.ensure_future(run_job()) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        p99 = await light_p99_ms(lambda: not all(job.done() for job in jobs)) # Measured for as long as the jobs run
+        await asyncio.gather(*jobs)
+        return p99
+
+    async def scenario():
+        deadline = time.perf_counter() + 0.5
+        baseline = await light_p99_ms(lambda: time.perf_counter() < deadline)
+        offloaded = await p99_while_running(lambda: calculate_esg_scores_offloaded(pool, orders))
+        in_threads = await p99_while_running(lambda: asyncio.to_thread(calculate_esg_scores, orders))
+        return baseline, offloaded, in_threads
+
+    p99_baseline, p99_offloaded, p99_in_threads = asyncio.run(scenario())
+    latencies = f"p99 {p99_baseline:.2f} ms idle, {p99_offloaded:.2f} ms with offloaded jobs, {p99_in_threads:.2f} ms with jobs in threads"
+    assert p99_offloaded < 3 * p99_baseline + 1.0, latencies
+    assert p99_offloaded < p99_in_threads, latencies
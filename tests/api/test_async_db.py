@@ -0,0 +1,48 @@
+import asyncio
+import os
+import tempfile
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from api.main import async_database_url
+from api.models import Base, Order
+from api.services.pagination import paginate, paginate_async
+
+def test_async_database_url_swaps_in_async_drivers():
+    assert async_database_url("mysql+pymysql://user:secret@db:3306/agribridge") == "mysql+aiomysql://user:secret@db:3306/agribridge"
+    assert async_database_url("sqlite:///./agribridge.db") == "sqlite+aiosqlite:///./agribridge.db"
+    assert async_database_url("mysql+asyncmy://user:secret@db/agribridge") == "mysql+asyncmy://user:secret@db/agribridge"
+
+def test_paginate_async_matches_paginate():
+    path = os.path.join(tempfile.mkdtemp(), "orders.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(Order.__table__.insert(), [
+            {"id": i, "tenant_id": 1 if i % 3 else 2, "product_id": 1, "quantity": 1, "total_price": 1.0, "buyer_id": 1,
+             "status": "pending" if i % 2 else "completed"}
+            for i in range(1, 61)
+        ])
+    db = sessionmaker(bind=engine)()
+    expected, cursor = [], None
+    while True:
+        rows, cursor = paginate(db.query(Order).filter(Order.tenant_id == 1, Order.status == "pending"), Order.id, 1, 4, cursor=cursor, descending=True)
+        expected.extend(row.id for row in rows)
+        if cursor is None:
+            break
+    db.close()
+
+    async def read_all_pages():
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        seen, cursor = [], None
+        async with async_sessionmaker(async_engine)() as session:
+            statement = select(Order).where(Order.tenant_id == 1, Order.status == "pending")
+            while True:
+                rows, cursor = await paginate_async(session, statement, Order.id, 1, 4, cursor=cursor, descending=True)
+                seen.extend(row.id for row in rows)
+                if cursor is None:
+                    break
+        await async_engine.dispose()
+        return seen
+
+    assert asyncio.run(read_all_pages()) == expected == sorted((i for i in range(1, 61) if i % 3 and i % 2), reverse=True)
@@ -1,6 +1,6 @@
 import pytest
 from fastapi.testclient import TestClient
-from api.main import app, settings, create_access_token
+from api.main import app, settings, create_access_token, revoke_token, token_cache
 from datetime import timedelta, datetime, timezone
 from jose import jwt
 
@@ -76,3 +76,26 @@ def test_protected_route_access_with_expired_token():
     )
     assert response.status_code == 401
     assert "Signature has expired" in response.json()["detail"]
+
+def test_reused_token_is_verified_once():
+    access_token = create_access_token(data={"sub": "testuser", "tenant_id": 1}, expires_delta=timedelta(minutes=1))
+    hits = token_cache.stats()["hits"]
+    for _ in range(3):
+        response = client.get("/api/v1/protected", headers={"Authorization": f"Bearer {access_token}"})
+        assert response.status_code == 200
+    assert token_cache.stats()["hits"] == hits + 2
+
+def test_revoked_token_is_refused():
+    access_token = create_access_token(data={"sub": "testuser", "tenant_id": 1}, expires_delta=timedelta(minutes=1))
+    headers = {"Authorization": f"Bearer {access_token}"}
+    assert client.get("/api/v1/protected", headers=headers).status_code == 200
+    assert revoke_token(access_token)
+    response = client.get("/api/v1/protected", headers=headers)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Token has been revoked"
+
+def test_token_without_tenant_is_refused():
+    access_token = create_access_token(data={"sub": "testuser"}, expires_delta=timedelta(minutes=1))
+    response = client.get("/api/v1/protected", headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Could not validate credentials"
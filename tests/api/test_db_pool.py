@@ -0,0 +1,68 @@
+import asyncio
+import os
+import tempfile
+import pytest
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from api.services.db_pool import PoolMonitor, pool_options
+
+def database_path() -> str:
+    return os.path.join(tempfile.mkdtemp(), "pool.db")
+
+def test_pool_options_size_and_monitor_server_databases():
+    monitor = PoolMonitor()
+    options = pool_options("mysql+pymysql://user:secret@db/agribridge", monitor, QueuePool,
+                           pool_size=5, max_overflow=2, timeout_s=3.0, recycle_s=1800, pre_ping=True)
+    assert issubclass(options.pop("poolclass"), QueuePool)
+    assert options == {"pool_size": 5, "max_overflow": 2, "pool_timeout": 3.0, "pool_recycle": 1800, "pool_pre_ping": True}
+    assert pool_options("sqlite://", monitor, QueuePool, 5, 2, 3.0, 1800, True) == {"pool_pre_ping": True}
+
+def test_monitor_records_overflow_waits_timeouts_and_invalidations():
+    monitor = PoolMonitor()
+    engine = create_engine(f"sqlite:///{database_path()}", poolclass=monitor.pool_class(QueuePool),
+                           pool_size=1, max_overflow=1, pool_timeout=0.2, pool_pre_ping=True)
+    monitor.attach(engine)
+
+    first, second = engine.connect(), engine.connect()
+    stats = monitor.stats()
+    assert (stats["checkouts"], stats["checked_out"], stats["overflow"]) == (2, 2, 1)
+    assert (stats["peak_checked_out"], stats["peak_overflow"], stats["connects"]) == (2, 1, 2)
+
+    # Pool exhausted: the third checkout waits pool_timeout, then fails
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    stats = monitor.stats()
+    assert stats["timeouts"] == 1 and stats["wait_ms_max"] >= 150
+
+    second.invalidate()
+    second.close()
+    first.close()
+    assert monitor.stats()["invalidations"] == 1
+    assert monitor.stats()["checked_out"] == 0
+
+    # engine.dispose() builds a new pool of the same class, still reporting to the monitor
+    engine.dispose()
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    stats = monitor.stats()
+    assert (stats["checkouts"], stats["checked_out"], stats["connects"]) == (3, 0, 3)
+
+def test_monitor_on_an_async_engine():
+    async def run():
+        monitor = PoolMonitor()
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database_path()}", poolclass=monitor.pool_class(AsyncAdaptedQueuePool),
+                                     pool_size=2, max_overflow=0)
+        monitor.attach(engine.sync_engine)
+
+        async def query():
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(*(query() for _ in range(4))) # Two of the four wait for a connection
+        await engine.dispose()
+        return monitor.stats()
+
+    stats = asyncio.run(run())
+    assert stats["checkouts"] == 4 and stats["peak_checked_out"] == 2 and stats["wait_ms_max"] >= 30
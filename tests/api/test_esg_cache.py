@@ -0,0 +1,54 @@
+import threading
+import time
+import pytest
+from api.main import redis_client
+from api.services.esg_cache import ESGReportCache
+
+TENANT_ID = 9901 # Keys of this test tenant are removed after each test
+
+@pytest.fixture(scope="function")
+def cache():
+    yield ESGReportCache(redis_client, ttl_s=60, wait_timeout_ms=2000, poll_interval_ms=10)
+    for key in redis_client.scan_iter(f"esg:{TENANT_ID}:*"):
+        redis_client.delete(key)
+
+def _report(score: float):
+    return {"farmer_name": "Test Farm", "esg_score": score, "social_impact": {}, "environmental_impact": {}}
+
+def test_esg_cache_hits_until_invalidated(cache):
+    calls = []
+    compute = lambda: calls.append(1) or _report(10.0 * len(calls))
+    assert cache.get_or_compute(TENANT_ID, 1, compute)["esg_score"] == 10.0
+    assert cache.get_or_compute(TENANT_ID, 1, compute)["esg_score"] == 10.0
+    assert len(calls) == 1
+
+    cache.invalidate(TENANT_ID, 1) # e.g. a new order for one of the farmer's products
+    assert cache.get_or_compute(TENANT_ID, 1, compute)["esg_score"] == 20.0
+    assert cache.get_or_compute(TENANT_ID, 2, lambda: None) is None # Unknown farmers are not cached
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (1, 3, 1)
+
+def test_esg_cache_recomputes_once_under_concurrent_misses(cache):
+    calls = []
+    def slow_compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return _report(42.0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute(TENANT_ID, 3, slow_compute))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [r["esg_score"] for r in results] == [42.0] * 8
+    assert cache.stats()["wait_hits"] == 7
+
+def test_esg_cache_serves_expired_report_while_another_worker_refreshes(cache):
+    cache.ttl_s = 0 # Every cached report is immediately past its freshness TTL
+    assert cache.get_or_compute(TENANT_ID, 4, lambda: _report(1.0))["esg_score"] == 1.0
+    redis_client.set(f"esg:{TENANT_ID}:4:lock:0", "other-worker", px=5000) # Someone else is refreshing
+    assert cache.get_or_compute(TENANT_ID, 4, lambda: _report(2.0))["esg_score"] == 1.0
+    assert cache.stats()["stale_hits"] == 1
+    redis_client.delete(f"esg:{TENANT_ID}:4:lock:0")
+    assert cache.get_or_compute(TENANT_ID, 4, lambda: _report(2.0))["esg_score"] == 2.0
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from api.models import Base, Farmer, Order, Product, Tenant
+from api.services.esg_calculator import (
+    build_esg_report, calculate_esg_score, calculate_esg_scores, calculate_farmer_esg_score_sql,
+    calculate_farmer_esg_score_streaming, iter_farmer_order_chunks, recalculate_esg_scores,
+)
+from api.services.esg_stats import check_esg_consistency, rebuild_esg_stats, record_order
+
+def _random_orders(num_farmers: int, num_orders: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    farmer_ids = rng.integers(1, num_farmers + 1, size=num_orders)
+    return pd.DataFrame({
+        "farmer_id": farmer_ids,
+        "product_id": farmer_ids * 100 + rng.integers(0, 6, size=num_orders), # Products belong to one farmer
+        "quantity": rng.integers(0, 60, size=num_orders),
+    })
+
+def test_batch_esg_scores_match_scalar_function():
+    orders = _random_orders(num_farmers=200, num_orders=5000)
+    scores = calculate_esg_scores(orders, farmer_ids=range(1, 206)).set_index("farmer_id")
+    assert len(scores) == 205
+    for farmer_id, farmer_orders in orders.groupby("farmer_id"):
+        expected, _, _ = calculate_esg_score(farmer_orders[["product_id", "quantity"]])
+        assert scores.loc[farmer_id, "esg_score"] == expected # Bit-for-bit, not approximately
+    assert scores.loc[205, "esg_score"] == calculate_esg_score(pd.DataFrame(columns=["product_id", "quantity"]))[0]
+
+    env = {"carbon_reduction": 3.5}
+    env_scores = calculate_esg_scores(orders, environmental_data=env).set_index("farmer_id")
+    assert env_scores.loc[7, "esg_score"] == calculate_esg_score(orders[orders.farmer_id == 7], env)[0]
+
+def _session():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+def test_recalculate_esg_scores_writes_back_in_bulk():
+    db = _session()
+    db.add_all([Tenant(id=1, name="T1"), Tenant(id=2, name="T2")])
+    db.add_all([Farmer(id=1, tenant_id=1, name="A"), Farmer(id=2, tenant_id=1, name="B"), Farmer(id=3, tenant_id=2, name="C", esg_score=42.0)])
+    db.add_all([Product(id=10, tenant_id=1, farmer_id=1, price=1.0), Product(id=11, tenant_id=1, farmer_id=1, price=1.0),
+                Product(id=30, tenant_id=2, farmer_id=3, price=1.0)])
+    db.add_all([Order(tenant_id=1, product_id=10, quantity=100), Order(tenant_id=1, product_id=11, quantity=20),
+                Order(tenant_id=2, product_id=30, quantity=5)])
+    db.commit()
+
+    assert recalculate_esg_scores(db, tenant_id=1) == 2
+    expected = calculate_esg_score(pd.DataFrame({"product_id": [10, 11], "quantity": [100, 20]}))[0]
+    assert db.get(Farmer, 1).esg_score == expected
+    assert db.get(Farmer, 2).esg_score == 0.0 # No orders
+    assert db.get(Farmer, 3).esg_score == 42.0 # Other tenant untouched
+    assert build_esg_report(db, 1, 1)["esg_score"] == expected
+    assert build_esg_report(db, 2, 1) is None # Farmer 1 belongs to tenant 1
+    db.close()
+
+def test_incremental_esg_stats_match_full_recalculation():
+    db = _session()
+    db.add(Tenant(id=1, name="T1"))
+    db.add(Farmer(id=1, tenant_id=1, name="A", esg_score=75.5, total_sales=5000.0)) # Stale demo values
+    products = [Product(id=100 + i, tenant_id=1, farmer_id=1, price=1.0) for i in range(5)]
+    db.add_all(products)
+    db.add(Order(tenant_id=1, product_id=100, quantity=7)) # Placed before stats existed
+    db.commit()
+    assert [m["farmer_id"] for m in check_esg_consistency(db)] == [1]
+
+    rng = np.random.default_rng(0)
+    for _ in range(40):
+        product = products[int(rng.integers(0, 5))]
+        quantity = int(rng.integers(1, 50))
+        record_order(db, product, quantity) # The first call backfills from the existing order
+        db.add(Order(tenant_id=1, product_id=product.id, quantity=quantity))
+        db.commit()
+        assert check_esg_consistency(db) == []
+
+    # The repair job reproduces the incrementally maintained values exactly
+    farmer = db.get(Farmer, 1)
+    incremental = (farmer.esg_score, farmer.total_sales)
+    db.query(Farmer).filter(Farmer.id == 1).update({"esg_score": 0.0})
+    db.commit()
+    assert rebuild_esg_stats(db, tenant_id=1) == 1
+    farmer = db.get(Farmer, 1)
+    assert (farmer.esg_score, farmer.total_sales) == incremental
+    assert check_esg_consistency(db, tenant_id=1) == []
+    db.close()
+
+def test_streaming_and_sql_esg_scores_match_in_memory_path():
+    db = _session()
+    db.add(Tenant(id=1, name="T1"))
+    db.add_all([Farmer(id=1, tenant_id=1, name="Co-op"), Farmer(id=2, tenant_id=1, name="Empty")])
+    db.add_all([Product(id=100 + i, tenant_id=1, farmer_id=1, price=1.0) for i in range(7)])
+    db.commit()
+    orders = _random_orders(num_farmers=1, num_orders=25000)
+    orders["product_id"] = 100 + orders["product_id"] % 7
+    db.execute(Order.__table__.insert(), [
+        {"tenant_id": 1, "product_id": int(p), "quantity": int(q)} for p, q in zip(orders["product_id"], orders["quantity"])
+    ])
+    db.commit()
+
+    expected = calculate_esg_score(orders[["product_id", "quantity"]])
+    chunk_sizes = [len(chunk) for chunk in iter_farmer_order_chunks(db, 1, chunk_size=1000)]
+    assert len(chunk_sizes) == 25 and max(chunk_sizes) == 1000 # Never more than one chunk in memory
+    assert calculate_farmer_esg_score_streaming(db, 1, chunk_size=1000) == expected
+    assert calculate_farmer_esg_score_sql(db, 1) == expected
+    assert calculate_farmer_esg_score_sql(db, 2) == calculate_farmer_esg_score_streaming(db, 2) == calculate_esg_score(orders.iloc[:0])
+    db.close()
@@ -1,8 +1,11 @@
 import pytest
 from fastapi.testclient import TestClient
-from api.main import app, create_access_token, settings
+from api.main import app, create_access_token, settings, SessionLocal
+from api.models import Order, Product, Tenant
+from api.routes import financial
 from datetime import timedelta
 import os
+import uuid
 
 client = TestClient(app)
 
@@ -11,29 +14,45 @@ def auth_headers():
     token = create_access_token(data={"sub": "testuser", "tenant_id": 1}, expires_delta=timedelta(minutes=60))
     return {"Authorization": f"Bearer {token}"}
 
-def test_process_payment_stripe_success(auth_headers, monkeypatch):
+@pytest.fixture(scope="function")
+def order_id():
+    """A new pending order of tenant 1; a payment claims its order, so each test pays its own."""
+    db = SessionLocal()
+    try:
+        if db.get(Tenant, 1) is None:
+            db.add(Tenant(id=1, name="Test Tenant"))
+        if db.get(Product, 1101) is None:
+            db.add(Product(id=1101, tenant_id=1, name="Test Product for Payment", price=10.0))
+        order = Order(tenant_id=1, product_id=1101, quantity=5, total_price=50.0, buyer_id=60, status="pending")
+        db.add(order)
+        db.commit()
+        return order.id
+    finally:
+        db.close()
+
+def test_process_payment_stripe_success(auth_headers, order_id, monkeypatch):
     monkeypatch.setenv("STRIPE_API_KEY", "pk_test_valid_stripe_key")
     response = client.post(
         "/api/v1/payments",
-        json={"order_id": 1, "amount": 50.0, "currency": "TWD", "payment_method": "stripe"},
+        json={"order_id": order_id, "amount": 50.0, "currency": "TWD", "payment_method": "stripe"},
         headers=auth_headers
     )
     assert response.status_code == 200
     assert response.json()["status"] == "completed"
     assert "transaction_id" in response.json()
-    assert response.json()["order_id"] == 1
+    assert response.json()["order_id"] == order_id
 
-def test_process_payment_newebpay_success(auth_headers, monkeypatch):
+def test_process_payment_newebpay_success(auth_headers, order_id, monkeypatch):
     monkeypatch.setenv("NEWEPAY_API_KEY", "valid_newebpay_key")
     response = client.post(
         "/api/v1/payments",
-        json={"order_id": 2, "amount": 120.0, "currency": "TWD", "payment_method": "newebpay"},
+        json={"order_id": order_id, "amount": 120.0, "currency": "TWD", "payment_method": "newebpay"},
         headers=auth_headers
     )
     assert response.status_code == 200
     assert response.json()["status"] == "completed"
     assert "transaction_id" in response.json()
-    assert response.json()["order_id"] == 2
+    assert response.json()["order_id"] == order_id
 
 def test_process_payment_unsupported_method(auth_headers):
     response = client.post(
@@ -44,6 +63,28 @@ def test_process_payment_unsupported_method(auth_headers):
     assert response.status_code == 400
     assert response.json()["detail"] == "Unsupported payment method"
 
+def test_process_payment_idempotency_key_replays_first_response(auth_headers, order_id):
+    headers = {**auth_headers, "Idempotency-Key": f"pay-{uuid.uuid4()}"}
+    payment = {"order_id": order_id, "amount": 75.0, "currency": "TWD", "payment_method": "stripe"}
+    first = client.post("/api/v1/payments", json=payment, headers=headers)
+    retry = client.post("/api/v1/payments", json=payment, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json()["transaction_id"] == first.json()["transaction_id"]
+    assert retry.headers["Idempotent-Replayed"] == "true" and "Idempotent-Replayed" not in first.headers
+
+    # Reusing the key for a different payment is rejected
+    response = client.post("/api/v1/payments", json={**payment, "amount": 80.0}, headers=headers)
+    assert response.status_code == 422
+
+def test_paid_order_cannot_be_charged_again(auth_headers, order_id, monkeypatch):
+    charges = []
+    monkeypatch.setattr(financial, "_call_gateway", lambda payment_request: charges.append(1) or "completed")
+    payment = {"order_id": order_id, "amount": 50.0, "currency": "TWD", "payment_method": "stripe"}
+    statuses = [client.post("/api/v1/payments", json=payment, headers={**auth_headers, "Idempotency-Key": f"pay-{uuid.uuid4()}"}).status_code
+                for _ in range(2)]
+    assert statuses == [200, 409] and len(charges) == 1
+    assert client.post("/api/v1/payments", json={**payment, "order_id": 999999}, headers=auth_headers).status_code == 409
+
 def test_get_transactions(auth_headers):
     response = client.get("/api/v1/ledger/transactions", headers=auth_headers)
     assert response.status_code == 200
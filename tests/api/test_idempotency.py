@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+import pytest
+from api.main import redis_client
+from api.services.idempotency import IdempotencyInProgress, IdempotencyKeyInvalid, IdempotencyKeyReused, IdempotencyStore
+
+TENANT_ID = 9902 # Keys of this test tenant are removed after each test
+
+class CountingRedis:
+    """Passes calls through to the real client, counting them by command."""
+    def __init__(self, client):
+        self.client = client
+        self.calls = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name == "register_script":
+            return attribute
+        def call(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return attribute(*args, **kwargs)
+        return call
+
+@pytest.fixture(scope="function")
+def redis():
+    yield CountingRedis(redis_client)
+    for key in redis_client.scan_iter(f"idem:{TENANT_ID}:*"):
+        redis_client.delete(key)
+
+def test_retry_replays_the_stored_response_with_one_get(redis):
+    store = IdempotencyStore(redis, ttl_s=60)
+    calls = []
+    compute = lambda: calls.append(1) or {"transaction_id": f"txn-{len(calls)}"}
+    assert store.run(TENANT_ID, "POST /payments", "key-1", {"amount": 50.0}, compute) == ({"transaction_id": "txn-1"}, False)
+
+    redis.calls.clear()
+    assert store.run(TENANT_ID, "POST /payments", "key-1", {"amount": 50.0}, compute) == ({"transaction_id": "txn-1"}, True)
+    assert redis.calls == {"get": 1} and len(calls) == 1
+
+    # Keys are scoped per operation, and a request without a key always runs
+    assert store.run(TENANT_ID, "POST /orders", "key-1", {"amount": 50.0}, compute)[0] == {"transaction_id": "txn-2"}
+    assert store.run(TENANT_ID, "POST /payments", None, {"amount": 50.0}, compute)[0] == {"transaction_id": "txn-3"}
+    with pytest.raises(IdempotencyKeyReused):
+        store.run(TENANT_ID, "POST /payments", "key-1", {"amount": 99.0}, compute)
+    with pytest.raises(IdempotencyKeyInvalid):
+        store.run(TENANT_ID, "POST /payments", "", {"amount": 50.0}, compute)
+    assert store.stats()["executed"] == 2 and store.stats()["replayed"] == 1 and store.stats()["mismatches"] == 1
+
+def test_concurrent_duplicates_wait_and_replay(redis):
+    store = IdempotencyStore(redis, ttl_s=60, wait_timeout_ms=2000, poll_interval_ms=10)
+    calls = []
+    def slow_compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"order_id": 7}
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.run(TENANT_ID, "POST /orders", "key-2", {"q": 1}, slow_compute)))
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(replayed for _, replayed in results) == [False] + [True] * 5
+    assert all(response == {"order_id": 7} for response, _ in results)
+    assert store.stats()["waited"] == 5
+
+def test_failed_request_releases_the_key_and_slow_duplicates_get_409(redis):
+    store = IdempotencyStore(redis, ttl_s=60, wait_timeout_ms=50, poll_interval_ms=10)
+    def failing():
+        raise RuntimeError("gateway down")
+    with pytest.raises(RuntimeError):
+        store.run(TENANT_ID, "POST /payments", "key-3", {"amount": 1.0}, failing)
+    assert store.run(TENANT_ID, "POST /payments", "key-3", {"amount": 1.0}, lambda: {"ok": True}) == ({"ok": True}, False)
+
+    async def slow():
+        await asyncio.sleep(0.3)
+        return {"ok": True}
+
+    async def duplicate_while_running():
+        first = asyncio.create_task(store.run_async(TENANT_ID, "POST /orders", "key-4", {"q": 2}, slow))
+        await asyncio.sleep(0.05)
+        with pytest.raises(IdempotencyInProgress):
+            await store.run_async(TENANT_ID, "POST /orders", "key-4", {"q": 2}, slow)
+        assert await first == ({"ok": True}, False)
+        assert await store.run_async(TENANT_ID, "POST /orders", "key-4", {"q": 2}, slow) == ({"ok": True}, True)
+
+    asyncio.run(duplicate_while_running())
+    assert store.stats()["conflicts"] == 1
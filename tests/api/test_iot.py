@@ -1,7 +1,9 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
 from api.main import app, create_access_token
 from datetime import timedelta
+import json
 from api.routes.iot import mock_iot_data_store # Import the in-memory store for inspection
 
 client = TestClient(app)
@@ -81,3 +83,425 @@ def test_iot_data_multi_tenancy_isolation(auth_headers, other_tenant_auth_header
     assert response.status_code == 200
     assert len(response.json()) == 1
     assert response.json()[0]["humidity"] == 50.0
+
+def test_iot_series_ring_buffer_is_bounded():
+    from api.services.iot_store import DeviceSeries
+    series = DeviceSeries("sensor-ring", capacity=3)
+    for i in range(5):
+        series.append(1_000 * i, (float(i), None, None, None))
+    assert len(series) == 3
+    timestamps, values = series.tail(10)
+    assert list(timestamps) == [2_000, 3_000, 4_000]
+    assert list(values[0]) == [2.0, 3.0, 4.0]
+    assert series[0].temperature == 2.0
+    assert series[-1].humidity is None
+
+def test_receive_iot_data_bulk_ndjson(auth_headers, clear_iot_data_store):
+    body = "\n".join([
+        '{"device_id": "sensor-bulk", "timestamp": "2023-01-01T10:00:00Z", "temperature": 21.0}',
+        '{"device_id": "sensor-bulk", "timestamp": "2023-01-01T10:00:10Z", "humidity": "wet"}',
+        'not json',
+        '{"device_id": "sensor-bulk", "timestamp": "2023-01-01T10:00:20Z", "temperature": 22.0}',
+    ])
+    response = client.post(
+        "/api/v1/iot/data/bulk",
+        content=body.encode("utf-8"),
+        headers={**auth_headers, "Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    assert response.json()["accepted"] == 2
+    assert response.json()["rejected"] == 2
+    assert [e["row"] for e in response.json()["errors"]] == [1, 2]
+    assert len(mock_iot_data_store[1]["sensor-bulk"]) == 2
+    assert mock_iot_data_store[1]["sensor-bulk"][-1].temperature == 22.0
+
+def test_receive_iot_data_bulk_rejects_out_of_range_timestamps_and_long_device_ids(auth_headers, clear_iot_data_store):
+    body = "\n".join([
+        '{"device_id": "sensor-bulk", "timestamp": 1672567200000, "temperature": 21.0}',
+        '{"device_id": "sensor-bulk", "timestamp": 1000000000000000000000000000000, "temperature": 21.5}',
+        json.dumps({"device_id": "s" * 65, "timestamp": 1672567210000, "temperature": 22.0}),
+        '{"device_id": "sensor-bulk", "timestamp": 1672567220000, "temperature": 22.5}',
+    ])
+    response = client.post(
+        "/api/v1/iot/data/bulk",
+        content=body.encode("utf-8"),
+        headers={**auth_headers, "Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    assert response.json()["accepted"] == 2
+    assert response.json()["errors"] == [
+        {"row": 1, "detail": "timestamp is out of range"},
+        {"row": 2, "detail": "device_id must be at most 64 characters"},
+    ]
+    assert len(mock_iot_data_store[1]["sensor-bulk"]) == 2
+
+def test_receive_iot_data_bulk_unsupported_content_type(auth_headers, clear_iot_data_store):
+    response = client.post(
+        "/api/v1/iot/data/bulk",
+        content=b"<xml/>",
+        headers={**auth_headers, "Content-Type": "application/xml"}
+    )
+    assert response.status_code == 415
+
+def test_decode_msgpack_checks_the_row_limit_from_the_array_header():
+    msgpack = pytest.importorskip("msgpack")
+    from api.services import iot_ingest
+
+    async def chunks(body: bytes, size: int):
+        for start in range(0, len(body), size):
+            yield body[start:start + size]
+
+    readings = [{"device_id": "sensor-mp", "timestamp": 1_672_567_200_000 + i, "temperature": 20.0} for i in range(3)]
+    body = msgpack.packb(readings) + msgpack.packb({"device_id": "sensor-mp", "temperature": 21.0})
+    assert asyncio.run(iot_ingest.decode_msgpack(chunks(body, 7), 4)) == readings + [{"device_id": "sensor-mp", "temperature": 21.0}]
+    with pytest.raises(iot_ingest.IoTBatchTooLarge):
+        asyncio.run(iot_ingest.decode_msgpack(chunks(body, 7), 3))
+    # A header announcing more rows than allowed is refused before any row arrives
+    with pytest.raises(iot_ingest.IoTBatchTooLarge):
+        asyncio.run(iot_ingest.decode_msgpack(chunks(b"\xdd" + (10_000_000).to_bytes(4, "big"), 64), 1000))
+
+def test_get_iot_data_bucketed_aggregation(auth_headers, clear_iot_data_store):
+    device_id = "sensor-agg"
+    for minute, temperature in [(0, 20.0), (0.5, 22.0), (1, 30.0), (2, 10.0)]:
+        seconds = int(minute * 60)
+        client.post(
+            "/api/v1/iot/data",
+            json={"device_id": device_id, "timestamp": f"2023-01-01T10:{seconds // 60:02d}:{seconds % 60:02d}Z", "temperature": temperature},
+            headers=auth_headers
+        )
+    response = client.get(
+        f"/api/v1/iot/data/{device_id}?since=2023-01-01T10:00:00Z&until=2023-01-01T10:01:59Z&bucket=1m&agg=mean",
+        headers=auth_headers
+    )
+    assert response.status_code == 200
+    assert [p["temperature"] for p in response.json()] == [21.0, 30.0]
+    assert response.json()[0]["humidity"] is None
+
+def test_get_iot_data_lttb_and_invalid_bucket(auth_headers, clear_iot_data_store):
+    device_id = "sensor-lttb"
+    rows = [{"device_id": device_id, "timestamp": 1_672_567_200_000 + i * 1000, "temperature": float(i % 17)} for i in range(500)]
+    client.post(
+        "/api/v1/iot/data/bulk",
+        content="\n".join(json.dumps(row) for row in rows).encode("utf-8"),
+        headers={**auth_headers, "Content-Type": "application/x-ndjson"}
+    )
+    response = client.get(f"/api/v1/iot/data/{device_id}?points=50", headers=auth_headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 50
+
+    response = client.get(f"/api/v1/iot/data/{device_id}?bucket=fortnight", headers=auth_headers)
+    assert response.status_code == 400
+
+def test_iot_data_late_and_duplicate_readings_stay_ordered(auth_headers, clear_iot_data_store):
+    device_id = "sensor-late"
+    for timestamp, temperature in [("10:00:00", 20.0), ("10:02:00", 22.0), ("10:01:00", 21.0), ("10:02:00", 23.0)]:
+        client.post(
+            "/api/v1/iot/data",
+            json={"device_id": device_id, "timestamp": f"2023-01-01T{timestamp}Z", "temperature": temperature},
+            headers=auth_headers
+        )
+    response = client.get(f"/api/v1/iot/data/{device_id}?limit=2", headers=auth_headers)
+    assert response.status_code == 200
+    # The late 10:01 reading is merged into place and the duplicate 10:02 reading replaces the first
+    assert [p["temperature"] for p in response.json()] == [21.0, 23.0]
+    assert len(mock_iot_data_store[1][device_id]) == 3
+
+def test_iot_write_behind_flushes_and_applies_backpressure():
+    import asyncio
+    import numpy as np
+    from sqlalchemy import create_engine, func, select
+    from sqlalchemy.pool import StaticPool
+    from api.models import Base, IoTReading
+    from api.services.iot_persistence import IoTQueueFull, IoTWriteBehindQueue
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine, tables=[IoTReading.__table__])
+    writer = IoTWriteBehindQueue(engine, max_pending_rows=10, batch_size=4, flush_interval_ms=20)
+
+    def columns(n, start=0):
+        values = np.full((4, n), np.nan)
+        values[0] = 20.0
+        return {"sensor-db": (np.arange(start, start + n, dtype=np.int64), values)}
+
+    async def scenario():
+        await writer.start()
+        writer.offer(1, columns(6))
+        with pytest.raises(IoTQueueFull):
+            writer.offer(1, columns(5, start=100)) # 6 + 5 rows would exceed the bound
+        writer.offer(1, columns(3, start=200))
+        await writer.stop()
+
+    asyncio.run(scenario())
+    with engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(IoTReading)).scalar() == 9
+        assert conn.execute(select(IoTReading.humidity).limit(1)).scalar() is None
+    assert writer.stats()["rejected_rows"] == 5
+    assert writer.stats()["queue_depth"] == 0
+
+def test_iot_write_behind_retries_requeues_and_dead_letters_only_bad_rows():
+    import asyncio
+    import numpy as np
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.exc import DataError, OperationalError
+    from sqlalchemy.pool import StaticPool
+    from api.models import Base, IoTReading
+    from api.services.iot_persistence import IoTWriteBehindQueue
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine, tables=[IoTReading.__table__])
+    writer = IoTWriteBehindQueue(engine, batch_size=100, flush_interval_ms=10, max_retries=1, retry_backoff_ms=1)
+    insert = writer._insert
+    outages = [2] # The first two INSERTs lose the connection: one flush exhausts its retry and is requeued
+
+    def flaky_insert(rows):
+        if outages[0]:
+            outages[0] -= 1
+            raise OperationalError("INSERT", {}, Exception("Lost connection to MySQL server"))
+        if any(row["device_id"] == "bad-device" and row["timestamp_ms"] == 3 for row in rows):
+            raise DataError("INSERT", {}, Exception("Data too long for column 'device_id'")) # As MySQL rejects an over-long id
+        insert(rows)
+    writer._insert = flaky_insert
+
+    def columns(device_id, n):
+        values = np.full((4, n), np.nan)
+        values[0] = np.arange(n, dtype=np.float64)
+        return {device_id: (np.arange(n, dtype=np.int64), values)}
+
+    async def scenario():
+        await writer.start()
+        writer.offer(1, columns("sensor-a", 10))
+        writer.offer(2, columns("bad-device", 6))
+        writer.offer(1, columns("sensor-b", 10))
+        await writer.stop()
+
+    asyncio.run(scenario())
+    with engine.connect() as conn:
+        stored = conn.execute(select(IoTReading.device_id, IoTReading.timestamp_ms)).all()
+    assert len(stored) == 25 # Every reading of every tenant except the bad one
+    assert ("bad-device", 3) not in stored
+    assert [(row["tenant_id"], row["device_id"], row["timestamp_ms"], row["temperature"]) for row in writer.dead_letters()] == [(2, "bad-device", 3, 3.0)]
+    stats = writer.stats()
+    assert stats["requeued_rows"] == 26 and stats["retries"] >= 1
+    assert stats["flushed_rows"] == 25 and stats["failed_rows"] == 1 and stats["queue_depth"] == 0
+
+def test_iot_segments_serve_cold_history(tmp_path):
+    import numpy as np
+    from api.services.iot_segments import IoTSegmentStore, read_history, read_latest
+    from api.services.iot_store import IoTTimeSeriesStore
+
+    segments = IoTSegmentStore(str(tmp_path), segment_max_records=8, retention_days=1)
+    hot = IoTTimeSeriesStore(capacity=5)
+    timestamps = np.arange(20, dtype=np.int64) * 1000
+    values = np.full((4, 20), np.nan)
+    values[0] = np.arange(20)
+    for start in range(0, 20, 4): # Several small flushes, as the write-behind pipeline would do
+        segments.append(1, "sensor/cold", timestamps[start:start + 4], values[:, start:start + 4])
+    hot.extend(1, "sensor/cold", timestamps, values) # Memory only keeps the newest 5
+
+    window_timestamps, window_values = read_history(hot, segments, 1, "sensor/cold", 2000, 17000)
+    assert list(window_timestamps) == list(range(2000, 18000, 1000))
+    assert list(read_latest(hot, segments, 1, "sensor/cold", 8)[1][0]) == list(range(12, 20))
+
+    # A reopened store rebuilds its index from disk; compaction drops expired segments and trims the rest
+    reopened = IoTSegmentStore(str(tmp_path), segment_max_records=8, retention_days=1)
+    assert reopened.compact(1, "sensor/cold", now_ms=86_400_000 + 10_000) == {"removed_segments": 1, "merged_segments": 1}
+    assert list(reopened.read_range(1, "sensor/cold")[0]) == list(range(10_000, 20_000, 1000))
+    assert read_history(hot, None, 1, "unknown-device") is None
+
+def test_iot_segment_reads_run_safely_during_compaction(tmp_path):
+    import sys
+    import threading
+    import numpy as np
+    from api.services.iot_segments import IoTSegmentStore
+
+    segments = IoTSegmentStore(str(tmp_path), segment_max_records=4096, retention_days=1)
+    # A reader that took its segments just before compaction dropped an expired one still sees its readings
+    recent = 86_400_000 + np.arange(1000, dtype=np.int64) * 1000
+    segments.append(1, "sensor-expired", recent, np.zeros((4, 1000)))
+    segments.append(1, "sensor-expired", np.arange(500, dtype=np.int64) * 1000, np.zeros((4, 500)))
+
+    class CompactAfterFirstRelease:
+        """Store lock that runs one compaction as soon as a reader has released it, before the reader opens any file."""
+        def __init__(self, lock):
+            self.lock, self.armed = lock, True
+        def __enter__(self):
+            self.lock.acquire()
+        def __exit__(self, *exc):
+            self.lock.release()
+            if self.armed:
+                self.armed = False
+                assert segments.compact(1, "sensor-expired", now_ms=2 * 86_400_000)["removed_segments"] == 1
+
+    lock = segments._lock
+    segments._lock = CompactAfterFirstRelease(lock)
+    assert len(segments.read_range(1, "sensor-expired")[0]) == 1500
+    segments._lock = lock
+    assert len(segments.read_range(1, "sensor-expired")[0]) == 1000
+
+    segments.retention_days = 180
+    timestamps = np.arange(2000, dtype=np.int64) * 1000
+    values = np.full((4, 2000), np.nan)
+    values[0] = np.arange(2000)
+    segments.append(1, "sensor-compact", timestamps, values)
+    stop, errors, reads = threading.Event(), [], []
+
+    def rewrite_and_compact():
+        try:
+            for round in range(100):
+                segments.append(1, "sensor-compact", timestamps[round % 10::10], values[:, round % 10::10])
+                segments.append(1, "sensor-compact", timestamps[round % 7::7], values[:, round % 7::7])
+                segments.compact(1, "sensor-compact", now_ms=2_000_000)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            stop.set()
+
+    def read():
+        try:
+            while not stop.is_set():
+                window, _ = segments.read_range(1, "sensor-compact", 100_000, 1_899_000)
+                latest, _ = segments.tail_before(1, "sensor-compact", None, 50)
+                reads.append((len(window), list(latest[[0, -1]])))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=rewrite_and_compact)] + [threading.Thread(target=read) for _ in range(2)]
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6) # Switch threads often so reads interleave with compaction
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    assert reads and all(read == (1800, [1_950_000, 1_999_000]) for read in reads)
+
+def test_iot_live_websocket_receives_ingested_readings(auth_headers, clear_iot_data_store):
+    token = auth_headers["Authorization"].split(" ", 1)[1]
+    with client.websocket_connect(f"/api/v1/iot/live/sensor-live?token={token}") as websocket:
+        client.post(
+            "/api/v1/iot/data",
+            json={"device_id": "sensor-live", "timestamp": "2023-01-01T10:00:00Z", "temperature": 24.5},
+            headers=auth_headers
+        )
+        frame = websocket.receive_json()
+        assert frame["device_id"] == "sensor-live"
+        assert frame["readings"][0]["temperature"] == 24.5
+        assert frame["readings"][0]["humidity"] is None
+        stats = client.get("/api/v1/iot/live/stats", headers=auth_headers).json()
+        assert stats["connections"] == 1
+        assert stats["topics"] == {"sensor-live": 1}
+
+def test_iot_live_hub_drops_oldest_frames_for_slow_subscribers():
+    import numpy as np
+    from api.services.iot_live import IoTLiveHub
+    hub = IoTLiveHub(max_queue=2)
+    slow = hub.subscribe(1, "sensor-fan")
+    fast = hub.subscribe(1, "sensor-fan")
+    for i in range(3):
+        hub.publish(1, "sensor-fan", np.array([i * 1000], dtype=np.int64), np.full((4, 1), float(i)))
+    assert len(slow.frames) == 2
+    assert slow.frames[0][0] is fast.frames[0][0] # One encoded frame shared by all subscribers
+    assert hub.stats()["dropped_frames"] == 2
+
+def test_iot_rule_engine_threshold_duration_and_rate_rules():
+    import numpy as np
+    from api.services.iot_rules import IoTRuleEngine
+    engine = IoTRuleEngine()
+    base = {"window_s": 0, "cooldown_s": 3600, "device_id": None, "line_user_id": None}
+    engine.add_rule(1, {**base, "name": "hot", "kind": "threshold", "channel": "temperature", "direction": "above", "value": 30.0})
+    engine.add_rule(1, {**base, "name": "dry", "kind": "duration", "channel": "soil_moisture", "direction": "below", "value": 25.0, "window_s": 600})
+    engine.add_rule(1, {**base, "name": "heating", "kind": "rate", "channel": "temperature", "direction": "rise", "value": 5.0, "window_s": 900})
+
+    timestamps = np.arange(20, dtype=np.int64) * 60_000
+    values = np.full((4, 20), np.nan)
+    values[0] = [20.0] * 8 + [26.0] * 4 + [31.0] * 8 # Rises by 6 at minute 8, crosses 30 at minute 12
+    values[2] = [30.0] * 5 + [20.0] * 15 # Dry from minute 5, so the duration rule fires at minute 15
+    alerts = engine.evaluate(1, "sensor-rules", timestamps, values)
+    assert [(a["rule_name"], a["timestamp_ms"] // 60_000) for a in alerts] == [("heating", 8), ("hot", 12), ("dry", 15)]
+
+    # Cooldown suppresses repeats until cooldown_s has passed in reading time
+    assert engine.evaluate(1, "sensor-rules", np.array([25 * 60_000], dtype=np.int64), values[:, -1:]) == []
+    later = engine.evaluate(1, "sensor-rules", np.array([80 * 60_000], dtype=np.int64), values[:, -1:])
+    assert [a["rule_name"] for a in later] == ["hot", "dry"] # Both conditions still hold; "heating" no longer does
+
+    with pytest.raises(ValueError):
+        engine.add_rule(1, {**base, "name": "bad", "kind": "rate", "channel": "temperature", "direction": "above", "value": 1.0})
+
+def test_iot_rules_api_fires_alerts_on_ingest(auth_headers, clear_iot_data_store, monkeypatch):
+    from api.routes import iot as iot_routes
+    fired = []
+    monkeypatch.setattr(iot_routes, "_dispatch_alerts", fired.extend)
+    response = client.post(
+        "/api/v1/iot/rules",
+        json={"name": "溫度過高", "kind": "threshold", "channel": "temperature", "direction": "above", "value": 30.0, "device_id": "sensor-alert"},
+        headers=auth_headers
+    )
+    assert response.status_code == 201
+    rule_id = response.json()["id"]
+    assert client.post("/api/v1/iot/rules", json={**response.json(), "channel": "wind"}, headers=auth_headers).status_code == 400
+
+    for device_id in ("sensor-alert", "sensor-other"):
+        client.post(
+            "/api/v1/iot/data",
+            json={"device_id": device_id, "timestamp": "2023-01-01T10:00:00Z", "temperature": 32.0},
+            headers=auth_headers
+        )
+    assert [(a["rule_id"], a["device_id"]) for a in fired] == [(rule_id, "sensor-alert")]
+
+    assert client.delete(f"/api/v1/iot/rules/{rule_id}", headers=auth_headers).status_code == 204
+    assert client.get("/api/v1/iot/rules", headers=auth_headers).json() == []
+    assert client.delete(f"/api/v1/iot/rules/{rule_id}", headers=auth_headers).status_code == 404
+
+def test_iot_device_stats_match_numpy_and_reset_each_period():
+    import numpy as np
+    from api.services.iot_stats import IoTDeviceStatsStore, HOUR_MS
+    stats = IoTDeviceStatsStore()
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(120, dtype=np.int64) * 60_000 # Two hours of minute readings
+    values = rng.normal(25.0, 3.0, size=(4, 120))
+    values[1, ::7] = np.nan
+    stats.update(1, "sensor-stats", timestamps[:50], values[:, :50]) # Bulk batch spanning no boundary
+    for i in range(50, 120): # Then one reading at a time across the hour boundary
+        stats.update(1, "sensor-stats", timestamps[i:i + 1], values[:, i:i + 1])
+
+    summary = stats.summary(1, "sensor-stats", now_ms=int(timestamps[-1]))
+    hourly, daily = summary["hourly"]["channels"], summary["daily"]["channels"]
+    second_hour = values[:, 60:]
+    assert hourly["temperature"]["count"] == 60
+    assert abs(hourly["temperature"]["mean"] - second_hour[0].mean()) < 1e-9
+    assert abs(hourly["temperature"]["stddev"] - second_hour[0].std()) < 1e-9
+    assert daily["humidity"]["count"] == int((~np.isnan(values[1])).sum())
+    assert abs(daily["humidity"]["stddev"] - np.nanstd(values[1])) < 1e-9
+    assert daily["temperature"]["min"] == values[0].min()
+    assert summary["hourly"]["since"].timestamp() * 1000 == HOUR_MS
+    assert summary["total_readings"] == 120
+
+    # A new hour with no readings yet reports empty channels
+    assert stats.summary(1, "sensor-stats", now_ms=3 * HOUR_MS)["hourly"]["channels"]["temperature"]["count"] == 0
+    assert stats.summary(1, "unknown-device") is None
+
+def test_iot_device_stats_endpoints(auth_headers, clear_iot_data_store):
+    from datetime import datetime, timezone
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    for device_id, temperature in (("sensor-s1", 20.0), ("sensor-s1", 30.0), ("sensor-s2", 18.0)):
+        client.post(
+            "/api/v1/iot/data",
+            json={"device_id": device_id, "timestamp": now.isoformat(), "temperature": temperature},
+            headers=auth_headers
+        )
+        now += timedelta(seconds=1)
+
+    response = client.get("/api/v1/iot/devices/sensor-s1/stats", headers=auth_headers)
+    assert response.status_code == 200
+    daily = response.json()["daily"]["channels"]
+    assert daily["temperature"]["count"] == 2
+    assert daily["temperature"]["mean"] == 25.0
+    assert daily["temperature"]["stddev"] == 5.0
+    assert daily["humidity"] == {"count": 0, "min": None, "max": None, "mean": None, "stddev": None}
+
+    devices = client.get("/api/v1/iot/devices", headers=auth_headers).json()
+    assert [d["device_id"] for d in devices if d["device_id"] in ("sensor-s1", "sensor-s2")] == ["sensor-s1", "sensor-s2"]
+    assert client.get("/api/v1/iot/devices/sensor-missing/stats", headers=auth_headers).status_code == 404
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from api.services.product_search import ProductSearchIndex, normalize
+
+ROWS = [
+    (1, "有機蘋果禮盒"),
+    (2, "台東有機蘋果"),
+    (3, "蘋果"),
+    (4, "高山烏龍茶"),
+    (5, "Organic Apple"),
+    (6, "ＡＰＰＬＥ Juice"),
+    (7, "有機蔬菜箱"),
+]
+
+def build(rows=ROWS, **kwargs) -> ProductSearchIndex:
+    index = ProductSearchIndex(**kwargs)
+    async def load():
+        return rows
+    asyncio.run(index.ensure_built(1, load))
+    return index
+
+def names(hits):
+    return [hit["name"] for hit in hits]
+
+def test_normalize_folds_width_and_case():
+    assert normalize("  ＡＰＰＬＥ,  Juice！") == "apple juice"
+    assert normalize("有機 蘋果") == "有機 蘋果"
+
+def test_prefix_matches_rank_before_contains_and_shorter_names_first():
+    hits = build().search(1, "蘋果")
+    assert names(hits) == ["蘋果", "有機蘋果禮盒", "台東有機蘋果"] # Equal lengths: lower id first
+    assert [hit["match"] for hit in hits] == ["prefix", "contains", "contains"]
+    assert names(build().search(1, "有機")) == ["有機蔬菜箱", "有機蘋果禮盒", "台東有機蘋果"]
+
+def test_prefix_only_and_single_character_queries():
+    index = build()
+    assert names(index.search(1, "有", prefix_only=True)) == ["有機蔬菜箱", "有機蘋果禮盒"]
+    assert names(index.search(1, "茶")) == ["高山烏龍茶"]
+    assert index.search(1, "茶", prefix_only=True) == []
+
+def test_matches_need_the_contiguous_query():
+    # 蘋果禮盒 and 有機 are both in product 1, but 果有 is in no name
+    index = build()
+    assert index.search(1, "蘋果有機") == []
+    assert names(index.search(1, "有機 禮盒")) == ["有機蘋果禮盒"]
+
+def test_latin_names_are_case_and_width_insensitive():
+    index = build()
+    assert names(index.search(1, "app")) == ["ＡＰＰＬＥ Juice", "Organic Apple"]
+    assert names(index.search(1, "ｏｒｇ")) == ["Organic Apple"]
+
+def test_limit_and_empty_queries():
+    index = build()
+    assert len(index.search(1, "有機", limit=1)) == 1
+    assert index.search(1, "！？") == []
+    assert index.search(1, "不存在") == []
+
+def test_added_products_are_searchable_and_ranked_with_the_base():
+    index = build()
+    index.add(1, 8, "蘋果汁")
+    index.add(1, 9, "青森蘋果")
+    assert names(index.search(1, "蘋果")) == ["蘋果", "蘋果汁", "青森蘋果", "有機蘋果禮盒", "台東有機蘋果"]
+    index.add(2, 10, "蘋果") # Tenant 2 has no index yet; it is loaded from the database on first search
+    assert not index.is_built(2)
+
+def test_products_created_during_a_build_are_not_lost():
+    index = ProductSearchIndex()
+    async def load():
+        index.add(1, 20, "火龍果") # Committed after the snapshot was read
+        return ROWS + [(21, "百香果")]
+    asyncio.run(index.ensure_built(1, load))
+    assert names(index.search(1, "果", limit=50)).count("火龍果") == 1
+    assert "百香果" in names(index.search(1, "百香"))
+
+def test_tenants_are_isolated():
+    index = build()
+    async def load():
+        return [(100, "有機蘋果")]
+    asyncio.run(index.ensure_built(2, load))
+    assert names(index.search(2, "蘋果")) == ["有機蘋果"]
+    assert len(index.search(1, "蘋果")) == 3
+
+def test_needs_refresh_on_age_and_delta_size():
+    index = build(max_age_s=300, min_delta_rebuild=2)
+    assert not index.needs_refresh(1)
+    for product_id in range(30, 33):
+        index.add(1, product_id, f"新品{product_id}")
+    assert index.needs_refresh(1)
+    asyncio.run(index.refresh(1, lambda: asyncio.sleep(0, ROWS)))
+    assert not index.needs_refresh(1)
+    index._indexes[1].built_at = time.time() - 301
+    assert index.needs_refresh(1)
+
+def test_stats_report_memory_per_tenant():
+    index = build()
+    stats = index.stats()[1]
+    assert stats["products"] == len(ROWS) and stats["delta_products"] == 0
+    memory = stats["memory_bytes"]
+    assert memory["total"] == memory["names"] + memory["postings"] + memory["delta"] > 0
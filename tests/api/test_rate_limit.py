@@ -0,0 +1,139 @@
+import asyncio
+import json
+import time
+import httpx
+import pytest
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from api.main import app, create_access_token, rate_limit_exempt_paths, rate_limit_exempt_routes, rate_limiter, redis_client, request_tenant
+from api.services.rate_limit import RateLimitMiddleware, TokenBucketLimiter, route_key
+
+TENANT_ID = 9904 # Buckets of these test tenants are removed after each test
+ENTERPRISE_TENANT_ID = 9905
+PLANS = {
+    "free": {"rate": 1, "burst": 2, "route_rate": 1, "route_burst": 2},
+    "standard": {"rate": 1, "burst": 4, "route_rate": 1, "route_burst": 3},
+    "enterprise": {"rate": 10, "burst": 8, "route_rate": 10, "route_burst": 8},
+}
+
+def make_client(limiter: TokenBucketLimiter, max_in_flight: int = 0) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/api/v1/products")
+    def products():
+        return []
+
+    @app.get("/api/v1/products/{product_id}")
+    def product(product_id: int):
+        return {"id": product_id}
+
+    @app.get("/api/v1/iot/devices/{device_id}")
+    def device(device_id: str):
+        return {"device_id": device_id}
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok"}
+
+    @app.get("/slow")
+    async def slow():
+        await asyncio.sleep(0.2)
+        return {}
+
+    app.add_middleware(RateLimitMiddleware, limiter=limiter, resolve_tenant=request_tenant, exempt_paths=("/health",), max_in_flight=max_in_flight)
+    return TestClient(app)
+
+def auth(tenant_id: int) -> dict:
+    return {"Authorization": f"Bearer {create_access_token({'sub': 'testuser', 'tenant_id': tenant_id})}"}
+
+@pytest.fixture(scope="function")
+def limiter():
+    yield TokenBucketLimiter(redis_client, PLANS, {ENTERPRISE_TENANT_ID: "enterprise"}, default_plan="standard", anonymous_plan="free")
+    for pattern in (f"ratelimit:{{t:{TENANT_ID}}}*", f"ratelimit:{{t:{ENTERPRISE_TENANT_ID}}}*", "ratelimit:{ip:testclient}*"):
+        for key in redis_client.scan_iter(pattern):
+            redis_client.delete(key)
+
+def test_route_key_folds_ids():
+    assert route_key("GET", "/api/v1/products/101/stock") == route_key("GET", "/api/v1/products/7/stock") == "GET /api/v1/products/{id}/stock"
+    assert route_key("GET", "/api/v1/iot/devices/sensor-01") == "GET /api/v1/iot/devices/sensor-01"
+
+def test_route_buckets_follow_the_route_template(limiter):
+    client = make_client(limiter)
+    devices = ["sensor-a", "sensor-b", "sensor-c", "sensor-d"]
+    responses = [client.get(f"/api/v1/iot/devices/{device}", headers=auth(TENANT_ID)) for device in devices]
+    assert [response.status_code for response in responses] == [200] * 3 + [429]
+    assert responses[-1].json()["detail"] == "Rate limit exceeded for this route"
+
+def test_tenant_over_its_route_limit_gets_429_with_retry_after(limiter):
+    client = make_client(limiter)
+    assert [client.get("/api/v1/products", headers=auth(TENANT_ID)).status_code for _ in range(3)] == [200] * 3
+    response = client.get("/api/v1/products", headers=auth(TENANT_ID))
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["detail"] == "Rate limit exceeded for this route"
+    # The tenant's remaining budget is still available on other routes, and other tenants are unaffected
+    assert client.get("/api/v1/products/101", headers=auth(TENANT_ID)).status_code == 200
+    assert client.get("/api/v1/products", headers=auth(ENTERPRISE_TENANT_ID)).status_code == 200
+    response = client.get("/api/v1/products/102", headers=auth(TENANT_ID))
+    assert response.status_code == 429 and response.json()["detail"] == "Rate limit exceeded for this tenant"
+    assert limiter.stats()["tenants"][f"t:{TENANT_ID}"] == {"allowed": 4, "rejected": 2, "route_rejected": 1}
+
+def test_limits_follow_the_tenant_plan(limiter):
+    client = make_client(limiter)
+    assert [client.get("/api/v1/products", headers=auth(ENTERPRISE_TENANT_ID)).status_code for _ in range(9)] == [200] * 8 + [429]
+
+def test_tokens_refill_over_time(limiter):
+    client = make_client(limiter)
+    statuses = [client.get("/api/v1/products", headers=auth(TENANT_ID)).status_code for _ in range(4)]
+    assert statuses[-1] == 429
+    time.sleep(1.1)
+    assert client.get("/api/v1/products", headers=auth(TENANT_ID)).status_code == 200
+
+def test_requests_without_a_valid_token_are_limited_per_client(limiter):
+    client = make_client(limiter)
+    statuses = [client.get("/api/v1/products/1").status_code,
+                client.get("/api/v1/products/2", headers={"Authorization": "Bearer invalid_jwt_token"}).status_code,
+                client.get("/api/v1/products/3").status_code]
+    assert statuses == [200, 200, 429]
+    assert limiter.stats()["tenants"]["anonymous"]["rejected"] == 1
+    assert [client.get("/health").status_code for _ in range(5)] == [200] * 5 # Exempt
+
+def test_redis_outage_falls_back_to_in_process_buckets(limiter):
+    unreachable = redis.Redis(host="127.0.0.1", port=1, socket_connect_timeout=0.05, socket_timeout=0.05, retry=Retry(NoBackoff(), 0))
+    limiter = TokenBucketLimiter(unreachable, PLANS, default_plan="standard", anonymous_plan="free", fallback_s=60)
+    client = make_client(limiter)
+    assert [client.get("/api/v1/products", headers=auth(TENANT_ID)).status_code for _ in range(4)] == [200] * 3 + [429]
+    stats = limiter.stats()
+    assert stats["redis_errors"] == 1 and stats["local_checks"] == 4 # Redis is not retried during the fallback period
+
+def test_load_is_shed_beyond_max_in_flight(limiter):
+    app = make_client(limiter, max_in_flight=1).app
+
+    async def burst():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await asyncio.gather(*(client.get("/slow", headers=auth(ENTERPRISE_TENANT_ID)) for _ in range(3)))
+
+    responses = asyncio.run(burst())
+    assert sorted(response.status_code for response in responses) == [200, 503, 503]
+    assert all(response.headers["Retry-After"] == "1" for response in responses if response.status_code == 503)
+    assert limiter.stats()["shed"] == 2
+
+def test_app_limits_tenants_but_not_iot_ingest(limiter, monkeypatch):
+    # The app's own limiter (when enabled) shares these Redis buckets, so only the one under test may take tokens
+    monkeypatch.setattr(rate_limiter, "check", lambda tenant_id, client, route: (True, 0.0, ""))
+    client = TestClient(RateLimitMiddleware(app, limiter=limiter, resolve_tenant=request_tenant,
+                                            exempt_paths=rate_limit_exempt_paths, exempt_routes=rate_limit_exempt_routes))
+    readings = [{"device_id": "sensor-rl", "timestamp": f"2025-01-01T00:00:{i:02d}Z", "temperature": 20.0 + i} for i in range(10)]
+    assert [client.post("/api/v1/iot/data", json=reading, headers=auth(TENANT_ID)).status_code for reading in readings] == [201] * 10
+    body = "\n".join(json.dumps(reading) for reading in readings)
+    response = client.post("/api/v1/iot/data/bulk", content=body.encode("utf-8"), headers={**auth(TENANT_ID), "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200 and response.json()["accepted"] == 10
+    # Ingest took no tokens, so the tenant still has its full route burst elsewhere
+    assert [client.get("/api/v1/iot/devices", headers=auth(TENANT_ID)).status_code for _ in range(4)] == [200] * 3 + [429]
+
+def test_unknown_plan_is_rejected():
+    with pytest.raises(ValueError):
+        TokenBucketLimiter(redis_client, PLANS, {TENANT_ID: "platinum"})
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import tempfile
+import time
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+from api.main import redis_client
+from api.models import Base, Product
+from api.services.read_replicas import PIN_KEY_PREFIX, ReplicaRouter, client_key
+
+def sqlite_db(rows) -> str:
+    path = os.path.join(tempfile.mkdtemp(), "agribridge.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine, tables=[Product.__table__])
+    with engine.begin() as conn:
+        conn.execute(Product.__table__.insert(), [{"id": i, "tenant_id": 1, "name": name, "price": 1.0, "farmer_id": 1} for i, name in rows])
+    engine.dispose()
+    return f"sqlite+aiosqlite:///{path}"
+
+def async_engine(url: str):
+    return create_async_engine(url, poolclass=NullPool)
+
+@pytest.fixture(scope="function")
+def primary_url():
+    return sqlite_db([(1, "有機蔬菜包"), (2, "高山水果禮盒")])
+
+@pytest.fixture(scope="function")
+def key():
+    key = client_key("Bearer test-token", None)
+    yield key
+    redis_client.delete(f"{PIN_KEY_PREFIX}:{key}")
+
+def make_router(primary_url, replicas, **kwargs) -> ReplicaRouter:
+    primary = async_sessionmaker(async_engine(primary_url), expire_on_commit=False)
+    return ReplicaRouter(primary, [(f"replica{i + 1}", async_engine(url)) for i, url in enumerate(replicas)], redis_client, **kwargs)
+
+async def product_names(session_factory):
+    async with session_factory() as db:
+        return (await db.execute(select(Product.name).order_by(Product.id))).scalars().all()
+
+def test_client_key_uses_the_token_or_the_address():
+    assert client_key("Bearer a", "10.0.0.1") == client_key("Bearer a", "10.0.0.2") != client_key("Bearer b", "10.0.0.1")
+    assert client_key(None, "10.0.0.1") != client_key(None, "10.0.0.2")
+
+def test_reads_rotate_over_replicas_of_the_same_database(primary_url, key):
+    router = make_router(primary_url, [primary_url, primary_url])
+    routed = [asyncio.run(router.route(key)) for _ in range(4)]
+    assert [name for name, _ in routed] == ["replica1", "replica2", "replica1", "replica2"]
+    assert asyncio.run(product_names(routed[0][1])) == ["有機蔬菜包", "高山水果禮盒"]
+    assert router.stats()["replicas"]["replica1"]["reads"] == 2
+
+def test_without_replicas_reads_go_to_the_primary(primary_url, key):
+    router = make_router(primary_url, [])
+    assert not router.enabled and asyncio.run(router.route(key)) == (None, router.primary)
+
+def test_writers_read_their_writes_from_the_primary(primary_url, key):
+    stale_replica = sqlite_db([(1, "有機蔬菜包")]) # Has not replicated product 2 yet
+    router = make_router(primary_url, [stale_replica], pin_s=0.2)
+    asyncio.run(router.pin(key))
+    name, session_factory = asyncio.run(router.route(key))
+    assert name is None and asyncio.run(product_names(session_factory)) == ["有機蔬菜包", "高山水果禮盒"]
+    assert asyncio.run(router.route(client_key("Bearer other", None)))[0] == "replica1" # Other clients are not pinned
+    time.sleep(0.25)
+    assert asyncio.run(router.route(key))[0] == "replica1"
+
+def test_pins_are_shared_between_workers(primary_url, key):
+    writer, reader = make_router(primary_url, [primary_url]), make_router(primary_url, [primary_url])
+    asyncio.run(writer.pin(key))
+    assert asyncio.run(reader.route(key))[0] is None
+    assert reader.stats()["pinned_reads"] == 1
+
+def test_failing_replica_is_ejected_and_reads_fall_back(primary_url, key):
+    broken = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'missing', 'replica.db')}"
+    router = make_router(primary_url, [broken, primary_url], eject_after_failures=2, eject_s=0.2)
+    assert asyncio.run(router.check()) == {"replica1": False, "replica2": True}
+    assert asyncio.run(router.route(key))[0] == "replica1" # One failure is tolerated
+    asyncio.run(router.check())
+    assert [asyncio.run(router.route(key))[0] for _ in range(3)] == ["replica2"] * 3
+    assert router.stats()["replicas"]["replica1"]["ejections"] == 1
+
+    router.record_failure("replica2"), router.record_failure("replica2")
+    assert asyncio.run(router.route(key)) == (None, router.primary)
+    assert router.stats()["fallback_reads"] == 1
+
+    time.sleep(0.25) # Ejections over: both are tried again
+    assert {asyncio.run(router.route(key))[0] for _ in range(2)} == {"replica1", "replica2"}
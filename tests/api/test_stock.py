@@ -0,0 +1,141 @@
+import os
+import tempfile
+import threading
+import time
+import pytest
+from redis.crc import key_slot
+from sqlalchemy import create_engine, select
+from api.main import redis_client
+from api.models import Base, Product
+from api.services.stock import TENANTS_KEY, OutOfStock, ReservationExpired, StockReservations, active_key, dirty_key
+
+TENANT_ID = 9903 # Keys of this test tenant are removed after each test
+
+@pytest.fixture(scope="function")
+def engine():
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'stock.db')}")
+    Base.metadata.create_all(bind=engine, tables=[Product.__table__])
+    with engine.begin() as conn:
+        conn.execute(Product.__table__.insert(), [
+            {"id": 1, "tenant_id": TENANT_ID, "name": "高山水果禮盒", "price": 500.0, "farmer_id": 1, "stock": 10},
+            {"id": 2, "tenant_id": TENANT_ID, "name": "有機蔬菜包", "price": 120.0, "farmer_id": 1, "stock": 5},
+        ])
+    yield engine
+    for key in redis_client.scan_iter(f"stock:{{{TENANT_ID}}}:*"):
+        redis_client.delete(key)
+    redis_client.srem(TENANTS_KEY, TENANT_ID)
+
+def db_stock(engine, product_id):
+    with engine.connect() as conn:
+        return conn.execute(select(Product.stock).where(Product.id == product_id)).scalar()
+
+def test_script_keys_share_one_cluster_slot():
+    keys, _ = StockReservations._keys(TENANT_ID, 1)
+    assert len({key_slot(key.encode()) for key in keys + [dirty_key(TENANT_ID)]}) == 1
+
+def test_reserve_loads_stock_and_refuses_to_oversell(engine):
+    stock = StockReservations(redis_client, engine)
+    reservations = [stock.reserve(TENANT_ID, 1, 3, db_stock=10) for _ in range(3)]
+    assert len(set(reservations)) == 3
+    with pytest.raises(OutOfStock):
+        stock.reserve(TENANT_ID, 1, 2, db_stock=10)
+    stock.reserve(TENANT_ID, 1, 1, db_stock=10)
+    assert stock.levels(TENANT_ID, 1) == {"available": 0, "held": 10}
+
+def test_reserve_refuses_quantities_that_are_not_positive(engine):
+    stock = StockReservations(redis_client, engine)
+    for quantity in (0, -5):
+        with pytest.raises(ValueError):
+            stock.reserve(TENANT_ID, 1, quantity, db_stock=10)
+    keys, member = stock._keys(TENANT_ID, 1)
+    assert stock._reserve(keys=keys, args=[member, 0, -5, "forged", 1]) == -3 # The script checks too
+    stock.reserve(TENANT_ID, 1, 1, db_stock=10)
+    assert stock.levels(TENANT_ID, 1) == {"available": 9, "held": 1}
+
+def test_concurrent_buyers_never_oversell(engine):
+    stock = StockReservations(redis_client, engine)
+    outcomes = []
+    def buy():
+        try:
+            stock.reserve(TENANT_ID, 1, 1, db_stock=10)
+            outcomes.append("reserved")
+        except OutOfStock:
+            outcomes.append("sold out")
+    threads = [threading.Thread(target=buy) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outcomes.count("reserved") == 10 and outcomes.count("sold out") == 40
+    assert stock.levels(TENANT_ID, 1) == {"available": 0, "held": 10}
+
+def test_confirm_sells_and_release_returns_units(engine):
+    stock = StockReservations(redis_client, engine)
+    sold = stock.reserve(TENANT_ID, 1, 4, db_stock=10)
+    cancelled = stock.reserve(TENANT_ID, 1, 2, db_stock=10)
+    assert stock.confirm(TENANT_ID, 1, sold) == 4
+    assert stock.release(TENANT_ID, 1, cancelled) == 2
+    assert stock.release(TENANT_ID, 1, cancelled) == 0
+    assert stock.levels(TENANT_ID, 1) == {"available": 6, "held": 0}
+    with pytest.raises(ReservationExpired):
+        stock.confirm(TENANT_ID, 1, sold) # Already sold
+
+def test_expired_holds_return_to_stock_and_cannot_be_confirmed(engine):
+    stock = StockReservations(redis_client, engine, hold_ttl_s=0)
+    reservation_id = stock.reserve(TENANT_ID, 1, 10, db_stock=10)
+    time.sleep(0.01)
+    assert stock.release_expired() == 1 # The sweep finds the product with an expired hold
+    assert stock.levels(TENANT_ID, 1) == {"available": 10, "held": 0}
+    with pytest.raises(ReservationExpired):
+        stock.confirm(TENANT_ID, 1, reservation_id)
+    with pytest.raises(ReservationExpired):
+        stock.renew(TENANT_ID, 1, reservation_id)
+    assert stock.release_expired() == 0
+
+def test_renew_extends_the_hold(engine):
+    stock = StockReservations(redis_client, engine, hold_ttl_s=1)
+    reservation_id = stock.reserve(TENANT_ID, 1, 3, db_stock=10)
+    stock.hold_ttl_s = 60
+    assert stock.renew(TENANT_ID, 1, reservation_id) == 3
+    expires_at = redis_client.zscore(f"stock:{{{TENANT_ID}}}:1:expiry", reservation_id)
+    assert expires_at > time.time() * 1000 + 50_000
+    assert redis_client.zscore(active_key(TENANT_ID), f"{TENANT_ID}:1") == expires_at # The sweep will not look at it before then
+
+def test_expired_holds_are_released_by_the_next_reservation(engine):
+    stock = StockReservations(redis_client, engine, hold_ttl_s=0)
+    stock.reserve(TENANT_ID, 2, 5, db_stock=5)
+    time.sleep(0.01)
+    stock.hold_ttl_s = 60
+    stock.reserve(TENANT_ID, 2, 5, db_stock=5)
+    assert stock.levels(TENANT_ID, 2) == {"available": 0, "held": 5}
+
+def test_reconcile_writes_on_hand_stock_in_one_batch(engine):
+    stock = StockReservations(redis_client, engine)
+    stock.confirm(TENANT_ID, 1, stock.reserve(TENANT_ID, 1, 3, db_stock=10))
+    stock.reserve(TENANT_ID, 1, 2, db_stock=10) # Still held: counted as on hand
+    stock.confirm(TENANT_ID, 2, stock.reserve(TENANT_ID, 2, 5, db_stock=5))
+    assert stock.reconcile() == 2
+    assert (db_stock(engine, 1), db_stock(engine, 2)) == (7, 0)
+    assert stock.reconcile() == 0 # Nothing dirty any more
+
+def test_reconcile_keeps_products_changed_during_the_write(engine):
+    stock = StockReservations(redis_client, engine)
+    stock.confirm(TENANT_ID, 1, stock.reserve(TENANT_ID, 1, 1, db_stock=10))
+    write = stock.engine.begin
+    def begin():
+        stock.confirm(TENANT_ID, 1, stock.reserve(TENANT_ID, 1, 1, db_stock=10)) # Sold after the snapshot was read
+        return write()
+    stock.engine = type("Engine", (), {"begin": staticmethod(begin)})
+    assert stock.reconcile() == 1
+    stock.engine = engine
+    assert db_stock(engine, 1) == 9
+    assert stock.reconcile() == 1
+    assert db_stock(engine, 1) == 8
+
+def test_set_available_keeps_holds(engine):
+    stock = StockReservations(redis_client, engine)
+    stock.reserve(TENANT_ID, 1, 4, db_stock=10)
+    assert stock.set_available(TENANT_ID, 1, 100) == 104
+    assert stock.levels(TENANT_ID, 1) == {"available": 100, "held": 4}
+    stock.reconcile()
+    assert db_stock(engine, 1) == 104
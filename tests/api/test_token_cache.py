@@ -0,0 +1,52 @@
+import time
+from api.services.token_cache import TokenCache
+
+CLAIMS = {"username": "testuser", "tenant_id": 1}
+
+def test_cached_claims_are_returned_as_copies():
+    cache = TokenCache()
+    assert cache.get("token-a") is None
+    cache.put("token-a", CLAIMS, exp=time.time() + 60)
+    claims = cache.get("token-a")
+    assert claims == CLAIMS
+    claims["tenant_id"] = 2 # A handler changing its copy does not affect the next request
+    assert cache.get("token-a") == CLAIMS
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+def test_entries_expire_at_the_token_exp_or_max_ttl():
+    cache = TokenCache(max_ttl_s=60)
+    cache.put("expiring", CLAIMS, exp=time.time() + 0.05)
+    cache.put("long-lived", CLAIMS, exp=time.time() + 3600)
+    time.sleep(0.1)
+    assert cache.get("expiring") is None and cache.get("long-lived") == CLAIMS
+    cache.max_ttl_s = 0.05
+    cache.put("long-lived", CLAIMS, exp=time.time() + 3600)
+    time.sleep(0.1)
+    assert cache.get("long-lived") is None
+    assert cache.stats()["expired"] == 2
+
+def test_least_recently_used_tokens_are_evicted():
+    cache = TokenCache(max_entries=2)
+    cache.put("a", CLAIMS)
+    cache.put("b", CLAIMS)
+    cache.get("a")
+    cache.put("c", CLAIMS)
+    assert cache.get("b") is None and cache.get("a") == CLAIMS and cache.get("c") == CLAIMS
+    assert cache.stats()["size"] == 2 and cache.stats()["evictions"] == 1
+
+def test_revoked_tokens_are_evicted_and_not_cached_again():
+    cache = TokenCache()
+    cache.put("token-a", CLAIMS)
+    assert cache.revoke("token-a", exp=time.time() + 0.05)
+    assert cache.get("token-a") is None and cache.is_revoked("token-a")
+    cache.put("token-a", CLAIMS) # Verified concurrently with the revocation
+    assert cache.get("token-a") is None
+    time.sleep(0.1)
+    assert not cache.is_revoked("token-a") # Past its exp the token is refused as expired anyway
+
+def test_zero_entries_disables_the_cache():
+    cache = TokenCache(max_entries=0)
+    cache.put("token-a", CLAIMS)
+    assert cache.get("token-a") is None and cache.stats()["size"] == 0
+    cache.revoke("token-a")
+    assert cache.is_revoked("token-a")